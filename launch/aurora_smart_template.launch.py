@@ -5,6 +5,7 @@ from ament_index_python.packages import get_package_share_directory
 from launch_ros.actions import Node
 from launch import LaunchDescription, actions
 from launch.actions import DeclareLaunchArgument
+from launch.conditions import UnlessCondition
 from launch.substitutions import LaunchConfiguration
 
 
@@ -23,13 +24,14 @@ def generate_launch_description():
             {"RIB_server_ip":"localhost"},
             {"RIB_port": 18944},
             {"RIB_type": "client"}
-        ]
+        ],
+        condition=UnlessCondition(LaunchConfiguration('igtl_direct'))
     )
 
     sensor = Node(
         package = "trajcontrol",
         executable = "sensor_processing",
-        parameters=[{"registration":LaunchConfiguration('registration')}]
+        parameters=[{"registration":LaunchConfiguration('registration')}, {"igtl_direct": LaunchConfiguration('igtl_direct')}]
     )
 
     robot = Node(
@@ -69,6 +71,11 @@ def generate_launch_description():
             description="0=load previous / 1=new registration"
         ),
         actions.LogInfo(msg=["registration: ", LaunchConfiguration('registration')]),
+        DeclareLaunchArgument(
+            "igtl_direct",
+            default_value="false",
+            description="true=sensor_processing reads the PLUS OpenIGTLink server itself (no igtl_node)"
+        ),
         aurora,
         sensor,
         estimator,
@@ -0,0 +1,76 @@
+import os
+import sys
+
+from ament_index_python.packages import get_package_share_directory
+from launch_ros.actions import Node
+from launch import LaunchDescription, actions
+from launch.actions import DeclareLaunchArgument
+from launch.conditions import UnlessCondition
+from launch.substitutions import LaunchConfiguration
+
+
+def generate_launch_description():
+
+    config = os.path.join(
+        get_package_share_directory('trajcontrol'),
+        'config',
+        'virtual_nodes_params.yaml'
+        )
+
+    # OpenIGTLink server standing in for PLUS + Aurora (no hardware): full TCP -> bridge -> sensor_processing path
+    server = Node(
+        package="trajcontrol",
+        executable="igtl_server",
+        parameters=[config, {"source": LaunchConfiguration('source')}, {"log": LaunchConfiguration('log')}, \
+            {"rate": LaunchConfiguration('rate')}]
+    )
+
+    aurora = Node(
+        package="ros2_igtl_bridge",
+        executable="igtl_node",
+        parameters=[
+            {"RIB_server_ip":"localhost"},
+            {"RIB_port": 18944},
+            {"RIB_type": "client"}
+        ],
+        condition=UnlessCondition(LaunchConfiguration('igtl_direct'))
+    )
+
+    sensor = Node(
+        package = "trajcontrol",
+        executable = "sensor_processing",
+        parameters=[{"registration":LaunchConfiguration('registration')}, {"auto_entry": True}, \
+            {"igtl_direct": LaunchConfiguration('igtl_direct')}]
+    )
+
+    return LaunchDescription([
+        DeclareLaunchArgument(
+            "source",
+            default_value="dataset",
+            description="Tool poses: dataset / log (recorded run) / needle (follows /stage/state/needle_pose)"
+        ),
+        DeclareLaunchArgument(
+            "log",
+            default_value="",
+            description="Recorded run replayed with source=log (csv / col / stream directory)"
+        ),
+        DeclareLaunchArgument(
+            "rate",
+            default_value="40.0",
+            description="Tracker frame rate (Hz)"
+        ),
+        DeclareLaunchArgument(
+            "registration",
+            default_value="0",
+            description="0=load previous / 1=new registration"
+        ),
+        DeclareLaunchArgument(
+            "igtl_direct",
+            default_value="false",
+            description="true=sensor_processing reads the server itself / false=through igtl_node"
+        ),
+        actions.LogInfo(msg=["source: ", LaunchConfiguration('source')]),
+        server,
+        aurora,
+        sensor,
+    ])
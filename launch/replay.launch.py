@@ -0,0 +1,82 @@
+import os
+
+from ament_index_python.packages import get_package_share_directory
+from launch_ros.actions import Node
+from launch import LaunchDescription, actions
+from launch.actions import DeclareLaunchArgument
+from launch.substitutions import LaunchConfiguration
+
+
+def generate_launch_description():
+
+    config = os.path.join(
+        get_package_share_directory('trajcontrol'),
+        'config',
+        'virtual_nodes_params.yaml'
+        )
+
+    # Nodes under test follow the recorded time when the replay runs at max rate
+    sim_time = {"use_sim_time": LaunchConfiguration('max_rate')}
+
+    replay = Node(
+        package="trajcontrol",
+        executable="log_replay",
+        parameters=[{"filename": LaunchConfiguration('run')}, {"speed": LaunchConfiguration('speed')}, \
+            {"max_rate": LaunchConfiguration('max_rate')}, {"publish_entry": LaunchConfiguration('publish_entry')}]
+    )
+
+    sensor = Node(
+        package = "trajcontrol",
+        executable = "sensor_processing",
+        parameters=[{"registration": LaunchConfiguration('registration')}, sim_time]
+    )
+
+    estimator = Node(
+        package="trajcontrol",
+        executable="estimator",
+        parameters=[config, sim_time]
+    )
+
+    file = Node(
+        package="trajcontrol",
+        executable="save_file",
+        parameters=[{"filename": LaunchConfiguration('filename')}, sim_time]
+    )
+
+    return LaunchDescription([
+        DeclareLaunchArgument(
+            "run",
+            default_value="my_data",
+            description="Recorded run to replay (data/<run>.csv, <run>.col or stream directory)"
+        ),
+        actions.LogInfo(msg=["run: ", LaunchConfiguration('run')]),
+        DeclareLaunchArgument(
+            "filename",
+            default_value="replay_data",
+            description="File name to save .csv file with replayed data"
+        ),
+        DeclareLaunchArgument(
+            "speed",
+            default_value="1.0",
+            description="Replay speed factor"
+        ),
+        DeclareLaunchArgument(
+            "max_rate",
+            default_value="false",
+            description="true=replay as fast as possible on simulated time"
+        ),
+        DeclareLaunchArgument(
+            "publish_entry",
+            default_value="true",
+            description="true=replay recorded skin entry / false=let sensor_processing define it"
+        ),
+        DeclareLaunchArgument(
+            "registration",
+            default_value="0",
+            description="0=load previous / 1=new registration"
+        ),
+        replay,
+        sensor,
+        estimator,
+        file
+    ])
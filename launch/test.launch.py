@@ -5,7 +5,8 @@ from ament_index_python.packages import get_package_share_directory
 from launch_ros.actions import Node
 from launch import LaunchDescription, actions
 from launch.actions import DeclareLaunchArgument
-from launch.substitutions import LaunchConfiguration
+from launch.conditions import IfCondition, UnlessCondition
+from launch.substitutions import LaunchConfiguration, PythonExpression
 
 
 def generate_launch_description():
@@ -16,37 +17,75 @@ def generate_launch_description():
         'virtual_nodes_params.yaml'
         )
 
+    # Simulated time: every node follows /clock from sim_clock (galil robot runs in real time)
+    sim_time = {"use_sim_time": LaunchConfiguration('sim_time')}
+
+    clock = Node(
+        package="trajcontrol",
+        executable="sim_clock",
+        parameters=[{"max_speed": LaunchConfiguration('max_speed')}],
+        condition=IfCondition(LaunchConfiguration('sim_time'))
+    )
+
+    # Aurora: simulated by virtual_robot (closed loop needle simulation) or by virtual_aurora
+    # (following the needle simulation at the tracker rate with its noise models, or replaying a recorded dataset)
+    use_needle = PythonExpression(["'", LaunchConfiguration('simulation'), "' == 'needle'"])
+    use_tracker = PythonExpression(["'", LaunchConfiguration('simulation'), "' != 'needle' or '", LaunchConfiguration('aurora'), "' == 'tracker'"])
+    robot_aurora = PythonExpression(["'", LaunchConfiguration('simulation'), "' == 'needle' and '", LaunchConfiguration('aurora'), "' == 'robot'"])
+
     aurora = Node(
         package="trajcontrol",
         executable="virtual_aurora",
+        parameters=[config, {"source": PythonExpression(["'needle' if ", use_needle, " else 'dataset'"])}, sim_time],
+        condition=IfCondition(use_tracker)
     )
 
     sensor = Node(
         package = "trajcontrol",
         executable = "sensor_processing",
-        parameters=[{"registration":LaunchConfiguration('registration')}]
+        parameters=[{"registration":LaunchConfiguration('registration')}, {"auto_entry": use_needle}, sim_time]
     )
 
+    # Robot: virtual_robot or smart_template talking to the simulated Galil controller
+    use_galil = PythonExpression(["'", LaunchConfiguration('robot'), "' == 'galil'"])
+
     robot = Node(
         package="trajcontrol",
-        executable="virtual_robot"
+        executable="virtual_robot",
+        parameters=[config, {"publish_aurora": robot_aurora}, {"auto_step": use_needle}, sim_time],
+        condition=UnlessCondition(use_galil)
+    )
+
+    galil = Node(
+        package="trajcontrol",
+        executable="galil_simulator",
+        parameters=[{"port_link": "/tmp/ttyGalil"}],
+        condition=IfCondition(use_galil)
+    )
+
+    smart_template = Node(
+        package="trajcontrol",
+        executable="smart_template",
+        parameters=[{"serial_port": "/tmp/ttyGalil"}, {"position_source": LaunchConfiguration('position_source')}],
+        condition=IfCondition(use_galil)
     )
 
     estimator = Node(
         package="trajcontrol",
         executable="estimator",
-        parameters=[config]
+        parameters=[config, sim_time]
     )
 
     controller = Node(
         package="trajcontrol",
-        executable="controller_discrete"
+        executable="controller_discrete",
+        parameters=[sim_time]
     )   
 
     file = Node(
         package="trajcontrol",
         executable="save_file",
-        parameters=[{"filename":LaunchConfiguration('filename')}]
+        parameters=[{"filename":LaunchConfiguration('filename')}, sim_time]
     )
 
     return LaunchDescription([
@@ -62,10 +101,43 @@ def generate_launch_description():
             description="0=load previous / 1=new registration"
         ),
         actions.LogInfo(msg=["registration: ", LaunchConfiguration('registration')]),
+        DeclareLaunchArgument(
+            "robot",
+            default_value="virtual",
+            description="virtual=virtual_robot / galil=smart_template with simulated Galil controller"
+        ),
+        DeclareLaunchArgument(
+            "simulation",
+            default_value="needle",
+            description="needle=closed loop needle simulation in virtual_robot / dataset=virtual_aurora replays a recorded dataset"
+        ),
+        DeclareLaunchArgument(
+            "aurora",
+            default_value="robot",
+            description="robot=Aurora readings from virtual_robot / tracker=virtual_aurora tools at the tracker rate (simulation=needle)"
+        ),
+        DeclareLaunchArgument(
+            "sim_time",
+            default_value="false",
+            description="true=run on simulated time stepped by sim_clock (as fast as the nodes allow)"
+        ),
+        DeclareLaunchArgument(
+            "max_speed",
+            default_value="0.0",
+            description="sim_clock maximum speed factor over real time (0 = unlimited)"
+        ),
+        DeclareLaunchArgument(
+            "position_source",
+            default_value="poll",
+            description="smart_template stage position source: poll / record"
+        ),
+        clock,
         aurora,
         sensor,
         estimator,
         controller,
         robot,
+        galil,
+        smart_template,
         file
     ])
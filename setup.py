@@ -13,7 +13,8 @@ setup(
             ['resource/' + package_name]),
         ('share/' + package_name, ['package.xml']),
         (os.path.join('share', package_name, 'launch'), glob('launch/*.launch.py')),
-        (os.path.join('share', package_name, 'config'), glob('config/*.yaml'))
+        (os.path.join('share', package_name, 'config'), glob('config/*.yaml')),
+        (os.path.join('share', package_name, 'files'), glob('files/*.mat') + glob('files/*.xml'))
     ],
     
     install_requires=['setuptools'],
@@ -27,6 +28,7 @@ setup(
         'console_scripts': [
             'virtual_aurora = trajcontrol.virtual_aurora:main',
             'virtual_robot = trajcontrol.virtual_robot:main',
+            'sim_clock = trajcontrol.sim_clock:main',
             'virtual_UI = trajcontrol.virtual_UI:main',
             'keypress = trajcontrol.keypress:main',
             'sensor_processing = trajcontrol.sensor_processing:main',
@@ -36,8 +38,23 @@ setup(
             'controller_mpc = trajcontrol.controller_mpc:main',
             'controller_rand = trajcontrol.controller_rand:main',
             'save_file = trajcontrol.save_file:main',
+            'log_join = trajcontrol.log_join:main',
+            'log_columnar = trajcontrol.log_columnar:main',
+            'log_loader = trajcontrol.log_loader:main',
+            'log_catalog = trajcontrol.log_catalog:main',
+            'log_replay = trajcontrol.log_replay:main',
+            'log_metrics = trajcontrol.log_metrics:main',
+            'log_reprocess = trajcontrol.log_reprocess:main',
+            'log_smoother = trajcontrol.log_smoother:main',
+            'monte_carlo = trajcontrol.monte_carlo:main',
+            'dataset = trajcontrol.dataset:main',
+            'shape_processing = trajcontrol.shape_processing:main',
+            'fault_injector = trajcontrol.fault_injector:main',
+            'igtl_server = trajcontrol.igtl_server:main',
             'smart_template = trajcontrol.smart_template:main',
             'smart_template_manual = trajcontrol.smart_template_manual:main',
+            'galil_simulator = trajcontrol.galil_simulator:main',
+            'galil_benchmark = trajcontrol.galil_simulator:benchmark',
         ],
     },
 )
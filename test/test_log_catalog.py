@@ -0,0 +1,45 @@
+import os
+import shutil
+import sqlite3
+import numpy as np
+
+from trajcontrol import log_loader
+from trajcontrol.log_catalog import Catalog, CATALOG_VERSION, despike, run_metadata
+
+DATA = os.path.join(os.path.dirname(__file__), '..', 'data')
+RUN = 'fix_J_05_K05.csv'
+
+
+# Catalog errors: lateral distance from the entry point, despiked after taking the distance
+def test_lateral_error_definition():
+    filename = os.path.join(DATA, RUN)
+    log = log_loader.load(filename, cache=False)
+    entry = log.get(['Entry_point x', 'Entry_point y', 'Entry_point z'])
+    tip = log.get(['Tip x', 'Tip y', 'Tip z'])
+    valid = np.any(entry != 0, axis=1) & np.any(tip != 0, axis=1)
+    error = despike(np.hypot(tip[valid,0] - entry[valid,0], tip[valid,2] - entry[valid,2]))
+    meta = run_metadata(filename)
+    assert np.isclose(meta['error_rms'], np.sqrt(np.mean(error**2)))
+    assert np.isclose(meta['error_max'], error.max())
+
+
+# Runs indexed by a catalog of another version are indexed again even if their file did not change
+def test_catalog_version_reindex(tmp_path):
+    folder = str(tmp_path)
+    shutil.copy(os.path.join(DATA, RUN), folder)
+    db = os.path.join(folder, 'catalog.sqlite')
+    catalog = Catalog(db)
+    assert catalog.update(folder, workers=1)[0] == 1
+    assert catalog.update(folder, workers=1)[0] == 0
+    catalog.close()
+
+    old = sqlite3.connect(db)
+    old.execute('UPDATE runs SET error_rms = -1')
+    old.execute('PRAGMA user_version = %d' % (CATALOG_VERSION - 1))
+    old.commit()
+    old.close()
+
+    catalog = Catalog(db)
+    assert catalog.update(folder, workers=1)[0] == 1
+    assert catalog.query()[0]['error_rms'] > 0
+    catalog.close()
@@ -0,0 +1,19 @@
+import numpy as np
+
+from trajcontrol.log_reprocess import filter_scale
+from trajcontrol.pose_filter import FILTER_WINDOW, FILTER_SIZE
+
+
+# Snapshot logs (5 Hz readings) get the live filter span (40 readings at 40 Hz = 1 s)
+def test_filter_scale_snapshot():
+    stamp = np.arange(100, dtype=np.int64)*200000000
+    window, size, rate = filter_scale(stamp, FILTER_WINDOW, FILTER_SIZE, 40.0)
+    assert np.isclose(rate, 5.0)
+    assert size == 5 and window == 62
+
+
+# Stream recordings (every Aurora reading) are filtered as live
+def test_filter_scale_stream():
+    stamp = np.arange(100, dtype=np.int64)*25000000
+    assert filter_scale(stamp, FILTER_WINDOW, FILTER_SIZE, 40.0)[0:2] == (FILTER_WINDOW, FILTER_SIZE)
+    assert filter_scale(stamp[::8], FILTER_WINDOW, FILTER_SIZE, 0.0)[0:2] == (FILTER_WINDOW, FILTER_SIZE)
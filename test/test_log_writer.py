@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import pytest
+
+from trajcontrol import log_loader
+from trajcontrol.control_law import J_INITIAL
+from trajcontrol.log_writer import LogWriter, STREAMS, RECEIVE_COLUMNS, SNAPSHOT_HEADER, FORMATS, jacobian_values
+
+
+# The estimator publishes a 5x3 Jacobian: logged values are padded to the 7x7 J columns
+def test_jacobian_values():
+    values = jacobian_values(J_INITIAL)
+    assert len(values) == len(STREAMS['jacobian']) - 2
+    padded = np.reshape(values, (7, 7))
+    assert np.array_equal(padded[0:5, 0:3], J_INITIAL)
+    assert not np.any(padded[5:, :]) and not np.any(padded[:, 3:])
+    with pytest.raises(ValueError):
+        jacobian_values(np.zeros((8, 3)))
+
+
+@pytest.mark.parametrize('log_format', list(FORMATS))
+def test_jacobian_stream_load(tmp_path, log_format):
+    filename = os.path.join(str(tmp_path), 'jacobian' + FORMATS[log_format])
+    writer = LogWriter(filename, RECEIVE_COLUMNS + STREAMS['jacobian'], format=log_format)
+    for i in range(3):
+        assert writer.write([10+i, 500] + jacobian_values(J_INITIAL*(i+1)) + [10+i, 0])
+    writer.close()
+    assert writer.written == 3
+
+    log = log_loader.load(filename)
+    assert len(log) == 3
+    assert np.allclose(log['J21'], J_INITIAL[2, 1]*np.arange(1, 4))
+    assert np.allclose(log['J66'], 0.0)
+
+
+@pytest.mark.parametrize('log_format', list(FORMATS))
+def test_snapshot_load(tmp_path, log_format):
+    filename = os.path.join(str(tmp_path), 'run' + FORMATS[log_format])
+    row = [10, 0] + [1.0, 2.0, 3.0, 9, 0] + [0.0]*9*4 + jacobian_values(J_INITIAL) + [10, 0] + [12.5, 11.0, 10, 0]
+    assert len(row) == len(SNAPSHOT_HEADER)
+    writer = LogWriter(filename, SNAPSHOT_HEADER, format=log_format)
+    writer.write(row)
+    writer.close()
+
+    log = log_loader.load(filename)
+    assert len(log) == 1
+    assert np.isclose(log['J00'][0], J_INITIAL[0, 0])
+    assert np.isclose(log['Control z'][0], 11.0)
+
+
+# A row that cannot be written is dropped and reported, later rows are still written
+class ListLogger():
+
+    def __init__(self):
+        self.messages = []
+
+    def error(self, message):
+        self.messages.append(message)
+
+
+def test_writer_survives_bad_rows(tmp_path):
+    filename = os.path.join(str(tmp_path), 'control' + FORMATS['columnar'])
+    logger = ListLogger()
+    writer = LogWriter(filename, RECEIVE_COLUMNS + STREAMS['control'], format='columnar', flush_rows=1, logger=logger)
+    writer.write([1, 0, 12.5])                      # Wrong number of values
+    writer.write([2, 0, 12.5, 11.0, 2, 0])
+    writer.close()
+    assert writer.written == 1 and writer.dropped == 1 and writer.errors == 1
+    assert len(logger.messages) == 1
+    assert len(log_loader.load(filename)) == 1
+
+
+# The disk budget counts and evicts only the segments of its writers
+def test_budget_evicts_own_segments(tmp_path):
+    folder = str(tmp_path)
+    with open(os.path.join(folder, 'other.bin'), 'wb') as f:
+        f.write(b'0'*100000)                    # Larger than the budget, never counted or removed
+    filename = os.path.join(folder, 'control.csv')
+    writer = LogWriter(filename, RECEIVE_COLUMNS + STREAMS['control'], flush_rows=10, rotate_size=500, disk_budget=2000, logger=ListLogger())
+    for i in range(1000):
+        writer.write([i, 0, 12.5, 11.0, i, 0])
+    writer.close()
+    assert writer.evicted and not writer.refused and (writer.dropped == 0)
+    assert writer.usage() <= 2000
+    assert os.path.getsize(os.path.join(folder, 'other.bin')) == 100000
+    log = log_loader.load(os.path.join(folder, 'control.manifest.json'))
+    assert 0 < len(log) < 1000
+    assert log['Control sec'][-1] == 999
+
+
+# Without rotation nothing can be evicted: rows are refused once the file reaches the budget
+def test_budget_without_rotation(tmp_path):
+    logger = ListLogger()
+    writer = LogWriter(os.path.join(str(tmp_path), 'control.csv'), RECEIVE_COLUMNS + STREAMS['control'], flush_rows=10, disk_budget=1000, \
+        logger=logger)
+    for i in range(1000):
+        writer.write([i, 0, 12.5, 11.0, i, 0])
+    writer.close()
+    assert writer.refused and (writer.dropped > 0) and (writer.written + writer.dropped == 1000)
+    assert len(logger.messages) == 2            # Warning at start, budget reached
@@ -0,0 +1,153 @@
+import numpy as np
+
+from scipy.optimize import minimize
+
+SAFE_LIMIT = 5.0            # Maximum control output delta from entry point (used by controller_discrete)
+MPC_BOUNDS = ((-10, 10), (-10, 10))     # Stage position bounds of the MPC solution [x, z] (used by controller_mpc)
+CONTROL_LENGTH = 50.0       # Maximum insertion depth for control input (stops robot after that point)
+
+# Initial Jacobian (estimated values from previous experiments)
+# Rows: tip outputs [x_tip, y_tip, z_tip, yaw, pitch]; columns: stage inputs [x_robot, y_needle_depth, z_robot]
+J_INITIAL = np.array([(0.9906,-0.1395,-0.5254),
+                      ( 0.0588, 1.7334,-0.1336),
+                      (-0.3769, 0.1906, 0.2970),
+                      ( 0.0004,-0.0005, 0.0015),
+                      ( 0.0058,-0.0028,-0.0015)])
+
+########################################################################
+### Estimator ###
+########################################################################
+
+# Function: tip_outputs
+# DO: Estimator outputs of tip poses (yaw and pitch from Tait-Bryan Z-Y'-X'' angles)
+# Inputs:
+#   pose: tip pose(s) (numpy array [x, y, z, qw, qx, qy, qz] or Nx7)
+# Output:
+#   Z: [x_tip, y_tip, z_tip, yaw, pitch] (same leading shape as pose)
+def tip_outputs(pose):
+    pose = np.asarray(pose, dtype=float)
+    w, x, y, z = pose[...,3], pose[...,4], pose[...,5], pose[...,6]
+    yaw = np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))
+    pitch = np.arcsin(np.clip(2*(w*y - z*x), -1.0, 1.0))     # 90 degrees if out of range
+    return np.concatenate((pose[...,0:3], yaw[...,None], pitch[...,None]), axis=-1)
+
+# Function: jacobian_update
+# DO: Broyden update of the Jacobian from input and output rates
+# Inputs:
+#   J: current Jacobian (outputs x inputs)
+#   deltaX: input rate (numpy array, inputs)
+#   deltaZ: output rate (numpy array, outputs)
+#   alpha: update gain
+# Output:
+#   updated Jacobian
+def jacobian_update(J, deltaX, deltaZ, alpha):
+    deltaX = np.ravel(deltaX)
+    deltaZ = np.ravel(deltaZ)
+    return J + alpha*np.outer((deltaZ - np.matmul(J, deltaX))/(np.dot(deltaX, deltaX) + 1e-9), deltaX)
+
+########################################################################
+### Controllers ###
+########################################################################
+
+# Function: control_jacobian
+# DO: Columns of the Jacobian driven by the stage (x_robot and z_robot)
+def control_jacobian(J):
+    return np.array([J[:,0], J[:,2]]).T
+
+# Function: discrete_control
+# DO: One step of the discrete Jacobian controller (controller_discrete)
+# Inputs:
+#   stage: current stage position [x, z]
+#   err: output error (target - tip outputs)
+#   J: estimated Jacobian
+#   K: controller gain
+# Output:
+#   stage command [x, z]
+def discrete_control(stage, err, J, K):
+    return np.ravel(stage) + K*np.matmul(np.linalg.pinv(control_jacobian(J)), np.ravel(err))
+
+# Function: limit_control
+# DO: Limit stage command to SAFE_LIMIT around the entry point [x, z]
+def limit_control(cmd, entry, safe_limit=SAFE_LIMIT):
+    return np.clip(cmd, np.ravel(entry) - safe_limit, np.ravel(entry) + safe_limit)
+
+# Function: mpc_control
+# DO: Model predictive control of the stage with the linear Jacobian model y(k+1) = y(k) + Jc (u(k+1) - u(k))
+# Inputs:
+#   tip: current tip outputs
+#   stage: current stage position [x, z]
+#   target: target outputs
+#   J: estimated Jacobian
+#   P: prediction horizon
+#   C: control horizon (input kept constant after C steps)
+#   wu: weight of input changes
+#   bounds: (min, max) stage position of each axis [x, z]
+# Output:
+#   stage command [x, z] (first step of the optimal sequence), final cost
+def mpc_control(tip, stage, target, J, P=10, C=3, wu=0.8, bounds=MPC_BOUNDS):
+    Jc = control_jacobian(J)
+    y0 = np.ravel(tip)
+    u0 = np.ravel(stage)
+    target = np.ravel(target)
+
+    def objective(u_hat):
+        # Reshape u_hat (minimize flattens it) and hold last input until P
+        u_hat = np.reshape(u_hat, (C, 2))
+        u_hat = np.vstack((u_hat, np.repeat(u_hat[[C-1]], P-C, axis=0)))
+        # Predicted outputs over the horizon
+        y_hat = y0 + np.cumsum(np.matmul(np.diff(np.vstack((u0, u_hat)), axis=0), Jc.T), axis=0)
+        return np.linalg.norm(target - y_hat) + wu*np.linalg.norm(np.diff(u_hat, axis=0))
+
+    solution = minimize(objective, np.tile(u0, C), method='SLSQP', bounds=list(bounds)*C)
+    u = np.reshape(solution.x, (C, 2))
+    return u[0], objective(solution.x)
+
+########################################################################
+### Controller commands ###
+########################################################################
+# Complete commands of the deployed controller nodes (also simulated by monte_carlo)
+
+# Function: control_target
+# DO: Control target: x and z from the entry point, y and orientation from the current tip
+# Inputs:
+#   tip: current tip pose [x, y, z, qw, qx, qy, qz]
+#   entry: entry point [x, y, z, ...]
+# Output:
+#   target pose [x, y, z, qw, qx, qy, qz]
+def control_target(tip, entry):
+    tip = np.ravel(tip)
+    entry = np.ravel(entry)
+    return np.concatenate(([entry[0], tip[1], entry[2]], tip[3:7]))
+
+# Function: discrete_command
+# DO: Stage command of controller_discrete: discrete control step limited to SAFE_LIMIT around the entry point
+# Inputs:
+#   tip: current tip pose [x, y, z, qw, qx, qy, qz]
+#   stage: current stage position [x, z]
+#   entry: entry point [x, y, z, ...]
+#   J: estimated Jacobian
+#   K: controller gain
+#   hold_x: keep the x command at the entry point x (only z is controlled)
+# Output:
+#   stage command [x, z], output error (target - tip outputs)
+def discrete_command(tip, stage, entry, J, K, safe_limit=SAFE_LIMIT, hold_x=True):
+    entry = np.ravel(entry)
+    err = tip_outputs(control_target(tip, entry)) - tip_outputs(np.ravel(tip))
+    cmd = limit_control(discrete_control(stage, err, J, K), entry[[0,2]], safe_limit)
+    if hold_x:
+        cmd[0] = entry[0]
+    return cmd, err
+
+# Function: mpc_command
+# DO: Stage command of controller_mpc (first step of the MPC solution towards the control target)
+# Inputs:
+#   tip: current tip pose [x, y, z, qw, qx, qy, qz]
+#   stage: current stage position [x, z]
+#   entry: entry point [x, y, z, ...]
+#   J: estimated Jacobian
+#   P, C, wu, bounds: as in mpc_control
+# Output:
+#   stage command [x, z], final cost
+def mpc_command(tip, stage, entry, J, P=10, C=3, wu=0.8, bounds=MPC_BOUNDS):
+    target = control_target(tip, entry)
+    return mpc_control(tip_outputs(np.ravel(tip)), stage, tip_outputs(target), J, P=P, C=C, wu=wu, bounds=bounds)
@@ -68,11 +68,6 @@ class Controller(Node):
         self.stage = np.array([[robot.position.x, robot.position.z]]).T
         self.depth = robot.position.y
 
-        # Check if robot reached its goal position (only after started control action)
-        if (self.cmd.size != 0):
-            if (np.linalg.norm(self.stage - self.cmd) <= 0.4):
-                self.robot_idle = True 
-
     # Get current tip pose
     def tip_callback(self, msg):
         tip = msg.pose
@@ -163,6 +158,7 @@ class Controller(Node):
         goal_handle = future.result()
         if not goal_handle.accepted:
             self.get_logger().info('Goal rejected :(')
+            self.robot_idle = True
             return
 
         # self.get_logger().info('Goal accepted :)')
@@ -170,12 +166,13 @@ class Controller(Node):
         self._get_result_future.add_done_callback(self.get_result_callback)
 
     # Get MoveStage action finish message (Result)
+    # Robot is free for a new command as soon as the motion finished
     def get_result_callback(self, future):
         result = future.result().result
         status = future.result().status
-        # if status == GoalStatus.STATUS_SUCCEEDED:
-            # self.get_logger().info('Goal succeeded! Result: {0}'.format(result.x))
-            # self.robot_idle = True
+        if status != GoalStatus.STATUS_SUCCEEDED:
+            self.get_logger().info('Goal not successful! Result: {0}'.format(result.x))
+        self.robot_idle = True
 
 def main(args=None):
     rclpy.init(args=args)
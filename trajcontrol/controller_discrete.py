@@ -10,9 +10,7 @@ from cv_bridge import CvBridge
 from sensor_msgs.msg import Image
 from stage_control_interfaces.action import MoveStage
 from std_msgs.msg import Int8
-
-SAFE_LIMIT = 5.0            # Maximum control output delta from entry point
-CONTROL_LENGTH = 50.0       # Maximum insertion depth for control input (stops robot after that point)
+from trajcontrol.control_law import SAFE_LIMIT, CONTROL_LENGTH, control_target, discrete_command
 
 class ControllerDiscrete(Node):
 
@@ -21,6 +19,7 @@ class ControllerDiscrete(Node):
 
         #Declare node parameters
         self.declare_parameter('K', -0.5) #Controller gain
+        self.declare_parameter('hold_x', True) #Keep x command at the entry point (only z is controlled)
 
         #Topics from sensor processing node
         self.subscription_entry_point = self.create_subscription(PoseStamped, '/subject/state/skin_entry', self.entry_callback, 10)
@@ -53,7 +52,7 @@ class ControllerDiscrete(Node):
         self.cmd = np.empty(shape=[2,1])                  # Control output to the robot stage
         self.robot_idle = False                      # Robot free to new command
         self.depth = 0.0                            # Current insertion depth
-        self.J = np.zeros(shape=[7,7])                      # Initial Jacobian
+        self.J = np.zeros(shape=[5,3])                      # Initial Jacobian
 
     # A keyboard hotkey was pressed
     def keyboard_callback(self, msg):
@@ -63,33 +62,22 @@ class ControllerDiscrete(Node):
         # Only send new command after hitting SPACE
         if (self.depth < CONTROL_LENGTH) and (self.robot_idle == True) and (self.entry_point.size != 0) and (msg.data == 32):
 
-            # Build Control Jacobian from estimated model Jacobian
-            Jc = np.array([self.J[:,0], self.J[:,2]]).T
-
             # Send control signal only if robot is ready and after first readings (entry point and current needle tip)
             if (self.robot_idle == True) and (self.entry_point.size != 0) and (self.tip.size != 0)  and (self.stage.size != 0):
                 # Update target (X and Z from entry point, Y and orientation from current tip)
-                self.target = np.array([[self.entry_point[0,0], self.tip[1,0], self.entry_point[2,0], \
-                                        self.tip[3,0], self.tip[4,0], self.tip[5,0], self.tip[6,0]]]).T     
+                self.target = np.array([control_target(self.tip[:,0], self.entry_point[:,0])]).T
 
-                # Control law
-                K = self.get_parameter('K').get_parameter_value().double_value  # Get K value          
-                err = self.target-self.tip                                      # Control error
-                self.cmd = self.stage + K*np.matmul(np.linalg.pinv(Jc),err)     # Calculate control output
+                # Control law (error in estimator outputs [x, y, z, yaw, pitch])
+                # Limited to SAFE_LIMIT around entry point, x kept at the entry point if hold_x (same command as monte_carlo)
+                K = self.get_parameter('K').get_parameter_value().double_value  # Get K value
+                hold_x = self.get_parameter('hold_x').get_parameter_value().bool_value
+                cmd, err = discrete_command(self.tip[:,0], self.stage[:,0], self.entry_point[:,0], self.J, K, hold_x=hold_x)
+                self.cmd = np.array([cmd]).T
+                err = np.array([err]).T
 
-                # Limit control output to SAFE_LIMIT around entry point
-                if abs(self.cmd[1,0]-self.entry_point[2,0]) > SAFE_LIMIT:
+                if abs(self.cmd[1,0]-self.entry_point[2,0]) >= SAFE_LIMIT:
                     self.get_logger().info('Reached SAFE_LIMIT for control in Z')
 
-                self.cmd[0,0] = min(self.cmd[0,0], self.entry_point[0,0]+SAFE_LIMIT)
-                self.cmd[1,0] = min(self.cmd[1,0], self.entry_point[2,0]+SAFE_LIMIT)
-                self.cmd[0,0] = max(self.cmd[0,0], self.entry_point[0,0]-SAFE_LIMIT)
-                self.cmd[1,0] = max(self.cmd[1,0], self.entry_point[2,0]-SAFE_LIMIT)
-
-                # # WARNING JUST FOR TEST!!! - DELETE AFTER
-                self.cmd[0,0] = 0.0 + self.entry_point[0,0]
-                #self.cmd[1,0] = 0.0 + self.entry_point[2,0]
-
                 # Send command to stage
                 self.send_cmd(float(self.cmd[0,0]), float(self.cmd[1,0]))
                 self.robot_idle = False
@@ -120,12 +108,6 @@ class ControllerDiscrete(Node):
         if (self.depth > CONTROL_LENGTH):
             self.get_logger().info('Reached maximum insertion lenght for control')
 
-        # Check if robot reached its goal position (after cmd starts)
-        elif (self.robot_idle == False) and (self.cmd.size != 0):
-            if (np.linalg.norm(self.stage - self.cmd) <= 0.4):
-                self.robot_idle = True 
-                self.get_logger().info('Please, make a small insertion step and hit SPACE')
-
     # Get current tip pose
     def tip_callback(self, msg):
         tip = msg.pose
@@ -170,6 +152,7 @@ class ControllerDiscrete(Node):
         goal_handle = future.result()
         if not goal_handle.accepted:
             self.get_logger().info('Goal rejected :(')
+            self.robot_idle = True
             return
         self._get_result_future = goal_handle.get_result_async()
         self._get_result_future.add_done_callback(self.get_result_callback)
@@ -180,6 +163,9 @@ class ControllerDiscrete(Node):
         status = future.result().status
         if status != GoalStatus.STATUS_SUCCEEDED:
             self.get_logger().info('Goal not successful! Result: {0}'.format(result.x))
+        # Robot reached its goal position (or stopped): ready for next step
+        self.robot_idle = True
+        self.get_logger().info('Please, make a small insertion step and hit SPACE')
 
 def main(args=None):
     # Create controller_discrete node
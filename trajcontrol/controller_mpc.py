@@ -10,7 +10,7 @@ from geometry_msgs.msg import PoseStamped, PointStamped
 from cv_bridge import CvBridge
 from sensor_msgs.msg import Image
 from stage_control_interfaces.action import MoveStage
-from scipy.optimize import minimize
+from trajcontrol.control_law import control_target, mpc_command
 
 
 class ControllerMPC(Node):
@@ -21,6 +21,11 @@ class ControllerMPC(Node):
         #Declare node parameters
         self.declare_parameter('P', 10) #Prediction Horizon
         self.declare_parameter('C', 3)  #Control Horizon
+        self.declare_parameter('wu', 0.8) #Weight of control input changes
+
+        self.P = self.get_parameter('P').get_parameter_value().integer_value
+        self.C = self.get_parameter('C').get_parameter_value().integer_value
+        self.wu = self.get_parameter('wu').get_parameter_value().double_value
 
         #Topics from sensor processing node
         self.subscription_entry_point = self.create_subscription(PoseStamped, '/subject/state/skin_entry', self.entry_callback, 10)
@@ -42,7 +47,7 @@ class ControllerMPC(Node):
         self.action_client = ActionClient(self, MoveStage, '/move_stage')
 
         # Stored values
-        self.J = np.zeros(shape=[7,2])              # Simplified Jacobian matrix
+        self.J = np.zeros(shape=[5,3])              # Estimated Jacobian matrix
 
         self.tip = np.empty(shape=[7,0])            # Current needle tip pose
         self.stage = np.empty(shape=[2,0])          # Current stage pose
@@ -80,74 +85,21 @@ class ControllerMPC(Node):
 
     # Get current Jacobian matrix from Estimator node
     def jacobian_callback(self, msg):
-        J = np.asarray(CvBridge().imgmsg_to_cv2(msg))
-        self.J = np.array([J[:,0],J[:,2]]).T
+        self.J = np.asarray(CvBridge().imgmsg_to_cv2(msg))
        
         # Send control signal only if robot is ready and after first readings (entry point and current needle tip)
-        if (self.robot_idle == True) and (self.entry_point.size != 0) and (self.tip.size != 0):
-            target = np.array([[self.entry_point[0,0], self.tip[1,0], self.entry_point[2,0], \
-                                self.tip[3,0], self.tip[4,0], self.tip[5,0], self.tip[6,0]]]).T
-
-            # MPC Initialization
-            u_hat = np.zeros((2,C))                                             # Initial control guess (vector with C size)
-
-            ################################################################
-            ## TODO: Calculate or receive delta_t for each control step   ##
-            ################################################################
-            delta_t = (self.curr_time.nanosec - self.prev_time.nanosec)*1e9     # Temporary delta_t
-
-########################################################################
-            ## MPC Functions
-########################################################################
-            # Define process model
-            def process_model(y0, u0, u, delta_t, J):
-                y = np.zeros((7,1))
-                delta_u = (u-u0)/delta_t
-                y = y0 + np.matmul(J,delta_u)
-                return y
-
-            # Define objective function
-            def objective(u_hat):
-
-                # Reshape u_hat (minimize flattens it)
-                u_hat = np.reshape(u_hat,(2,C))
-                u_hat = np.hstack((u_hat, np.repeat(u_hat[:,[C-1]], P-C, axis=1)))
-                y_hat = np.zeros((7,P))
-
-                # Initialize prediction
-                y_hat0 = self.tip
-                u_hat0 = self.stage
-
-                # Simulate prediction horizon
-                for k in range(0,P):
-                    yp = process_model(y_hat0, u_hat0, u_hat[:,[k]], delta_t, self.J)
-                    # Save predicted variable
-                    y_hat[:,[k]] = yp
-                    # Update initial condition for next prediction step
-                    y_hat0 = y_hat[:,[k]]
-                    u_hat0 = u_hat[:,[k]]
-
-                # Cost function calculation
-                wu = 0.8
-                obj = np.linalg.norm(target-y_hat) + wu*np.linalg.norm(np.diff(u_hat))
-                return obj 
-########################################################################
-
-            # Initial objective
-            self.get_logger().info('Initial SSE Objective: %f' % (objective(u_hat)))  # calculate cost function with initial guess
-
-            # MPC calculation
+        if (self.robot_idle == True) and (self.entry_point.size != 0) and (self.tip.size != 0) and (self.stage.size != 0):
+            target = np.array([control_target(self.tip[:,0], self.entry_point[:,0])]).T
+
+            # MPC calculation (prediction in estimator outputs [x, y, z, yaw, pitch], same command as monte_carlo)
             start_time = time.time()
-            solution = minimize(objective,u_hat,method='SLSQP', bounds=[(-10, 10) for i in range(0,2*C)]) # optimizes the objective function
-            u = np.reshape(solution.x,(2,C))           # reshape solution (minimize flattens it)
+            u, cost = mpc_command(self.tip[:,0], self.stage[:,0], self.entry_point[:,0], self.J, P=self.P, C=self.C, wu=self.wu)
             end_time = time.time()
-            
-            cost = objective(u)
-            self.get_logger().info('Final SSE Objective: %f' % (objective(u))) # calculate cost function with optimization result
+            self.get_logger().info('Final SSE Objective: %f' % (cost))
             self.get_logger().info('Elapsed time: %f' % (end_time-start_time))
                 
             # Update controller output
-            self.cmd = u
+            self.cmd = np.array([u]).T
 
             # Send command to stage
             # Subtract the entry point because robot considers initial position to be (0,0)
@@ -187,6 +139,7 @@ class ControllerMPC(Node):
         goal_handle = future.result()
         if not goal_handle.accepted:
             self.get_logger().info('Goal rejected :(')
+            self.robot_idle = True
             return
 
         # self.get_logger().info('Goal accepted :)')
@@ -199,18 +152,16 @@ class ControllerMPC(Node):
         status = future.result().status
         if status == GoalStatus.STATUS_SUCCEEDED:
             self.get_logger().info('Goal succeeded! Result: {0}'.format(result.x))
-            self.robot_idle = True
+        else:
+            self.get_logger().info('Goal not successful (status %d)! Result: %s' % (status, result.x))
+        # Robot reached its goal position (or stopped: aborted / canceled): ready for next command
+        self.robot_idle = True
 
 def main(args=None):
     rclpy.init(args=args)
 
     controller_mpc = ControllerMPC()
 
-    global P
-    global C
-    P = controller_mpc.get_parameter('P').get_parameter_value().integer_value
-    C = controller_mpc.get_parameter('C').get_parameter_value().integer_value
-
     rclpy.spin(controller_mpc)
 
     # Destroy the node explicitly
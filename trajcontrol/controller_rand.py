@@ -17,6 +17,9 @@ class ControllerRand(Node):
     def __init__(self):
         super().__init__('controller_rand')
 
+        #Declare node parameters
+        self.declare_parameter('seed', -1)  #Random seed (-1 = random)
+
         #Topics from sensor processing node
         self.subscription_entry_point = self.create_subscription(PoseStamped, '/subject/state/skin_entry', self.entry_callback, 10)
         self.subscription_entry_point  # prevent unused variable warning
@@ -42,6 +45,8 @@ class ControllerRand(Node):
         self.robot_idle = True                     # Robot free to new command
         self.entry_depth = 0.0
         self.depth = 0.0
+        seed = self.get_parameter('seed').get_parameter_value().integer_value
+        self.rng = np.random.default_rng(None if seed < 0 else seed)    # Random stage targets
    
     # Save entry point (only once)
     def entry_callback(self, msg):
@@ -64,17 +69,13 @@ class ControllerRand(Node):
             if (self.depth >= (self.entry_depth+FINAL_LENGTH)):
                 self.get_logger().info('Depth: y=%f' % (self.depth))
                 self.robot_idle = False
-            # Check if robot reached its goal position
-            elif (np.linalg.norm(self.stage - self.cmd) <= 0.25):
-                self.robot_idle = True 
-                self.get_logger().info('Reached control target')
 
     # Move robot to new random position
     def timer_move_robot(self):
         # Send control signal only if robot is ready and after getting entry point (SPACE was hit by user)
         if (self.robot_idle == True) and (self.entry_point.size != 0):
 
-            new_rand = np.random.uniform(-2, 2, (2,1))
+            new_rand = self.rng.uniform(-2, 2, (2,1))
             new_rand[1] = min(new_rand[1], 1.0)
             new_rand[1] = max(new_rand[1],-1.0)
 
@@ -116,6 +117,7 @@ class ControllerRand(Node):
         goal_handle = future.result()
         if not goal_handle.accepted:
             self.get_logger().info('Goal rejected :(')
+            self.robot_idle = True
             return
 
         # self.get_logger().info('Goal accepted :)')
@@ -126,9 +128,11 @@ class ControllerRand(Node):
     def get_result_callback(self, future):
         result = future.result().result
         status = future.result().status
-        # if status == GoalStatus.STATUS_SUCCEEDED:
-        #     self.get_logger().info('Goal succeeded! Result: {0}'.format(result.x))
-        #     self.robot_idle = True
+        if status == GoalStatus.STATUS_SUCCEEDED:
+            self.get_logger().info('Reached control target')
+        # Robot is free for a new command unless max depth reached
+        if (self.depth < (self.entry_depth+FINAL_LENGTH)):
+            self.robot_idle = True
 
 def main(args=None):
     rclpy.init(args=args)
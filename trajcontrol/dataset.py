@@ -0,0 +1,203 @@
+import os
+import glob
+import json
+import argparse
+import numpy as np
+
+from scipy.io import loadmat
+
+try:
+    from ament_index_python.packages import get_package_share_directory, PackageNotFoundError   # Optional (installed package)
+except ImportError:
+    get_package_share_directory = None
+
+PACKAGE = 'trajcontrol'
+EXTENSION = '.mat'
+MANIFEST = 'manifest.json'
+CACHE_VERSION = 1           # Increase when the cache layout changes (rebuilds every cache)
+
+########################################################################
+### Dataset files ###
+########################################################################
+
+# Function: search_folders
+# DO: Folders searched for datasets, in order: package share directory (installed files), workspace source
+#     (src/trajcontrol/files, where nodes used to look) and the source tree of this module
+def search_folders():
+    folders = []
+    if get_package_share_directory is not None:
+        try:
+            folders.append(os.path.join(get_package_share_directory(PACKAGE), 'files'))
+        except (PackageNotFoundError, ValueError):
+            pass
+    folders.append(os.path.join(os.getcwd(), 'src', PACKAGE, 'files'))
+    folders.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files'))
+    return folders
+
+# Function: dataset_path
+# DO: Resolve a dataset name ('fbg_10') or path to its .mat file
+def dataset_path(name):
+    if os.path.isfile(name):
+        return os.path.abspath(name)
+    filename = name if name.endswith(EXTENSION) else name + EXTENSION
+    for folder in search_folders():
+        path = os.path.join(folder, filename)
+        if os.path.isfile(path):
+            return path
+    raise ValueError('Dataset %s not found in %s' % (name, ', '.join(search_folders())))
+
+# Function: cache_folder
+# DO: Cache directory of a dataset (XDG cache, one folder per dataset name)
+def cache_folder(path, root=None):
+    if root is None:
+        root = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), PACKAGE)
+    return os.path.join(root, os.path.splitext(os.path.basename(path))[0])
+
+# Function: source_key
+# DO: Identity of a .mat file for cache validation (size and modification time)
+def source_key(path):
+    stat = os.stat(path)
+    return {'version': CACHE_VERSION, 'source': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+########################################################################
+### Conversion ###
+########################################################################
+
+# Function: convert
+# DO: Convert the cell arrays of a .mat trial into contiguous float arrays saved as .npy files
+#     Cells with the same shape in every sample are stacked (needle_pose: Nx7, time_stamp: N)
+#     Cells with a varying number of columns are stored as rows (sensor: points x 3) with sample offsets
+# Inputs:
+#   path: .mat file
+#   folder: cache directory
+# Output:
+#   manifest (dictionary, also written to folder/manifest.json)
+def convert(path, folder):
+    os.makedirs(folder, exist_ok=True)
+    trial_data = loadmat(path, mat_dtype=True)
+    manifest = dict(source_key(path), variables={})
+    for name, cells in trial_data.items():
+        if name.startswith('__') or not isinstance(cells, np.ndarray) or cells.dtype != object:
+            continue
+        cells = [np.asarray(cell, dtype=float) for cell in cells.ravel()]
+        shapes = set(cell.shape for cell in cells)
+        if len(shapes) == 1:
+            shape = tuple(n for n in cells[0].shape if n != 1)      # (7, 1) -> (7,), (1, 1) -> ()
+            values = np.stack([cell.reshape(shape) for cell in cells]) if cells else np.empty((0,))
+            manifest['variables'][name] = {'ragged': False}
+        else:
+            values = np.concatenate([cell.T for cell in cells])      # One row per column of each cell
+            offsets = np.concatenate(([0], np.cumsum([cell.shape[1] for cell in cells]))).astype(np.int64)
+            save_array(os.path.join(folder, name + '_offsets.npy'), offsets)
+            manifest['variables'][name] = {'ragged': True}
+        save_array(os.path.join(folder, name + '.npy'), np.ascontiguousarray(values))
+        manifest['variables'][name]['shape'] = list(values.shape)
+        manifest['samples'] = len(cells)
+
+    # Manifest last: a cache without it (interrupted conversion) is rebuilt
+    temporary = os.path.join(folder, MANIFEST + '.%d.tmp' % (os.getpid()))
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary, os.path.join(folder, MANIFEST))
+    return manifest
+
+# Function: save_array
+# DO: Write a .npy file atomically (nodes starting together may convert the same dataset)
+def save_array(filename, values):
+    temporary = filename + '.%d.tmp' % (os.getpid())
+    with open(temporary, 'wb') as f:
+        np.save(f, values)
+    os.replace(temporary, filename)
+
+# Function: cached_manifest
+# DO: Manifest of a valid cache of path (None when missing or stale)
+def cached_manifest(path, folder):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    key = source_key(path)
+    return manifest if all(manifest.get(k) == v for k, v in key.items()) else None
+
+########################################################################
+### Dataset ###
+########################################################################
+
+# Class: Dataset
+# DO: Read-only memory mapped view of a converted trial (nodes using the same dataset share the pages)
+#     arrays[name]: stacked values (N x ...) or rows of ragged cells, offsets[name]: rows of sample i are offsets[i]:offsets[i+1]
+class Dataset():
+
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.samples = manifest.get('samples', 0)
+        self.arrays = {}
+        self.offsets = {}
+        for name, info in manifest['variables'].items():
+            self.arrays[name] = np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+            if info['ragged']:
+                self.offsets[name] = np.load(os.path.join(folder, name + '_offsets.npy'))
+
+    def __len__(self):
+        return self.samples
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    # Function: sample
+    # DO: Value of sample i (view: row of a stacked variable or rows of a ragged cell, e.g. sensor points x 3)
+    def sample(self, name, i):
+        if name in self.offsets:
+            return self.arrays[name][self.offsets[name][i]:self.offsets[name][i+1]]
+        return self.arrays[name][i]
+
+    # Function: last
+    # DO: Last row of every sample of a ragged variable (e.g. needle tip of each sensor shape, N x 3)
+    def last(self, name):
+        return self.arrays[name][self.offsets[name][1:] - 1]
+
+# Function: load
+# DO: Open a dataset, converting it on first use or when the .mat file changed
+# Inputs:
+#   name: dataset name ('fbg_10') or .mat path
+#   cache: cache root (None = ~/.cache/trajcontrol)
+# Output:
+#   Dataset
+def load(name, cache=None):
+    path = dataset_path(name)
+    folder = cache_folder(path, cache)
+    manifest = cached_manifest(path, folder)
+    if manifest is None:
+        manifest = convert(path, folder)
+    return Dataset(folder, manifest)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert .mat datasets to memory mapped .npy caches')
+    parser.add_argument('datasets', nargs='*', help='dataset names or .mat files (default: every dataset found)')
+    parser.add_argument('--cache', default=None, help='cache root (default: ~/.cache/trajcontrol)')
+    parser.add_argument('--force', action='store_true', help='convert even when the cache is valid')
+    options = parser.parse_args(args)
+
+    names = options.datasets
+    if not names:
+        found = {}
+        for folder in reversed(search_folders()):
+            for path in glob.glob(os.path.join(folder, '*' + EXTENSION)):
+                found[os.path.basename(path)] = path        # Earlier folders take precedence
+        names = sorted(found.values())
+    for name in names:
+        try:
+            path = dataset_path(name)
+        except ValueError as e:
+            print(e)
+            continue
+        folder = cache_folder(path, options.cache)
+        manifest = None if options.force else cached_manifest(path, folder)
+        if manifest is None:
+            manifest = convert(path, folder)
+        print('%s: %d samples -> %s (%s)' % (os.path.basename(path), manifest.get('samples', 0), folder, \
+            ', '.join('%s %s' % (variable, 'x'.join(str(n) for n in info['shape'])) for variable, info in manifest['variables'].items())))
+
+if __name__ == '__main__':
+    main()
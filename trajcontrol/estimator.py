@@ -1,5 +1,4 @@
 import rclpy
-import math
 import numpy as np
 
 from rclpy.node import Node
@@ -7,6 +6,8 @@ from geometry_msgs.msg import PoseStamped
 from sensor_msgs.msg import Image
 from cv_bridge import CvBridge
 from cv_bridge.core import CvBridge
+from trajcontrol.control_law import J_INITIAL, tip_outputs, jacobian_update
+from trajcontrol.sim_clock import StepAck
 
 class Estimator(Node):
 
@@ -24,7 +25,8 @@ class Estimator(Node):
 
         #Published topics
         timer_period = 0.3  # seconds
-        self.timer = self.create_timer(timer_period, self.timer_jacobian_callback)
+        self.step_ack = StepAck(self)
+        self.timer = self.step_ack.create_timer(timer_period, self.timer_jacobian_callback)
         self.publisher_jacobian = self.create_publisher(Image, '/needle/state/jacobian', 10)
         
         # Print numpy floats with only 3 decimal places
@@ -32,11 +34,7 @@ class Estimator(Node):
 
         # Initialize Jacobian with estimated values from previous experiments
         # (Alternative: initialize with values from first two sets of sensor and robot data)
-        self.J = np.array([(0.9906,-0.1395,-0.5254),
-                    ( 0.0588, 1.7334,-0.1336),
-                    (-0.3769, 0.1906, 0.2970),
-                    ( 0.0004,-0.0005, 0.0015),
-                    ( 0.0058,-0.0028,-0.0015)])
+        self.J = J_INITIAL.copy()
         self.Z = np.empty(shape=[5,0])                  # Current needle tip pose Z = [x_tip, y_tip, z_tip, yaw, pitch] 
         self.X = np.empty(shape=[3,0])                  # Current needle base pose X = [x_robot, y_needle_depth, z_robot]
         self.Xant = np.empty(shape=[3,0])               # Previous X = [x_robot, y_needle_depth, z_robot]
@@ -58,11 +56,11 @@ class Estimator(Node):
     # Z = [x_tip, y_tip, z_tip, yaw, pitch]  
     def sensor_callback(self, msg_sensor):
         # Get filtered sensor in robot frame   
-        quat = np.array([[msg_sensor.pose.orientation.w, msg_sensor.pose.orientation.x, msg_sensor.pose.orientation.y, msg_sensor.pose.orientation.z]]).T
-        angles = quat2ypr(quat)
+        tip = msg_sensor.pose
         self.Zant = self.Z
         self.TZant = self.TZ
-        self.Z = np.array([[msg_sensor.pose.position.x, msg_sensor.pose.position.y, msg_sensor.pose.position.z, angles[0], angles[1]]]).T
+        self.Z = np.array([tip_outputs([tip.position.x, tip.position.y, tip.position.z, \
+                    tip.orientation.w, tip.orientation.x, tip.orientation.y, tip.orientation.z])]).T
         self.TZ = msg_sensor.header.stamp
 
     # needle_pose from robot node
@@ -90,44 +88,9 @@ class Estimator(Node):
 
             # Update Jacobian
             alpha = self.get_parameter('alpha').get_parameter_value().double_value
-            self.J = self.J + alpha*np.outer((deltaZ-np.matmul(self.J, deltaX))/(np.matmul(np.transpose(deltaX), deltaX)+1e-9), deltaX)
+            self.J = jacobian_update(self.J, deltaX, deltaZ, alpha)
 
 
-########################################################################
-### Auxiliar functions ###
-########################################################################
-
-# Function: quat2ypr
-# DO: Transform quaternion representation to yaw-pitch-roll (Tait-Bryan Z-Y'-X'')
-# Inputs: 
-#   q: quaternion (numpy array [qw, qx, qy, qz])
-# Output:
-#   angles: angle vector (numpy array [yaw, pitch, roll])
-
-def quat2ypr(q):
-
-    angles = np.empty(shape=[3,0]) 
-
-    # yaw (z-axis rotation) [-pi, pi]
-    siny_cosp = 2 * (q[0] * q[3] + q[1] * q[2])
-    cosy_cosp = 1 - 2 * (q[2] * q[2] + q[3] * q[3])
-    angles[0] = math.atan2(siny_cosp, cosy_cosp)
-
-    # pitch (y-axis rotation) [-pi/2, pi/2]
-    sinp = 2 * (q[0] * q[2] - q[3] * q[1])
-    if (math.abs(sinp) >= 1):
-        angles[1] = math.copysign(math.pi / 2, sinp); # use 90 degrees if out of range
-    else:
-        angles[1] = math.asin(sinp)
-
-    # roll (x-axis rotation) [-pi, pi]
-    sinr_cosp = 2 * (q[0] * q[1] + q[2] * q[3])
-    cosr_cosp = 1 - 2 * (q[1] * q[1] + q[2] * q[2])
-    angles[2] = math.atan2(sinr_cosp, cosr_cosp)
-
-    
-    return angles
-
 ########################################################################
 def main(args=None):
     rclpy.init(args=args)
@@ -0,0 +1,125 @@
+import heapq
+import rclpy
+
+from rclpy.node import Node
+from rosidl_runtime_py.utilities import get_message
+from trajcontrol.fault_model import FaultModel
+
+# Class: FaultInjector
+# DO: Relay between a publisher and its subscribers that injects link faults (FaultModel)
+#     Messages are relayed serialized (any message type) from 'input' to 'output'.
+#     Remap the subscribers (or the publisher) so that the relay sits in the middle, e.g.
+#       publisher -> IGTL_TRANSFORM_IN_raw -> fault_injector -> IGTL_TRANSFORM_IN -> sensor_processing
+#     Times follow the node clock (simulated time with use_sim_time)
+class FaultInjector(Node):
+
+    def __init__(self):
+        super().__init__('fault_injector')
+
+        #Declare node parameters
+        self.declare_parameter('input', 'IGTL_TRANSFORM_IN_raw')   #Relayed topic
+        self.declare_parameter('output', 'IGTL_TRANSFORM_IN')      #Republished topic
+        self.declare_parameter('type', '')                  #Message type (e.g. ros2_igtl_bridge/msg/Transform, empty = from graph)
+        self.declare_parameter('delay', 0.0)                #Mean delay (s)
+        self.declare_parameter('delay_model', 'fixed')      #Delay distribution: fixed / uniform / normal / exponential / lognormal
+        self.declare_parameter('delay_spread', 0.0)         #Delay width (s, log std for lognormal)
+        self.declare_parameter('drop', 0.0)                 #Probability of dropping a message
+        self.declare_parameter('burst_rate', 0.0)           #Probability of a loss burst starting at each message
+        self.declare_parameter('burst_length', 10.0)        #Mean loss burst length (messages)
+        self.declare_parameter('duplicate', 0.0)            #Probability of sending a message twice
+        self.declare_parameter('reorder', 0.0)              #Probability of holding a message back (later ones overtake it)
+        self.declare_parameter('reorder_delay', 0.1)        #Extra delay of held back messages (s)
+        self.declare_parameter('keep_order', True)          #FIFO link apart from held back messages
+        self.declare_parameter('seed', -1)                  #Random seed (-1 = random)
+        self.declare_parameter('resolution', 0.001)         #Release timer period (s)
+        self.declare_parameter('report_period', 10.0)       #Statistics report period (s, 0 = only at shutdown)
+
+        seed = self.get_parameter('seed').get_parameter_value().integer_value
+        self.faults = FaultModel(delay=self.get_parameter('delay').get_parameter_value().double_value, \
+            delay_model=self.get_parameter('delay_model').get_parameter_value().string_value, \
+            spread=self.get_parameter('delay_spread').get_parameter_value().double_value, \
+            drop=self.get_parameter('drop').get_parameter_value().double_value, \
+            burst_rate=self.get_parameter('burst_rate').get_parameter_value().double_value, \
+            burst_length=self.get_parameter('burst_length').get_parameter_value().double_value, \
+            duplicate=self.get_parameter('duplicate').get_parameter_value().double_value, \
+            reorder=self.get_parameter('reorder').get_parameter_value().double_value, \
+            reorder_delay=self.get_parameter('reorder_delay').get_parameter_value().double_value, \
+            keep_order=self.get_parameter('keep_order').get_parameter_value().bool_value, \
+            seed=None if seed < 0 else seed)
+        self.input = self.get_parameter('input').get_parameter_value().string_value
+        self.output = self.get_parameter('output').get_parameter_value().string_value
+
+        # Relay created when the message type is known
+        self.subscription = None
+        self.publisher = None
+        self.queue = []             # Pending messages (release time in ns, sequence, serialized message)
+        self.sequence = 0
+        self.published = 0
+        msg_type = self.get_parameter('type').get_parameter_value().string_value
+        if msg_type:
+            self.create_relay(msg_type)
+        else:
+            self.timer_discovery = self.create_timer(0.5, self.timer_discovery_callback)
+
+        self.timer_release = self.create_timer(self.get_parameter('resolution').get_parameter_value().double_value, self.timer_release_callback)
+        report_period = self.get_parameter('report_period').get_parameter_value().double_value
+        if report_period > 0:
+            self.timer_report = self.create_timer(report_period, self.report)
+
+    # Wait for the input topic to appear and take its type
+    def timer_discovery_callback(self):
+        for name, types in self.get_topic_names_and_types():
+            if (name.lstrip('/') == self.input.lstrip('/')) and types:
+                self.timer_discovery.cancel()
+                self.create_relay(types[0])
+                return
+
+    def create_relay(self, msg_type):
+        msg_class = get_message(msg_type)
+        self.publisher = self.create_publisher(msg_class, self.output, 10)
+        self.subscription = self.create_subscription(msg_class, self.input, self.input_callback, 10, raw=True)
+        self.get_logger().info('Relaying %s -> %s (%s)' % (self.input, self.output, msg_type))
+
+    # Schedule the copies of a received message
+    def input_callback(self, msg):
+        now = self.get_clock().now().nanoseconds
+        for release in self.faults.schedule(now*1e-9):
+            heapq.heappush(self.queue, (int(release*1e9), self.sequence, msg))
+            self.sequence += 1
+
+    # Publish the messages due
+    def timer_release_callback(self):
+        now = self.get_clock().now().nanoseconds
+        while self.queue and self.queue[0][0] <= now:
+            _, _, msg = heapq.heappop(self.queue)
+            self.publisher.publish(msg)
+            self.published += 1
+
+    # Log link statistics
+    def report(self):
+        stats = self.faults.summary()
+        self.get_logger().info('%s: received %d, published %d, pending %d, dropped %d (+%d in bursts), duplicated %d, reordered %d, ' \
+            'delay mean %.1f ms, p50 %.1f ms, p95 %.1f ms, max %.1f ms' % (self.output, stats['received'], self.published, len(self.queue), \
+            stats['dropped'], stats['burst_dropped'], stats['duplicated'], stats['reordered'], \
+            stats['delay_mean']*1e3, stats['delay_p50']*1e3, stats['delay_p95']*1e3, stats['delay_max']*1e3))
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    fault_injector = FaultInjector()
+
+    try:
+        rclpy.spin(fault_injector)
+    except KeyboardInterrupt:
+        pass
+    fault_injector.report()
+
+    # Destroy the node explicitly
+    # (optional - otherwise it will be done automatically
+    # when the garbage collector destroys the node object)
+    fault_injector.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+
+from collections import deque
+
+DELAY_MODELS = ('fixed', 'uniform', 'normal', 'exponential', 'lognormal')
+DELAY_HISTORY = 10000           # Last delays kept for the statistics
+
+########################################################################
+### Fault model ###
+########################################################################
+
+# Class: FaultModel
+# DO: Random faults of a message link (seeded): delay, drops, loss bursts, duplicates and reordering
+#     schedule() is called once per received message and returns the release times of its copies
+#     Delay models (mean 'delay', width 'spread', seconds):
+#       fixed: delay / uniform: delay +- spread / normal: std spread / exponential: delay + exponential(spread)
+#       lognormal: median delay, log std spread
+#     Loss bursts follow a two-state (Gilbert) model: a burst starts with probability burst_rate and
+#     drops every message until it ends (mean burst_length messages)
+#     With keep_order the link is FIFO (a message never overtakes an earlier one) except for messages
+#     picked for reordering, which get reorder_delay extra delay and may be overtaken
+class FaultModel():
+
+    def __init__(self, delay=0.0, delay_model='fixed', spread=0.0, drop=0.0, burst_rate=0.0, burst_length=1.0, \
+            duplicate=0.0, reorder=0.0, reorder_delay=0.0, keep_order=True, seed=None):
+        if delay_model not in DELAY_MODELS:
+            raise ValueError('Unknown delay model %s (%s)' % (delay_model, ', '.join(DELAY_MODELS)))
+        self.delay = delay
+        self.delay_model = delay_model
+        self.spread = spread
+        self.drop = drop
+        self.burst_rate = burst_rate
+        self.burst_length = max(burst_length, 1.0)
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.keep_order = keep_order
+        self.rng = np.random.default_rng(seed)
+
+        # State
+        self.burst = False              # Inside a loss burst
+        self.last_release = -np.inf     # Latest release time of the FIFO messages
+        self.max_release = -np.inf      # Latest release time of any message (reordering count)
+        self.counts = dict.fromkeys(['received', 'scheduled', 'dropped', 'burst_dropped', 'duplicated', 'reordered'], 0)
+        self.delays = deque(maxlen=DELAY_HISTORY)
+
+    # Function: draw_delay
+    # DO: One delay of the delay model (s, never negative)
+    def draw_delay(self):
+        if self.delay_model == 'uniform':
+            delay = self.delay + self.rng.uniform(-self.spread, self.spread)
+        elif self.delay_model == 'normal':
+            delay = self.delay + self.rng.normal()*self.spread
+        elif self.delay_model == 'exponential':
+            delay = self.delay + self.rng.exponential(self.spread) if self.spread > 0 else self.delay
+        elif self.delay_model == 'lognormal':
+            delay = self.delay*np.exp(self.rng.normal()*self.spread)
+        else:
+            delay = self.delay
+        return max(delay, 0.0)
+
+    # Function: schedule
+    # DO: Faults of one message received at time now (s)
+    # Output:
+    #   release times of the message copies (empty list = dropped, two entries = duplicated)
+    def schedule(self, now):
+        self.counts['received'] += 1
+
+        # Loss bursts and independent drops
+        if self.burst:
+            self.burst = self.rng.random() >= 1.0/self.burst_length
+        elif self.burst_rate > 0:
+            self.burst = self.rng.random() < self.burst_rate
+        if self.burst:
+            self.counts['burst_dropped'] += 1
+            return []
+        if self.rng.random() < self.drop:
+            self.counts['dropped'] += 1
+            return []
+
+        copies = 2 if self.rng.random() < self.duplicate else 1
+        if copies == 2:
+            self.counts['duplicated'] += 1
+        releases = []
+        for _ in range(copies):
+            release = now + self.draw_delay()
+            if self.rng.random() < self.reorder:
+                release += self.reorder_delay
+            elif self.keep_order:
+                release = max(release, self.last_release)
+                self.last_release = release
+            if release < self.max_release:
+                self.counts['reordered'] += 1
+            self.max_release = max(self.max_release, release)
+            self.delays.append(release - now)
+            releases.append(release)
+        self.counts['scheduled'] += len(releases)
+        return releases
+
+    # Function: summary
+    # DO: Message counts and delay statistics (s) of the last DELAY_HISTORY copies
+    def summary(self):
+        stats = dict(self.counts)
+        delays = np.array(self.delays)
+        for key, value in (('delay_mean', np.mean), ('delay_p50', np.median), ('delay_p95', lambda d: np.percentile(d, 95)), ('delay_max', np.max)):
+            stats[key] = float(value(delays)) if delays.size > 0 else float('nan')
+        return stats
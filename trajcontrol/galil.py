@@ -0,0 +1,438 @@
+import re
+import glob
+import struct
+import threading
+import time
+import serial
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from serial.tools import list_ports
+
+# Galil DMC binary data record (DR/QR output)
+# Header: 4 bytes (byte 0 always has bit 7 set, bytes 2-3 hold the record size in bytes, little-endian)
+# General block: starts with the sample number (UW)
+# Axis block: status (UW), switches (UB), stop code (UB), reference position (SL), motor position (SL), ...
+RECORD_HEADER_SIZE = 4
+RECORD_SAMPLE_OFFSET = 4
+AXIS_MOTOR_POSITION_OFFSET = 8
+SAMPLE_COUNTER_WRAP = 65536
+
+SERIAL_BITS_PER_BYTE = 10       # Start + 8 data + stop bits
+RECORD_LINK_USE = 0.9           # Usable share of the serial line for data records (~46 Hz for 226 byte records at 115200 baud)
+RATE_WINDOW = 100               # Records used for the measured record rate
+
+FIRST_BINARY_BYTE = re.compile(rb'[\x80-\xff]')
+RESPONSE_END = re.compile(rb'[:?]')
+
+AXES = 'ABCDEFGH'
+
+LEGACY_PORTS = ['/dev/ttyUSB1', '/dev/ttyUSB2', '/dev/ttyUSB3']     # Previous fixed probing order
+EXCLUDED_PORTS = ['/dev/ttyUSB0']       # Aurora tracker port (files/PlusDeviceSet_Server_NDIAurora_2Needles.xml), never probed
+
+########################################################################
+### Command building ###
+########################################################################
+
+# Function: axes_command
+# DO: Build a coordinated multi-axis command
+# Inputs:
+#   cmd: Galil command (e.g. 'PA', 'PR', 'SP')
+#   values: one value per axis starting at axis A (None leaves the axis unchanged)
+# Output:
+#   command string (e.g. 'PA 100,-200')
+def axes_command(cmd, values):
+    return '%s %s' % (cmd, ','.join('' if v is None else '%d' % (int(v)) for v in values))
+
+# Function: axes_list
+# DO: Build a command that takes a list of axes (e.g. 'BG AB', 'ST AB')
+def axes_list(cmd, n_axes):
+    return '%s %s' % (cmd, AXES[0:n_axes])
+
+########################################################################
+
+# Class: GalilError
+# DO: Controller answered '?' to a command
+class GalilError(Exception):
+
+    def __init__(self, command, response=''):
+        super().__init__('Galil rejected "%s" %s' % (command, response))
+        self.command = command
+        self.response = response
+
+########################################################################
+
+# Class: GalilPort
+# DO: Send a batch of commands in a single serial write and wait for one acknowledgement per command
+#     (':' accepted / '?' rejected) instead of sleeping between writes
+#     While a DataRecordReader owns the port, its ASCII text must be forwarded to on_text
+class GalilPort():
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.streaming = False                  # True while a reader thread owns the serial input
+        self.lock = threading.Lock()            # One transaction at a time
+        self.received = bytearray()             # ASCII text forwarded by the reader thread
+        self.text_ready = threading.Condition()
+
+    # ASCII text from reader thread
+    def on_text(self, text):
+        with self.text_ready:
+            self.received += text
+            self.text_ready.notify_all()
+
+    # Send commands (list of strings without terminator) in one write
+    # Returns list of responses (text before each acknowledgement)
+    def send(self, commands, timeout=1.0):
+        if isinstance(commands, str):
+            commands = [commands]
+        with self.lock:
+            if self.ser is None:
+                raise ConnectionError('Galil not connected')
+            if not self.streaming:
+                self.ser.reset_input_buffer()
+            else:
+                with self.text_ready:
+                    self.received.clear()
+            self.ser.write(str.encode(';'.join(commands) + ';'))
+            return self.read_responses(commands, time.monotonic() + timeout)
+
+    # Send a single query command and return its answer as string
+    def query(self, command, timeout=1.0):
+        return self.send([command], timeout)[0].decode().strip()
+
+    # Wait for one acknowledgement per command
+    def read_responses(self, commands, deadline):
+        buffer = bytearray()
+        responses = []
+        while len(responses) < len(commands):
+            match = RESPONSE_END.search(buffer)
+            if match is not None:
+                response = bytes(buffer[0:match.start()])
+                if buffer[match.start()] == ord('?'):
+                    raise GalilError(commands[len(responses)], response.decode(errors='replace').strip())
+                responses.append(response)
+                del buffer[0:match.end()]
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('No answer from Galil to "%s"' % (commands[len(responses)]))
+            buffer += self.read_text(remaining)
+        return responses
+
+    # Get available ASCII text (from serial port or reader thread)
+    def read_text(self, timeout):
+        if self.streaming:
+            with self.text_ready:
+                if not self.received:
+                    self.text_ready.wait(timeout)
+                text = bytes(self.received)
+                self.received.clear()
+            return text
+        self.ser.timeout = min(timeout, 0.1)
+        return self.ser.read(max(1, self.ser.in_waiting))
+
+########################################################################
+### Data record parsing ###
+########################################################################
+
+# Class: DataRecordParser
+# DO: Split the serial byte stream into binary data records and ASCII responses
+#     Record layout comes from the controller QZ answer (number of axes, bytes in general block,
+#     bytes in coordinated move block, bytes per axis block)
+class DataRecordParser():
+
+    def __init__(self, n_axes, general_bytes, coord_bytes, axis_bytes, axes=(0, 1)):
+        self.n_axes = n_axes
+        self.record_size = RECORD_HEADER_SIZE + general_bytes + coord_bytes + n_axes*axis_bytes
+        self.buffer = bytearray()
+        self.dropped = 0        # Bytes discarded while looking for a valid record header
+
+        # Precompiled unpacker: sample number + motor position of the requested axes
+        fmt = '<%dxH' % (RECORD_SAMPLE_OFFSET)
+        offset = RECORD_SAMPLE_OFFSET + 2
+        for axis in axes:
+            field = RECORD_HEADER_SIZE + general_bytes + coord_bytes + axis*axis_bytes + AXIS_MOTOR_POSITION_OFFSET
+            fmt += '%dxi' % (field - offset)
+            offset = field + 4
+        self.unpacker = struct.Struct(fmt)
+
+    # Build parser from the QZ response (e.g. b' 4, 52, 26, 36')
+    @classmethod
+    def from_qz(cls, response, axes=(0, 1)):
+        fields = [int(v) for v in re.findall(rb'-?\d+', response)[0:4]]
+        if len(fields) != 4:
+            raise ValueError('Invalid QZ response: %s' % (response))
+        return cls(fields[0], fields[1], fields[2], fields[3], axes)
+
+    # Add new bytes from serial port
+    # Returns list of records (sample, (posA, posB, ...)) and ASCII text received in between
+    def feed(self, data):
+        self.buffer += data
+        records = []
+        text = bytearray()
+        while self.buffer:
+            match = FIRST_BINARY_BYTE.search(self.buffer)
+            if match is None:   # Only ASCII
+                text += self.buffer
+                self.buffer.clear()
+                break
+            start = match.start()
+            if start > 0:
+                text += self.buffer[:start]
+                del self.buffer[:start]
+            if len(self.buffer) < RECORD_HEADER_SIZE:   # Wait for complete header
+                break
+            size = self.buffer[2] | (self.buffer[3] << 8)
+            if size != self.record_size:    # Not a record header: resync on next byte
+                del self.buffer[0]
+                self.dropped += 1
+                continue
+            if len(self.buffer) < size:     # Wait for complete record
+                break
+            values = self.unpacker.unpack_from(self.buffer)
+            records.append((values[0], values[1:]))
+            del self.buffer[:size]
+        return records, bytes(text)
+
+# Function: record_bandwidth
+# DO: Highest data record rate the serial line can carry (records per second)
+# Inputs:
+#   record_size: data record size (bytes)
+#   baudrate: serial line speed (bits per second)
+def record_bandwidth(record_size, baudrate):
+    return RECORD_LINK_USE*baudrate/(SERIAL_BITS_PER_BYTE*record_size)
+
+# Function: min_record_period
+# DO: Shortest DR period (controller samples) whose records fit in the serial bandwidth
+# Inputs:
+#   record_size: data record size (bytes)
+#   sample_time: controller sample time (s, MG TM)
+#   baudrate: serial line speed (bits per second)
+def min_record_period(record_size, sample_time, baudrate):
+    return max(1, int(np.ceil(1.0/(record_bandwidth(record_size, baudrate)*sample_time) - 1e-9)))
+
+########################################################################
+
+# Class: SampleClock
+# DO: Convert the 16-bit controller sample counter into a time stamp in nanoseconds
+#     anchored to the host clock at the first record
+class SampleClock():
+
+    def __init__(self, sample_period):
+        self.sample_period_ns = int(sample_period*1e9)
+        self.last_sample = None
+        self.count = 0
+        self.anchor_ns = 0
+
+    def stamp(self, sample, now_ns):
+        if self.last_sample is None:
+            self.anchor_ns = now_ns
+        else:
+            self.count += (sample - self.last_sample) % SAMPLE_COUNTER_WRAP
+        self.last_sample = sample
+        return self.anchor_ns + self.count*self.sample_period_ns
+
+########################################################################
+
+# Class: DataRecordReader
+# DO: Background thread that reads the serial port while the controller streams data records
+#     Each record is handed to on_record(sample, positions) and any ASCII text to on_text(text)
+class DataRecordReader(threading.Thread):
+
+    def __init__(self, ser, parser, on_record, on_text=None):
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.parser = parser
+        self.on_record = on_record
+        self.on_text = on_text
+        self.running = True
+        self.records = 0                            # Records received
+        self.times = deque(maxlen=RATE_WINDOW)      # Arrival time of the last records
+
+    # Measured record rate over the last RATE_WINDOW records (records per second, 0 = unknown)
+    def rate(self):
+        times = list(self.times)
+        if (len(times) < 2) or (times[-1] <= times[0]):
+            return 0.0
+        return (len(times) - 1)/(times[-1] - times[0])
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except Exception:
+                break
+            if not data:
+                continue
+            records, text = self.parser.feed(data)
+            now = time.monotonic()
+            for sample, positions in records:
+                self.records += 1
+                self.times.append(now)
+                self.on_record(sample, positions)
+            if text and (self.on_text is not None):
+                self.on_text(text)
+
+    def stop(self):
+        self.running = False
+
+########################################################################
+### Connection management ###
+########################################################################
+
+# Class: GalilConnection
+# DO: Find the controller serial port, monitor the link with periodic round-trip pings
+#     and reconnect with exponential backoff when the link is lost
+#     Device discovery: explicit port, or USB (udev) attributes, or probe handshake on every serial port
+#     on_connect(ser) / on_disconnect() are called from the monitor thread when the link changes
+class GalilConnection():
+
+    def __init__(self, galil, port='', vid=0, pid=0, serial_number='', baudrate=115200, probe_command='QZ', \
+                 ping_period=1.0, ping_timeout=0.5, max_failures=3, backoff_max=10.0, on_connect=None, on_disconnect=None, log=print):
+        self.galil = galil
+        self.port = port
+        self.vid = vid
+        self.pid = pid
+        self.serial_number = serial_number
+        self.baudrate = baudrate
+        self.probe_command = probe_command
+        self.ping_period = ping_period
+        self.ping_timeout = ping_timeout
+        self.max_failures = max_failures
+        self.backoff_max = backoff_max
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.log = log
+
+        self.device = ''                    # Connected device
+        self.connected = False
+        self.failures = 0                   # Consecutive ping failures
+        self.reconnects = 0                 # Links re-established after a loss
+        self.lost = False                   # Link was lost since the last connection
+        self.latency = deque(maxlen=100)    # Last round-trip times (seconds)
+        self.running = False
+        self.thread = None
+
+    # Candidate devices in preference order
+    def candidates(self):
+        if self.port:
+            return [self.port]
+        filtered = (self.vid != 0) or (self.pid != 0) or (self.serial_number != '')
+        found = []
+        for info in list_ports.comports():
+            if (self.vid != 0) and (info.vid != self.vid):
+                continue
+            if (self.pid != 0) and (info.pid != self.pid):
+                continue
+            if self.serial_number and (info.serial_number != self.serial_number):
+                continue
+            found.append(info.device)
+        if filtered:
+            return found
+        found = [p for p in glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*') if p not in EXCLUDED_PORTS]
+        return [p for p in LEGACY_PORTS if p in found] + sorted(set(p for p in found if p not in LEGACY_PORTS))
+
+    # Open device and check that a Galil controller answers the probe command
+    def probe(self, device):
+        try:
+            ser = serial.Serial(device, baudrate=self.baudrate, timeout=self.ping_timeout)
+        except (OSError, ValueError):
+            return None
+        try:
+            GalilPort(ser).send(self.probe_command, timeout=self.ping_timeout)
+            return ser
+        except Exception:   # No answer, rejected probe or termios error
+            ser.close()
+            return None
+
+    # Single connection attempt (candidates are probed in parallel)
+    def connect(self):
+        devices = self.candidates()
+        if not devices:
+            return False
+        with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+            opened = list(pool.map(self.probe, devices))
+        ser = None
+        for device, port in zip(devices, opened):
+            if (port is not None) and (ser is None):
+                ser = port
+                self.device = device
+            elif port is not None:
+                port.close()
+        if ser is None:
+            return False
+        ser.timeout = 1
+        self.galil.ser = ser
+        self.connected = True
+        self.failures = 0
+        self.log('Serial connection open %s' % (self.device))
+        if self.on_connect is not None:
+            self.on_connect(ser)
+        return True
+
+    def disconnect(self):
+        if not self.connected:
+            return
+        self.connected = False
+        self.lost = True
+        if self.on_disconnect is not None:
+            self.on_disconnect()
+        ser = self.galil.ser
+        self.galil.ser = None
+        try:
+            ser.close()
+        except Exception:
+            pass
+        self.log('Serial connection lost %s' % (self.device))
+
+    # Start link monitor (and reconnection) thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.monitor, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2*self.ping_period + self.ping_timeout)
+
+    def monitor(self):
+        delay = 0.5
+        while self.running:
+            if not self.connected:
+                if self.connect():
+                    if self.lost:       # First connection is not a reconnection
+                        self.reconnects += 1
+                        self.lost = False
+                    delay = 0.5
+                else:
+                    time.sleep(delay)
+                    delay = min(2*delay, self.backoff_max)
+                continue
+            time.sleep(self.ping_period)
+            self.ping()
+
+    # Round trip with an empty command (controller answers ':')
+    def ping(self):
+        start = time.perf_counter()
+        try:
+            self.galil.send('', timeout=self.ping_timeout)
+        except GalilError:
+            pass
+        except Exception:   # Timeout, closed port or termios error
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.disconnect()
+            return
+        self.latency.append(time.perf_counter() - start)
+        self.failures = 0
+
+    # Link latency statistics (milliseconds)
+    def stats(self):
+        latency = 1e3*np.array(self.latency)
+        return {'device': self.device, 'connected': self.connected, 'reconnects': self.reconnects, 'failures': self.failures, \
+                'mean': float(latency.mean()) if latency.size else 0.0, \
+                'p95': float(np.percentile(latency, 95)) if latency.size else 0.0, \
+                'max': float(latency.max()) if latency.size else 0.0}
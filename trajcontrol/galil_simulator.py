@@ -0,0 +1,343 @@
+import os
+import re
+import struct
+import threading
+import time
+import tty
+import argparse
+import rclpy
+import serial
+import numpy as np
+
+from rclpy.node import Node
+from trajcontrol.galil import GalilPort, DataRecordParser, DataRecordReader, record_bandwidth, RECORD_HEADER_SIZE, RECORD_SAMPLE_OFFSET, AXIS_MOTOR_POSITION_OFFSET, AXES, axes_command
+
+N_AXES = 4
+GENERAL_BYTES = 52          # Same data record layout as a DMC-4040 (QZ answer)
+COORD_BYTES = 26
+AXIS_BYTES = 36
+
+COMMAND = re.compile(r'^([A-Z_]{2})\s*([A-H]*)\s*(=?)\s*(.*)$')
+
+########################################################################
+### Simulated controller ###
+########################################################################
+
+# Class: GalilSimulatorCore
+# DO: Galil DMC stand-in behind a pseudo-terminal
+#     Implements DP, PT, SH, MO, PA, PR, BG, ST, SP, AC, DC, TP, QZ, DR and MG TM
+#     with trapezoidal axis motion and configurable serial latency
+class GalilSimulatorCore():
+
+    def __init__(self, link='', latency=0.0, baudrate=0, speed=25000.0, accel=256000.0, decel=256000.0, sample_time=1000.0):
+        self.latency = latency              # Delay before each answer (seconds)
+        self.baudrate = baudrate            # Emulated line speed (0 = unlimited)
+        self.sample_time = sample_time*1e-6 # Controller sample period (TM in microseconds)
+
+        # Axis state (counts, counts/s, counts/s^2)
+        self.position = np.zeros(N_AXES)
+        self.velocity = np.zeros(N_AXES)
+        self.target = np.zeros(N_AXES)
+        self.speed = np.full(N_AXES, speed)
+        self.accel = np.full(N_AXES, accel)
+        self.decel = np.full(N_AXES, decel)
+        self.moving = np.zeros(N_AXES, dtype=bool)
+        self.tracking = np.zeros(N_AXES, dtype=bool)    # Position tracking mode (PT)
+        self.servo = np.zeros(N_AXES, dtype=bool)       # Servo enabled (SH)
+
+        self.sample = 0             # Controller sample counter
+        self.record_period = 0      # Data record period in samples (0 = off)
+        self.record_size = RECORD_HEADER_SIZE + GENERAL_BYTES + COORD_BYTES + N_AXES*AXIS_BYTES
+        self.commands = 0           # Number of commands executed
+
+        # Pseudo-terminal
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.slave = slave
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+
+        self.lock = threading.Lock()        # Serializes state access and pty writes
+        self.running = True
+        self.threads = [threading.Thread(target=self.serial_loop, daemon=True), threading.Thread(target=self.motion_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        self.running = False
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Write answer to the pty (with emulated line speed)
+    def write(self, data):
+        if self.baudrate > 0:
+            time.sleep(len(data)*10.0/self.baudrate)
+        with self.lock:
+            os.write(self.master, data)
+
+    # Read commands from the pty and answer them
+    def serial_loop(self):
+        buffer = ''
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            buffer += data.decode(errors='replace')
+            parts = re.split(r'[;\r\n]', buffer)
+            buffer = parts.pop()
+            if not parts:
+                continue
+            answer = bytearray()
+            for command in parts:
+                answer += self.execute(command.strip())
+            if self.latency > 0:
+                time.sleep(self.latency)
+            try:
+                self.write(bytes(answer))
+            except OSError:
+                break
+
+    # Execute one command and return its answer
+    def execute(self, command):
+        if not command:
+            return b':'
+        match = COMMAND.match(command.upper())
+        if match is None:
+            return b'?'
+        cmd, axes, equal, args = match.groups()
+        with self.lock:
+            self.commands += 1
+            try:
+                answer = self.run(cmd, axes, self.parse_values(axes, equal, args), args)
+            except (ValueError, IndexError):
+                return b'?'
+        if answer is None:
+            return b'?'
+        return answer + b':'
+
+    # Axis arguments as {axis index: value} ('PAA=10', 'PA 10,,20', 'BG AB')
+    def parse_values(self, axes, equal, args):
+        if axes and equal:
+            return {AXES.index(axes[0]): float(args)}
+        values = {}
+        for i, value in enumerate(args.split(',')):
+            if value.strip() and re.match(r'^-?[\d.]+$', value.strip()):
+                values[i] = float(value)
+        return values
+
+    def run(self, cmd, axes, values, args):
+        axis_list = [AXES.index(a) for a in axes] or list(range(N_AXES))
+        if cmd == 'DP':
+            for i, v in values.items():
+                self.position[i] = v
+                self.target[i] = v
+        elif cmd == 'PT':
+            for i, v in values.items():
+                self.tracking[i] = (v != 0)
+        elif cmd == 'SH':
+            self.servo[axis_list] = True
+        elif cmd == 'MO':
+            self.servo[axis_list] = False
+            self.moving[axis_list] = False
+        elif cmd == 'PA':
+            for i, v in values.items():
+                self.target[i] = v
+                self.moving[i] = self.tracking[i] and self.servo[i]
+        elif cmd == 'PR':
+            for i, v in values.items():
+                self.target[i] = self.position[i] + v
+        elif cmd == 'BG':
+            for i in axis_list:
+                if not self.servo[i]:
+                    return None
+                self.moving[i] = True
+        elif cmd == 'ST':
+            self.target[axis_list] = self.position[axis_list]
+            self.velocity[axis_list] = 0.0
+            self.moving[axis_list] = False
+        elif cmd in ('SP', 'AC', 'DC'):
+            array = {'SP': self.speed, 'AC': self.accel, 'DC': self.decel}[cmd]
+            for i, v in values.items():
+                array[i] = v
+        elif cmd == 'TP':
+            return str.encode(' ' + ', '.join('%d' % (p) for p in np.round(self.position)) + '\r\n')
+        elif cmd == 'QZ':
+            return str.encode(' %d, %d, %d, %d\r\n' % (N_AXES, GENERAL_BYTES, COORD_BYTES, AXIS_BYTES))
+        elif cmd == 'DR':
+            self.record_period = int(values.get(0, 0))
+        elif cmd == 'MG':
+            if args.strip() == 'TM':
+                return str.encode(' %.4f\r\n' % (self.sample_time*1e6))
+            if args.strip() == '_BN':
+                return b' 0.0000\r\n'
+            return str.encode(' ' + args.strip().strip('"') + '\r\n')
+        else:
+            return None
+        return b''
+
+    # Integrate trapezoidal motion and stream data records
+    def motion_loop(self):
+        last = time.monotonic()
+        next_record = 0
+        while self.running:
+            time.sleep(self.sample_time)
+            now = time.monotonic()
+            samples = int((now - last)/self.sample_time)
+            if samples == 0:
+                continue
+            last += samples*self.sample_time
+            with self.lock:
+                self.step(samples*self.sample_time)
+                self.sample += samples
+                record = None
+                if (self.record_period > 0) and (self.sample >= next_record):
+                    record = self.data_record()
+                    next_record = self.sample + self.record_period
+            if record is not None:
+                try:
+                    self.write(record)
+                except OSError:
+                    break
+
+    # Trapezoidal profile step (all axes at once)
+    def step(self, dt):
+        distance = self.target - self.position
+        direction = np.sign(distance)
+        speed = np.abs(self.velocity)
+        # Decelerate when the stopping distance reaches the remaining distance
+        braking = speed**2/(2*self.decel) >= np.abs(distance)
+        new_speed = np.where(braking, np.maximum(speed - self.decel*dt, 0.0), np.minimum(speed + self.accel*dt, self.speed))
+        new_position = self.position + direction*0.5*(speed + new_speed)*dt
+        # Arrived (or overshooting): snap to target
+        arrived = (np.sign(self.target - new_position) != direction) | (new_speed == 0.0) & braking
+        new_position = np.where(arrived, self.target, new_position)
+        new_speed = np.where(arrived, 0.0, new_speed)
+        self.position = np.where(self.moving, new_position, self.position)
+        self.velocity = np.where(self.moving, direction*new_speed, 0.0)
+        self.moving &= ~arrived
+
+    # Binary data record with current sample number and motor positions
+    def data_record(self):
+        record = bytearray(self.record_size)
+        record[0] = 0x80 | ((1 << N_AXES) - 1)
+        struct.pack_into('<H', record, 2, self.record_size)
+        struct.pack_into('<H', record, RECORD_SAMPLE_OFFSET, self.sample % 65536)
+        for i in range(N_AXES):
+            offset = RECORD_HEADER_SIZE + GENERAL_BYTES + COORD_BYTES + i*AXIS_BYTES
+            struct.pack_into('<HBB', record, offset, 0x8000 if self.moving[i] else 0, 0, 1)
+            struct.pack_into('<i', record, offset + AXIS_MOTOR_POSITION_OFFSET, int(round(self.position[i])))
+        return bytes(record)
+
+########################################################################
+### ROS node ###
+########################################################################
+
+class GalilSimulator(Node):
+
+    def __init__(self):
+        super().__init__('galil_simulator')
+
+        #Declare node parameters
+        self.declare_parameter('port_link', '/tmp/ttyGalil')    # Symbolic link to the simulated serial port
+        self.declare_parameter('latency', 0.002)                # Answer delay (seconds)
+        self.declare_parameter('baudrate', 115200)              # Emulated line speed (0 = unlimited)
+        self.declare_parameter('speed', 25000.0)                # Axis speed (counts/s)
+        self.declare_parameter('accel', 256000.0)               # Axis acceleration (counts/s^2)
+        self.declare_parameter('decel', 256000.0)               # Axis deceleration (counts/s^2)
+        self.declare_parameter('sample_time', 1000.0)           # Controller sample period TM (microseconds)
+
+        self.core = GalilSimulatorCore(link=self.get_parameter('port_link').get_parameter_value().string_value, \
+            latency=self.get_parameter('latency').get_parameter_value().double_value, \
+            baudrate=self.get_parameter('baudrate').get_parameter_value().integer_value, \
+            speed=self.get_parameter('speed').get_parameter_value().double_value, \
+            accel=self.get_parameter('accel').get_parameter_value().double_value, \
+            decel=self.get_parameter('decel').get_parameter_value().double_value, \
+            sample_time=self.get_parameter('sample_time').get_parameter_value().double_value)
+        self.get_logger().info('Simulated Galil at %s (%s)' % (self.core.port, self.core.link))
+
+    def destroy_node(self):
+        self.core.close()
+        super().destroy_node()
+
+########################################################################
+### Benchmark ###
+########################################################################
+
+# Function: benchmark
+# DO: Measure round-trip latency and throughput of the serial code path against the simulator
+def benchmark(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Galil serial path against the simulated controller')
+    parser.add_argument('-n', type=int, default=500, help='number of transactions per test')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated answer delay (s)')
+    parser.add_argument('--baudrate', type=int, default=115200, help='emulated line speed (0 = unlimited)')
+    parser.add_argument('--record-period', type=int, default=8, help='data record period for the streaming test (samples)')
+    options = parser.parse_args(args)
+
+    core = GalilSimulatorCore(latency=options.latency, baudrate=options.baudrate)
+    ser = serial.Serial(core.port, baudrate=115200, timeout=1)
+    galil = GalilPort(ser)
+    galil.send([axes_command("DP", [0, 0]), axes_command("PT", [1, 1]), "SH"])
+
+    tests = {
+        'TP query': lambda k: galil.query("TP"),
+        'PA a,b': lambda k: galil.send(axes_command("PA", [k % 100, -(k % 100)])),
+        'PR a,b;BG AB': lambda k: galil.send([axes_command("PR", [1, -1]), "BG AB"]),
+    }
+    print('%-14s %10s %10s %10s %12s' % ('test', 'mean [ms]', 'p95 [ms]', 'max [ms]', 'rate [1/s]'))
+    for name, test in tests.items():
+        latency = np.empty(options.n)
+        start = time.perf_counter()
+        for k in range(options.n):
+            t0 = time.perf_counter()
+            test(k)
+            latency[k] = time.perf_counter() - t0
+        total = time.perf_counter() - start
+        print('%-14s %10.3f %10.3f %10.3f %12.1f' % (name, 1e3*latency.mean(), 1e3*np.percentile(latency, 95), 1e3*latency.max(), options.n/total))
+
+    # Data record throughput
+    record_parser = DataRecordParser.from_qz(str.encode(galil.query("QZ")))
+    received = []
+    reader = DataRecordReader(ser, record_parser, lambda sample, positions: received.append(time.perf_counter()), galil.on_text)
+    galil.streaming = True
+    reader.start()
+    galil.send("DR %d,0" % (options.record_period))
+    time.sleep(2.0)
+    galil.send("DR 0")
+    reader.stop()
+    reader.join(timeout=1.0)
+    if len(received) > 1:
+        period = np.diff(received)
+        print('data records: %.1f Hz, %.1f Hz requested (period jitter %.3f ms, dropped bytes %d)' % (1.0/period.mean(), \
+            1.0/(options.record_period*core.sample_time), 1e3*period.std(), record_parser.dropped))
+    if options.baudrate > 0:
+        print('serial bandwidth: %.1f Hz for %d byte records at %d baud' % (record_bandwidth(record_parser.record_size, options.baudrate), \
+            record_parser.record_size, options.baudrate))
+    print('commands executed: %d' % (core.commands))
+    ser.close()
+    core.close()
+
+########################################################################
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    galil_simulator = GalilSimulator()
+
+    rclpy.spin(galil_simulator)
+
+    # Destroy the node explicitly
+    # (optional - otherwise it will be done automatically
+    # when the garbage collector destroys the node object)
+    galil_simulator.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import os
+import struct
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from trajcontrol.dataset import search_folders
+
+IGTL_PORT = 18944                           # PLUS OpenIGTLink server default port
+IGTL_VERSION = 1
+HEADER = struct.Struct('>H12s20sQQQ')       # version, type, device name, timestamp, body size, crc (58 bytes)
+TRANSFORM = struct.Struct('>12f')           # R11 R21 R31 R12 R22 R32 R13 R23 R33 TX TY TZ (48 bytes)
+PLUS_CONFIG = 'PlusDeviceSet_Server_NDIAurora_2Needles.xml'
+BUFFER_SIZE = 1 << 16                       # Receive buffer (bytes, grows for larger messages)
+
+########################################################################
+### CRC ###
+########################################################################
+
+# CRC-64/ECMA-182 (OpenIGTLink body checksum): polynomial 0x42F0E1EBA9EA3693, no reflection, init 0
+CRC_POLY = 0x42F0E1EBA9EA3693
+CRC_MASK = 0xFFFFFFFFFFFFFFFF
+def crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 56
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC_POLY) & CRC_MASK if crc & (1 << 63) else (crc << 1) & CRC_MASK
+        table.append(crc)
+    return table
+CRC_TABLE = crc_table()
+
+# Function: crc64
+# DO: OpenIGTLink checksum of a message body (bytes-like)
+def crc64(data, crc=0):
+    for byte in bytes(data):
+        crc = CRC_TABLE[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & CRC_MASK)
+    return crc
+
+########################################################################
+### TRANSFORM messages ###
+########################################################################
+
+# Function: timestamp
+# DO: OpenIGTLink timestamp (seconds in the upper 32 bits, fraction in the lower 32 bits) from nanoseconds
+def timestamp(nanoseconds):
+    sec, nanosec = divmod(int(nanoseconds), 1000000000)
+    return (sec << 32) | ((nanosec << 32) // 1000000000)
+
+# Function: pose_matrix
+# DO: Rotation matrix (3x3) of the quaternion of a pose [x, y, z, qw, qx, qy, qz]
+def pose_matrix(pose):
+    w, x, y, z = np.asarray(pose[3:7], dtype=float)/np.linalg.norm(pose[3:7])
+    return np.array([[1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)], \
+                     [2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)], \
+                     [2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)]])
+
+# Function: matrix_quaternion
+# DO: Quaternion [qw, qx, qy, qz] (qw >= 0) of a rotation matrix, largest pivot (numerically stable)
+def matrix_quaternion(R):
+    trace = R[0,0] + R[1,1] + R[2,2]
+    if trace > 0:
+        s = 2.0*np.sqrt(trace + 1.0)
+        q = [0.25*s, (R[2,1]-R[1,2])/s, (R[0,2]-R[2,0])/s, (R[1,0]-R[0,1])/s]
+    elif (R[0,0] > R[1,1]) and (R[0,0] > R[2,2]):
+        s = 2.0*np.sqrt(1.0 + R[0,0] - R[1,1] - R[2,2])
+        q = [(R[2,1]-R[1,2])/s, 0.25*s, (R[0,1]+R[1,0])/s, (R[0,2]+R[2,0])/s]
+    elif R[1,1] > R[2,2]:
+        s = 2.0*np.sqrt(1.0 + R[1,1] - R[0,0] - R[2,2])
+        q = [(R[0,2]-R[2,0])/s, (R[0,1]+R[1,0])/s, 0.25*s, (R[1,2]+R[2,1])/s]
+    else:
+        s = 2.0*np.sqrt(1.0 + R[2,2] - R[0,0] - R[1,1])
+        q = [(R[1,0]-R[0,1])/s, (R[0,2]+R[2,0])/s, (R[1,2]+R[2,1])/s, 0.25*s]
+    q = np.array(q)
+    return q if q[0] >= 0 else -q
+
+# Function: pack_transform
+# DO: Complete OpenIGTLink TRANSFORM message (header and body)
+# Inputs:
+#   name: device name (tool, e.g. NeedleToTracker)
+#   pose: tool pose [x, y, z, qw, qx, qy, qz]
+#   nanoseconds: message time
+# Output:
+#   message (bytes)
+def pack_transform(name, pose, nanoseconds=0):
+    R = pose_matrix(pose)
+    body = TRANSFORM.pack(*R.T.ravel(), *pose[0:3])
+    return HEADER.pack(IGTL_VERSION, b'TRANSFORM', name.encode()[:20], timestamp(nanoseconds), TRANSFORM.size, crc64(body)) + body
+
+# Function: unpack_transform
+# DO: Tool pose [x, y, z, qw, qx, qy, qz] of a TRANSFORM message body (read in place from a buffer)
+def unpack_transform(body):
+    values = TRANSFORM.unpack_from(body)
+    R = np.array(values[0:9]).reshape(3, 3).T
+    return np.concatenate((values[9:12], matrix_quaternion(R)))
+
+# Class: MessageReader
+# DO: Splits an OpenIGTLink byte stream into messages without copying them
+#     recv() reads from the socket into a fixed buffer and returns the complete messages as
+#     (type, device name, timestamp in s, body memoryview); the views are valid until the next recv()
+class MessageReader():
+
+    def __init__(self, size=BUFFER_SIZE, check_crc=False):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0              # First unparsed byte
+        self.end = 0                # End of received data
+        self.check_crc = check_crc
+
+    # Function: recv
+    # DO: Read available data (blocking) and parse the complete messages (None when the peer closed)
+    #     Message views of the previous call must be released first (the buffer may grow)
+    def recv(self, sock):
+        # Move the partial message to the front (and grow for messages larger than the buffer)
+        if self.start > 0:
+            self.view[0:self.end-self.start] = self.view[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        if self.end == len(self.buffer):
+            self.view.release()
+            self.buffer.extend(bytearray(len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        n = sock.recv_into(self.view[self.end:])
+        if n == 0:
+            return None
+        self.end += n
+        return list(self.messages())
+
+    def messages(self):
+        while self.end - self.start >= HEADER.size:
+            _, msg_type, name, stamp, body_size, crc = HEADER.unpack_from(self.buffer, self.start)
+            first = self.start + HEADER.size
+            if self.end - first < body_size:
+                return
+            self.start = first + body_size
+            body = self.view[first:self.start]
+            if self.check_crc and crc64(body) != crc:
+                continue
+            yield msg_type.rstrip(b'\0').decode(), name.rstrip(b'\0').decode(), (stamp >> 32) + (stamp & 0xFFFFFFFF)/2**32, body
+
+########################################################################
+### PLUS configuration ###
+########################################################################
+
+# Function: plus_config
+# DO: Transform names and listening port of the OpenIGTLink server of a PLUS device set configuration
+# Inputs:
+#   name: .xml file name (searched in the package files folders) or path
+# Output:
+#   names: transform (tool) names, port: listening port
+def plus_config(name=PLUS_CONFIG):
+    path = name
+    if not os.path.isfile(path):
+        for folder in search_folders():
+            if os.path.isfile(os.path.join(folder, name)):
+                path = os.path.join(folder, name)
+                break
+        else:
+            raise ValueError('PLUS configuration %s not found in %s' % (name, ', '.join(search_folders())))
+    server = ET.parse(path).getroot().find('PlusOpenIGTLinkServer')
+    if server is None:
+        raise ValueError('%s: no PlusOpenIGTLinkServer' % (path))
+    names = [transform.get('Name') for transform in server.iter('Transform')]
+    return names, int(server.get('ListeningPort', IGTL_PORT))
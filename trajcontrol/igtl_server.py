@@ -0,0 +1,99 @@
+import rclpy
+import socket
+import threading
+
+from trajcontrol.virtual_aurora import VirtualAurora
+from trajcontrol.igtl import pack_transform, plus_config, PLUS_CONFIG
+
+# Class: IgtlServer
+# DO: OpenIGTLink TRANSFORM server standing in for PLUS and the Aurora (ros2_igtl_bridge igtl_node connects as client)
+#     Tool names and listening port come from the PLUS configuration (files/PlusDeviceSet_Server_NDIAurora_2Needles.xml)
+#     Tool poses, noise, rate and jitter are those of virtual_aurora (source: needle simulation / log / dataset)
+#     Each frame is sent to every connected client as one write (all visible tools, like the PLUS server)
+class IgtlServer(VirtualAurora):
+
+    def __init__(self):
+        super().__init__('igtl_server')
+
+        #Declare node parameters
+        self.declare_parameter('host', '0.0.0.0')           #Listening address
+        self.declare_parameter('port', 0)                   #Listening port (0 = ListeningPort of the PLUS configuration)
+
+        port = self.get_parameter('port').get_parameter_value().integer_value
+        if port <= 0:
+            port = self.plus_port
+
+        # Listening socket, clients accepted in a thread (frames are sent from the timer)
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        self.sent = 0
+        self.server = socket.create_server((self.get_parameter('host').get_parameter_value().string_value, port))
+        self.accept_thread = threading.Thread(target=self.accept_clients, daemon=True)
+        self.accept_thread.start()
+        self.get_logger().info('OpenIGTLink server listening on port %d' % (port))
+
+    # Tool names of the PLUS configuration
+    def default_tools(self):
+        self.declare_parameter('plus_config', PLUS_CONFIG)  #PLUS device set configuration (.xml in files/ or path)
+        names, self.plus_port = plus_config(self.get_parameter('plus_config').get_parameter_value().string_value)
+        return names
+
+    # No ROS output: the bridge publishes IGTL_TRANSFORM_IN
+    def create_output(self):
+        pass
+
+    def accept_clients(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except OSError:     # Server closed
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.clients_lock:
+                self.clients.append(client)
+            self.get_logger().info('OpenIGTLink client connected: %s:%d' % address[0:2])
+
+    # Send one tracker frame to every client
+    def publish_readings(self, names, readings):
+        now = self.get_clock().now().nanoseconds
+        frame = b''.join(pack_transform(name, X, now) for name, X in zip(names, readings))
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.sendall(frame)
+                self.sent += 1
+            except OSError:
+                self.get_logger().info('OpenIGTLink client disconnected (%d frames sent)' % (self.sent))
+                client.close()
+                with self.clients_lock:
+                    self.clients.remove(client)
+
+    def destroy_node(self):
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)  # Wake up the accept thread
+        except OSError:
+            pass
+        self.server.close()
+        with self.clients_lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+        return super().destroy_node()
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    igtl_server = IgtlServer()
+
+    rclpy.spin(igtl_server)
+
+    # Destroy the node explicitly
+    # (optional - otherwise it will be done automatically
+    # when the garbage collector destroys the node object)
+    igtl_server.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import os
+import re
+import glob
+import sqlite3
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+from trajcontrol import log_loader
+
+CATALOG_FILE = 'catalog.sqlite'     # Default catalog location (inside the data folder)
+CATALOG_VERSION = 1                 # Metric definitions of the catalog (catalogs of another version are reindexed)
+SPIKE_WINDOW = 5                    # Median window used to reject isolated sensor spikes
+
+# Controller gain in file names: K05 = 0.5, K1 = 1, K02 = 0.2, K_0-15 = 0.15
+GAIN = re.compile(r'[Kk]_?(\d+(?:-\d+)?)')
+
+# Catalog columns (name, SQL type)
+FIELDS = [
+    ('name', 'TEXT PRIMARY KEY'), ('path', 'TEXT'), ('mtime', 'REAL'), ('size', 'INTEGER'),
+    ('kind', 'TEXT'), ('gain', 'REAL'), ('schema', 'INTEGER'), ('samples', 'INTEGER'),
+    ('start', 'REAL'), ('duration', 'REAL'), ('controlled', 'INTEGER'), ('commands', 'INTEGER'),
+    ('depth', 'REAL'), ('error_mean', 'REAL'), ('error_rms', 'REAL'), ('error_max', 'REAL'), ('error_final', 'REAL'),
+]
+
+########################################################################
+### Run metadata ###
+########################################################################
+
+# Function: parse_gain
+# DO: Controller gain from run name (None if not in the name)
+def parse_gain(name):
+    match = GAIN.search(name)
+    if match is None:
+        return None
+    value = match.group(1)
+    if '-' in value:
+        return float(value.replace('-', '.'))
+    if value.startswith('0') and len(value) > 1:
+        return float('0.' + value[1:])
+    return float(value)
+
+# Function: parse_kind
+# DO: Experiment kind from run name prefix (closedloop, move, jacob, symp, ...)
+def parse_kind(name):
+    match = re.match(r'[A-Za-z]+', name)
+    return match.group(0).lower() if match is not None else ''
+
+# Function: despike
+# DO: Sliding median of a 1D series (same length, isolated spikes removed)
+def despike(values, window=SPIKE_WINDOW):
+    if len(values) < window:
+        return values
+    filtered = np.median(sliding_window_view(values, window), axis=1)
+    pad = window // 2
+    return np.concatenate((values[:pad], filtered, values[len(values)-window+pad+1:]))
+
+# Function: tracking
+# DO: Insertion depth and tip deviation from the entry point (robot frame, y = insertion axis)
+# Inputs:
+#   log: RunLog
+# Output:
+#   rows: row indices with valid entry point and tip readings
+#   depth: tip depth from entry point (mm, despiked)
+#   error: tip - entry point in x and z (mm, despiked, one column per axis)
+def tracking(log):
+    entry = log.get(['Entry_point x', 'Entry_point y', 'Entry_point z'])
+    tip = log.get(['Tip x', 'Tip y', 'Tip z'])
+    rows = np.flatnonzero(np.any(entry != 0, axis=1) & np.any(tip != 0, axis=1))
+    depth = despike(tip[rows,1] - entry[rows,1])
+    error = np.column_stack((despike(tip[rows,0] - entry[rows,0]), despike(tip[rows,2] - entry[rows,2])))
+    return rows, depth, error
+
+# Function: lateral_error
+# DO: Lateral tip distance from the entry point, despiked after taking the distance (catalog error_* columns)
+# Inputs:
+#   log: RunLog
+#   rows: row indices from tracking
+# Output:
+#   lateral error (mm)
+def lateral_error(log, rows):
+    entry = log.get(['Entry_point x', 'Entry_point z'])[rows]
+    tip = log.get(['Tip x', 'Tip z'])[rows]
+    return despike(np.hypot(tip[:,0] - entry[:,0], tip[:,1] - entry[:,1]))
+
+# Function: run_metadata
+# DO: Load one run and compute its catalog entry
+# Inputs:
+#   filename: csv file
+# Output:
+#   dictionary with FIELDS keys
+def run_metadata(filename):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    stat = os.stat(filename)
+    log = log_loader.load(filename)
+    meta = dict.fromkeys([field for field, _ in FIELDS])
+    meta.update({'name': name, 'path': os.path.abspath(filename), 'mtime': stat.st_mtime, 'size': stat.st_size, \
+        'kind': parse_kind(name), 'gain': parse_gain(name), 'schema': log.schema, 'samples': len(log)})
+    if len(log) == 0:
+        return meta
+    meta['start'] = float(log.index.start)*1e-9
+    meta['duration'] = float(log.time().max())
+
+    # Control commands (changes of the stage command)
+    control = log.get(['Control x', 'Control z'])
+    meta['controlled'] = int(np.any(control != 0))
+    meta['commands'] = int(np.count_nonzero(np.any(np.diff(control, axis=0) != 0, axis=1)))
+
+    # Insertion depth and lateral tip error with respect to the entry point
+    rows, depth, _ = tracking(log)
+    if rows.size > 0:
+        error = lateral_error(log, rows)
+        meta['depth'] = float(depth.max())
+        meta['error_mean'] = float(error.mean())
+        meta['error_rms'] = float(np.sqrt(np.mean(error**2)))
+        meta['error_max'] = float(error.max())
+        meta['error_final'] = float(error[np.argmax(depth)])
+    return meta
+
+########################################################################
+### Catalog ###
+########################################################################
+
+# Class: Catalog
+# DO: SQLite index of recorded runs
+#     The catalog records CATALOG_VERSION (SQLite user_version): runs indexed with other metric definitions are reindexed
+class Catalog():
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != CATALOG_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS runs')        # Other metric definitions: index every run again
+            self.db.execute('PRAGMA user_version = %d' % (CATALOG_VERSION))
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (%s)' % (', '.join('%s %s' % field for field in FIELDS)))
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_gain ON runs (gain, depth)')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # Function: update
+    # DO: Index new or changed runs in parallel and drop runs whose file was removed
+    # Inputs:
+    #   folder: data folder
+    #   pattern: file pattern
+    #   workers: number of processes (None = cpu count)
+    # Output:
+    #   number of (re)indexed runs, number of removed runs, list of (file, error) that failed
+    def update(self, folder, pattern='*.csv', workers=None):
+        files = {os.path.abspath(filename): os.stat(filename) for filename in glob.glob(os.path.join(folder, pattern))}
+        known = {row['path']: (row['mtime'], row['size']) for row in self.db.execute('SELECT path, mtime, size FROM runs')}
+        changed = [path for path, stat in files.items() if known.get(path) != (stat.st_mtime, stat.st_size)]
+        removed = [path for path in known if path not in files]
+
+        failed = []
+        if changed:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [(path, executor.submit(run_metadata, path)) for path in changed]
+                for path, future in futures:
+                    try:
+                        meta = future.result()
+                    except (ValueError, OSError) as e:
+                        failed.append((path, str(e)))
+                        continue
+                    self.db.execute('INSERT OR REPLACE INTO runs VALUES (%s)' % (', '.join('?'*len(FIELDS))), \
+                        [meta[field] for field, _ in FIELDS])
+        self.db.executemany('DELETE FROM runs WHERE path = ?', [(path,) for path in removed])
+        self.db.commit()
+        return len(changed) - len(failed), len(removed), failed
+
+    # Function: query
+    # DO: Select runs by metadata
+    # Inputs (all optional):
+    #   name: SQL LIKE pattern on run name (e.g. 'closedloop%')
+    #   kind: experiment kind (file name prefix)
+    #   gain: controller gain
+    #   controlled: True for runs with control commands
+    #   min_depth, max_depth: insertion depth range (mm)
+    #   min_duration: minimum run length (s)
+    # Output:
+    #   list of sqlite3.Row (access by column name), ordered by name
+    def query(self, name=None, kind=None, gain=None, controlled=None, min_depth=None, max_depth=None, min_duration=None):
+        conditions = []
+        values = []
+        for condition, value in (('name LIKE ?', name), ('kind = ?', kind), ('abs(gain - ?) < 1e-9', gain), \
+                ('controlled = ?', None if controlled is None else int(controlled)), ('depth >= ?', min_depth), \
+                ('depth <= ?', max_depth), ('duration >= ?', min_duration)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        return self.db.execute('SELECT * FROM runs%s ORDER BY name' % (where), values).fetchall()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Index recorded runs and query them by metadata')
+    parser.add_argument('--folder', default=os.path.join('src', 'trajcontrol', 'data'), help='data folder')
+    parser.add_argument('--db', default=None, help='catalog file (default: <folder>/%s)' % (CATALOG_FILE))
+    parser.add_argument('--workers', type=int, default=None, help='number of processes used for indexing')
+    parser.add_argument('--no-update', action='store_true', help='query the catalog without re-indexing')
+    parser.add_argument('--name', default=None, help='run name pattern (SQL LIKE, e.g. closedloop%%)')
+    parser.add_argument('--kind', default=None, help='experiment kind (file name prefix)')
+    parser.add_argument('--gain', type=float, default=None, help='controller gain')
+    parser.add_argument('--controlled', action='store_true', default=None, help='only runs with control commands')
+    parser.add_argument('--min-depth', type=float, default=None, help='minimum insertion depth (mm)')
+    parser.add_argument('--max-depth', type=float, default=None, help='maximum insertion depth (mm)')
+    parser.add_argument('--min-duration', type=float, default=None, help='minimum run length (s)')
+    options = parser.parse_args(args)
+
+    catalog = Catalog(options.db if options.db is not None else os.path.join(options.folder, CATALOG_FILE))
+    if not options.no_update:
+        updated, removed, failed = catalog.update(options.folder, workers=options.workers)
+        print('%d runs indexed, %d removed' % (updated, removed))
+        for path, error in failed:
+            print('Failed %s: %s' % (path, error))
+    runs = catalog.query(options.name, options.kind, options.gain, options.controlled, \
+        options.min_depth, options.max_depth, options.min_duration)
+    print('%-32s %-12s %5s %6s %8s %10s %10s %10s %10s' % ('run', 'kind', 'gain', 'schema', 'samples', 'length [s]', 'depth [mm]', 'rms [mm]', 'final [mm]'))
+    for run in runs:
+        print('%-32s %-12s %5s %6d %8d %10s %10s %10s %10s' % (run['name'], run['kind'], '-' if run['gain'] is None else '%g' % run['gain'], \
+            run['schema'], run['samples'], *['-' if run[field] is None else '%.1f' % run[field] for field in ('duration', 'depth', 'error_rms', 'error_final')]))
+    catalog.close()
+
+if __name__ == '__main__':
+    main()
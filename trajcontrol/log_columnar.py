@@ -0,0 +1,149 @@
+import os
+import json
+import argparse
+import numpy as np
+
+FORMAT_NAME = 'trajcontrol-columnar'
+FORMAT_VERSION = 1
+SCHEMA_FILE = 'schema.json'
+EXTENSION = '.col'
+
+########################################################################
+### Columnar log format ###
+########################################################################
+# A log is a directory <name>.col with:
+#   schema.json: format name and version, number of complete rows and one entry per column (name, dtype, file)
+#   c000.bin, c001.bin, ...: raw little-endian values of each column, appended in batches
+# The row count in schema.json is only updated after the column files are flushed,
+# so a reader never sees a partially written row (even while the log is being recorded)
+
+# Function: column_dtype
+# DO: Storage type of a log column (time stamps as integers, everything else as double)
+def column_dtype(name):
+    return '<i8' if name.endswith('sec') else '<f8'
+
+# Class: ColumnarFile
+# DO: Append rows to a columnar log (used by LogWriter)
+class ColumnarFile():
+
+    def __init__(self, folder, header, dtypes=None):
+        self.folder = folder
+        self.header = list(header)
+        self.dtypes = list(dtypes) if dtypes is not None else [column_dtype(name) for name in self.header]
+        self.rows = 0
+        os.makedirs(folder, exist_ok=True)
+        self.files = ['c%03d.bin' % (i) for i in range(len(self.header))]
+        self.handles = [open(os.path.join(folder, file), 'wb') for file in self.files]
+        self.write_schema()
+
+    # Append a batch of rows (list of lists)
+    def writerows(self, rows):
+        if len(rows) == 0:
+            return
+        data = np.asarray(rows, dtype=np.float64).reshape(len(rows), len(self.header))
+        for i, handle in enumerate(self.handles):
+            handle.write(data[:,i].astype(self.dtypes[i]).tobytes())
+        self.rows += len(rows)
+
+    # Flush column files, then publish the new row count
+    def flush(self):
+        for handle in self.handles:
+            handle.flush()
+        self.write_schema()
+
+    def sync(self):
+        for handle in self.handles:
+            os.fsync(handle.fileno())
+
+    # Bytes on disk
+    def size(self):
+        return sum(handle.tell() for handle in self.handles)
+
+    def close(self):
+        self.flush()
+        for handle in self.handles:
+            handle.close()
+
+    def write_schema(self):
+        schema = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'rows': self.rows, \
+            'columns': [{'name': name, 'dtype': dtype, 'file': file} for name, dtype, file in zip(self.header, self.dtypes, self.files)]}
+        filename = os.path.join(self.folder, SCHEMA_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(schema, f, indent=1)
+        os.replace(filename + '.tmp', filename)  # Atomic update
+
+# Class: ColumnarLog
+# DO: Read a columnar log; columns are memory-mapped on first access and returned as numpy arrays
+class ColumnarLog():
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, SCHEMA_FILE)) as f:
+            schema = json.load(f)
+        if schema.get('format') != FORMAT_NAME:
+            raise ValueError('%s is not a %s log' % (folder, FORMAT_NAME))
+        if schema.get('version', 0) > FORMAT_VERSION:
+            raise ValueError('%s has format version %s (supported up to %d)' % (folder, schema.get('version'), FORMAT_VERSION))
+        self.rows = schema['rows']
+        self.columns = [column['name'] for column in schema['columns']]
+        self.schema = {column['name']: column for column in schema['columns']}
+        self.cache = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, name):
+        return name in self.schema
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            column = self.schema[name]
+            if self.rows == 0:
+                self.cache[name] = np.zeros(0, dtype=column['dtype'])
+            else:
+                self.cache[name] = np.memmap(os.path.join(self.folder, column['file']), dtype=column['dtype'], mode='r', shape=(self.rows,))
+        return self.cache[name]
+
+    # Function: table
+    # DO: Stack columns in one 2D float array (all columns if names is None)
+    def table(self, names=None):
+        names = self.columns if names is None else names
+        table = np.empty((self.rows, len(names)))
+        for i, name in enumerate(names):
+            table[:,i] = self[name]
+        return table
+
+    # Function: to_csv
+    # DO: Export log with the same header as SaveFile csv files
+    def to_csv(self, filename):
+        fmt = ['%d' if self.schema[name]['dtype'] == '<i8' else '%.17g' for name in self.columns]
+        np.savetxt(filename, self.table(), delimiter=',', fmt=fmt, header=','.join(self.columns), comments='')
+
+# Function: from_csv
+# DO: Convert a csv log (one header row) to columnar format
+def from_csv(filename, folder):
+    with open(filename, newline='', encoding='UTF8') as f:
+        header = f.readline().rstrip('\r\n').split(',')
+    data = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+    log = ColumnarFile(folder, header)
+    log.writerows(data)
+    log.close()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert trajcontrol logs between csv and columnar format')
+    parser.add_argument('input', help='<name>.col directory (export to csv) or <name>.csv file (convert to columnar)')
+    parser.add_argument('-o', '--output', default=None, help='output path (default: input with the other extension)')
+    options = parser.parse_args(args)
+
+    source = os.path.normpath(options.input)
+    base = os.path.splitext(source)[0]
+    if os.path.isdir(source):
+        output = options.output if options.output is not None else base + '.csv'
+        ColumnarLog(source).to_csv(output)
+    else:
+        output = options.output if options.output is not None else base + EXTENSION
+        from_csv(source, output)
+    print('%s written' % (output))
+
+if __name__ == '__main__':
+    main()
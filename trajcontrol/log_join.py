@@ -0,0 +1,112 @@
+import os
+import argparse
+import numpy as np
+
+from trajcontrol import log_loader
+from trajcontrol.log_writer import STREAMS, RECEIVE_COLUMNS, SNAPSHOT_HEADER, MANIFEST_EXTENSION
+from trajcontrol.log_columnar import EXTENSION
+
+########################################################################
+### Rebuild snapshot table from stream recording ###
+########################################################################
+
+# Function: load_stream
+# DO: Load one topic file written by SaveFile in stream mode
+#     (<topic>.csv, <topic>.csv.gz, <topic>.csv.zst, <topic>.col or rotated <topic>.manifest.json)
+# Inputs:
+#   folder: stream recording directory
+#   name: stream name
+#   n_columns: number of columns in the file (receive time + topic columns)
+# Output:
+#   time: receive time of each message (int64 nanoseconds)
+#   values: message values (one row per message)
+def load_stream(folder, name, n_columns):
+    filename = os.path.join(folder, name)
+    candidates = [filename + extension for extension in [MANIFEST_EXTENSION, EXTENSION, '.csv', '.csv.gz', '.csv.zst']]
+    path = next((path for path in candidates if os.path.exists(path)), None)
+    data = np.zeros((0, n_columns)) if path is None else log_loader.load(path, cache=False).data
+    if data.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, n_columns-2))
+    time = data[:,0].astype(np.int64)*1000000000 + data[:,1].astype(np.int64)
+    order = np.argsort(time, kind='stable')     # Writer queue keeps order, but be safe with merged files
+    return time[order], data[order,2:]
+
+# Function: as_of
+# DO: Latest message received at or before each query time (as-of join)
+# Inputs:
+#   time: sorted message receive times
+#   values: message values
+#   query: query times
+# Output:
+#   joined values (zeros before first message, like SaveFile initial values)
+#   age of the joined message at each query time in seconds (nan before first message)
+def as_of(time, values, query):
+    index = np.searchsorted(time, query, side='right') - 1
+    valid = index >= 0
+    joined = np.zeros((len(query), values.shape[1]))
+    joined[valid] = values[index[valid]]
+    age = np.full(len(query), np.nan)
+    age[valid] = (query[valid] - time[index[valid]])*1e-9
+    return joined, age
+
+# Function: join
+# DO: Build the wide snapshot table from a stream recording directory
+# Inputs:
+#   folder: directory with one <topic>.csv (or .col) file per stream
+#   period: snapshot period in seconds (used when base is None)
+#   base: stream name whose receive times define the rows (None = fixed period)
+#   with_age: append one '<stream> age' column per stream
+# Output:
+#   header: list of column names
+#   table: one row per snapshot
+def join(folder, period=0.2, base=None, with_age=False):
+    streams = {name: load_stream(folder, name, len(RECEIVE_COLUMNS + columns)) \
+        for name, columns in STREAMS.items()}
+
+    # Snapshot times
+    if base is not None:
+        query = streams[base][0]
+    else:
+        times = [time for time, _ in streams.values() if len(time) > 0]
+        if len(times) == 0:
+            query = np.zeros(0, dtype=np.int64)
+        else:
+            first = min(time[0] for time in times)
+            last = max(time[-1] for time in times)
+            query = np.arange(first, last+1, int(period*1e9), dtype=np.int64)
+
+    header = list(SNAPSHOT_HEADER)
+    blocks = [np.column_stack((query // 1000000000, query % 1000000000))]
+    ages = []
+    for name, (time, values) in streams.items():
+        joined, age = as_of(time, values, query)
+        blocks.append(joined)
+        ages.append(age)
+    if with_age:
+        header = header + [name + ' age' for name in STREAMS]
+        blocks.append(np.column_stack(ages))
+    return header, np.hstack(blocks)
+
+# Function: save_table
+# DO: Write wide table to csv (time columns as integers)
+def save_table(filename, header, table):
+    fmt = ['%d' if column.endswith('sec') else '%.17g' for column in header]
+    np.savetxt(filename, table, delimiter=',', fmt=fmt, header=','.join(header), comments='')
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Rebuild the SaveFile snapshot table from a stream mode recording')
+    parser.add_argument('folder', help='stream recording directory (data/<filename>)')
+    parser.add_argument('-o', '--output', default=None, help='output csv (default: <folder>.csv)')
+    parser.add_argument('--period', type=float, default=0.2, help='snapshot period in seconds')
+    parser.add_argument('--base', choices=list(STREAMS), default=None, help='one row per message of this stream instead of a fixed period')
+    parser.add_argument('--age', action='store_true', help='add the age (s) of each joined value')
+    options = parser.parse_args(args)
+
+    folder = os.path.normpath(options.folder)
+    output = options.output if options.output is not None else folder + '.csv'
+    header, table = join(folder, options.period, options.base, options.age)
+    save_table(output, header, table)
+    print('%d rows written to %s' % (table.shape[0], output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import os
+import re
+import io
+import glob
+import json
+import argparse
+import warnings
+import numpy as np
+
+from trajcontrol.log_columnar import ColumnarLog, EXTENSION
+from trajcontrol.log_writer import open_text, read_text, MANIFEST_EXTENSION
+
+CACHE_EXTENSION = '.npy'        # Parsed table cached at <name>.csv.npy
+
+# Header fixes for older SaveFile versions (column name: canonical name(s))
+HEADER_FIXES = {
+    'Aurora x': ['AuroraTip x'], 'Aurora y': ['AuroraTip y'], 'Aurora z': ['AuroraTip z'],
+    'Aurora qw': ['AuroraTip qw'], 'Aurora qx': ['AuroraTip qx'], 'Aurora qy': ['AuroraTip qy'], 'Aurora qz': ['AuroraTip qz'],
+    'Control_x': ['Control x'], 'Control_z': ['Control z'],
+    'Tip nanosec AuroraBase x': ['Tip nanosec', 'AuroraBase x'],    # Missing comma (97 column files)
+    'J66Control x': ['J66', 'Control x'],                           # Missing comma (entry stamp files)
+}
+
+# Entry point stamp written as the message repr (e.g. test_no_starv.csv), replaced by float seconds
+TIME_REPR = re.compile(r'"builtin_interfaces\.msg\.Time\(sec=(\d+), nanosec=(\d+)\)"')
+
+# Schema versions (detected from the canonical header)
+#   1: 77 columns, tip sensor only ('Aurora x')
+#   2: 84 columns, tip and base sensors (AuroraTip / AuroraBase)
+#   3: 85 columns, version 2 + entry point stamp
+#   4: 98 columns, sec/nanosec stamp of every source (current save_file.py)
+def schema_version(names):
+    if 'AuroraTip sec' in names:
+        return 4
+    if 'Entry_point stamp' in names:
+        return 3
+    if 'AuroraBase x' in names:
+        return 2
+    return 1
+
+########################################################################
+### Run log ###
+########################################################################
+
+# Function: canonical_header
+# DO: Fix known header problems of older logs
+# Inputs:
+#   header: header line
+# Output:
+#   list of canonical column names
+def canonical_header(header):
+    names = []
+    for name in header.rstrip('\r\n').split(','):
+        name = name.strip()
+        names.extend(HEADER_FIXES.get(name, [name]))
+    return names
+
+# Function: parse_csv
+# DO: Parse a SaveFile csv (any schema, plain or compressed) in one vectorized pass
+# Inputs:
+#   filename: csv file (.csv, .csv.gz or .csv.zst)
+# Output:
+#   names: canonical column names
+#   data: 2D float array (one row per line)
+def parse_csv(filename):
+    header, _, text = read_text(filename).partition('\n')
+    names = canonical_header(header)
+    if '"' in text:
+        text = TIME_REPR.sub(lambda m: '%s.%09d' % (m.group(1), int(m.group(2))), text)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')     # Header only files
+        try:
+            data = np.loadtxt(io.StringIO(text), delimiter=',', ndmin=2)
+        except ValueError:
+            # Broken lines (e.g. interrupted write): keep only complete rows
+            data = np.genfromtxt(io.StringIO(text), delimiter=',', invalid_raise=False, ndmin=2)
+    if data.size == 0:
+        data = np.zeros((0, len(names)))
+    if data.shape[1] != len(names):
+        raise ValueError('%s: header has %d columns, data has %d' % (filename, len(names), data.shape[1]))
+    return names, data
+
+# Class: TimeIndex
+# DO: Sorted time stamps (int64 nanoseconds) with binary search range queries
+class TimeIndex():
+
+    def __init__(self, stamp):
+        stamp = np.asarray(stamp, dtype=np.int64)
+        if np.all(stamp[1:] >= stamp[:-1]):
+            self.order = None                                   # Already sorted (usual case)
+            self.stamp = stamp
+        else:
+            self.order = np.argsort(stamp, kind='stable')
+            self.stamp = stamp[self.order]
+        self.start = self.stamp[0] if len(self.stamp) > 0 else 0
+
+    def __len__(self):
+        return len(self.stamp)
+
+    # Function: rows
+    # DO: Row indices with start <= stamp < stop (int64 nanoseconds)
+    def rows(self, start, stop):
+        i, j = np.searchsorted(self.stamp, [start, stop], side='left')
+        if self.order is None:
+            return np.arange(i, j)
+        return self.order[i:j]
+
+    # Function: between
+    # DO: Row indices between start and stop seconds after the first sample
+    def between(self, start, stop):
+        return self.rows(self.start + int(round(start*1e9)), self.start + int(round(stop*1e9)))
+
+    # Function: at
+    # DO: Row index of the latest sample at or before each stamp (-1 if none)
+    def at(self, stamp):
+        index = np.searchsorted(self.stamp, np.asarray(stamp, dtype=np.int64), side='right') - 1
+        if self.order is None:
+            return index
+        return np.where(index >= 0, self.order[np.maximum(index, 0)], -1)
+
+# Class: RunLog
+# DO: One recorded run with canonical column names, indexed by the snapshot time stamp
+class RunLog():
+
+    def __init__(self, names, data, filename=''):
+        self.filename = filename
+        self.names = list(names)
+        self.data = data
+        self.schema = schema_version(self.names)
+        self.columns = {name: i for i, name in enumerate(self.names)}
+        if ('Timestamp sec' not in self.columns) and ('Receive sec' not in self.columns):
+            raise ValueError('%s: no time stamp column' % (filename))
+        self.index = TimeIndex(self.stamp('Timestamp' if 'Timestamp sec' in self.columns else 'Receive'))   # Snapshot or stream log
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.data[:, self.columns[name]]
+
+    # Function: get
+    # DO: Several columns as a 2D array
+    def get(self, names):
+        return self.data[:, [self.columns[name] for name in names]]
+
+    # Function: stamp
+    # DO: Time stamp of a source in int64 nanoseconds ('Timestamp', 'AuroraTip', 'Tip', 'J', ...)
+    def stamp(self, source):
+        return self[source + ' sec'].astype(np.int64)*1000000000 + self[source + ' nanosec'].astype(np.int64)
+
+    # Function: time
+    # DO: Snapshot (or receive) time in seconds from the first row
+    def time(self):
+        return (self.stamp('Timestamp' if 'Timestamp sec' in self.columns else 'Receive') - self.index.start)*1e-9
+
+    # Function: between
+    # DO: Rows recorded between start and stop seconds after the first row
+    def between(self, start, stop):
+        return self.data[self.index.between(start, stop)]
+
+    # Function: samples
+    # DO: First row of each new reading of a source (snapshot rows repeat the last value received)
+    # Inputs:
+    #   prefix: source column prefix ('AuroraTip', 'Base', 'Entry_point', ...)
+    #   axes: value column suffixes
+    # Output:
+    #   rows: row index of each new reading (readings with all values zero are skipped)
+    #   stamp: reading stamp (int64 ns; source stamp when logged, snapshot time in older logs)
+    def samples(self, prefix, axes=(' x', ' y', ' z', ' qw', ' qx', ' qy', ' qz')):
+        value = self.get([prefix + axis for axis in axes])
+        if prefix + ' sec' in self.columns:
+            stamp = self.stamp(prefix)
+        elif prefix + ' stamp' in self.columns:
+            stamp = np.round(self[prefix + ' stamp']*1e9).astype(np.int64)
+        else:
+            stamp = self.stamp('Timestamp')                              # Older logs: snapshot time only
+        key = np.column_stack((value, stamp))
+        new = np.concatenate(([True], np.any(np.diff(key, axis=0) != 0, axis=1)))
+        rows = np.flatnonzero(new & np.any(value != 0, axis=1) & (stamp > 0))
+        return rows, stamp[rows]
+
+# Function: cache_name
+def cache_name(filename):
+    return filename + CACHE_EXTENSION
+
+# Function: load_manifest
+# DO: Load a rotated log (segments listed in <name>.manifest.json, evicted segments skipped)
+def load_manifest(filename, cache=True):
+    with open(filename) as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(filename)
+    names = canonical_header(','.join(manifest['header']))
+    tables = []
+    for segment in manifest['segments']:
+        path = os.path.join(folder, segment['file'])
+        if not os.path.exists(path):
+            continue                            # Evicted (disk budget)
+        try:
+            tables.append(load(path, cache and segment.get('closed') is not None).data)
+        except (ValueError, OSError):
+            if segment.get('closed') is not None:
+                raise                           # Only the segment being written may be incomplete
+    return RunLog(names, np.vstack(tables) if tables else np.zeros((0, len(names))), filename)
+
+# Function: load
+# DO: Load a run log (csv, compressed csv, columnar or rotated) with a parsed cache next to csv files
+# Inputs:
+#   filename: <name>.csv, <name>.csv.gz, <name>.csv.zst, <name>.col or <name>.manifest.json
+#   cache: use and refresh <name>.csv.npy (invalidated when the csv is newer)
+# Output:
+#   RunLog
+def load(filename, cache=True):
+    if filename.endswith(MANIFEST_EXTENSION):
+        return load_manifest(filename, cache)
+    if os.path.isdir(filename) and filename.rstrip(os.sep).endswith(EXTENSION):
+        log = ColumnarLog(filename)
+        return RunLog(canonical_header(','.join(log.columns)), log.table(), filename)
+
+    with open_text(filename) as f:
+        names = canonical_header(f.readline())
+    cached = cache_name(filename)
+    if cache and os.path.isfile(cached) and os.path.getmtime(cached) >= os.path.getmtime(filename):
+        data = np.load(cached, mmap_mode='r')
+        if data.ndim == 2 and data.shape[1] == len(names):
+            return RunLog(names, data, filename)
+    names, data = parse_csv(filename)
+    if cache:
+        try:
+            with open(cached + '.tmp', 'wb') as f:
+                np.save(f, data)
+            os.replace(cached + '.tmp', cached)     # Never leave a partial cache behind
+        except OSError:
+            pass                                # Read-only data folder: no cache
+    return RunLog(names, data, filename)
+
+# Function: load_all
+# DO: Load every run in a folder
+# Output:
+#   dictionary run name: RunLog (runs that cannot be parsed are skipped with a warning)
+def load_all(folder, pattern='*.csv', cache=True):
+    logs = {}
+    for filename in sorted(glob.glob(os.path.join(folder, pattern))):
+        try:
+            logs[os.path.splitext(os.path.basename(filename))[0]] = load(filename, cache)
+        except ValueError as e:
+            warnings.warn(str(e))
+    return logs
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Load SaveFile logs and print their schema, size and duration')
+    parser.add_argument('files', nargs='+', help='csv files or .col directories')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the csv text')
+    options = parser.parse_args(args)
+
+    print('%-40s %6s %6s %8s %10s' % ('run', 'schema', 'cols', 'rows', 'length [s]'))
+    for filename in options.files:
+        try:
+            log = load(filename, not options.no_cache)
+        except ValueError as e:
+            print('%-40s %s' % (os.path.basename(filename), e))
+            continue
+        length = log.time()[-1] if len(log) > 0 else 0.0
+        print('%-40s %6d %6d %8d %10.1f' % (os.path.basename(filename), log.schema, len(log.names), len(log), length))
+
+if __name__ == '__main__':
+    main()
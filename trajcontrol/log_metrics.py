@@ -0,0 +1,204 @@
+import os
+import json
+import glob
+import hashlib
+import argparse
+import warnings
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from trajcontrol import log_loader
+from trajcontrol.log_catalog import parse_gain, parse_kind, tracking
+from trajcontrol.control_law import CONTROL_LENGTH
+SETTLE_TOLERANCE = 1.0          # Lateral error band for settling time (mm)
+CACHE_FILE = 'metrics_cache.json'
+METRICS_VERSION = 1             # Increase when metric definitions change (invalidates cache)
+
+J_COLUMNS = ['J%d%d' % (i, j) for i in range(7) for j in range(7)]
+
+# Summary columns (name, print width, print format)
+SUMMARY = [
+    ('kind', 12, '%s'), ('gain', 5, '%g'), ('samples', 7, '%d'), ('commands', 8, '%d'), ('depth', 7, '%.1f'),
+    ('rms_x', 7, '%.2f'), ('rms_z', 7, '%.2f'), ('max_x', 7, '%.2f'), ('max_z', 7, '%.2f'), ('rms', 7, '%.2f'), ('max', 7, '%.2f'),
+    ('final_x', 7, '%.2f'), ('final_z', 7, '%.2f'), ('final', 7, '%.2f'), ('settle', 7, '%.1f'),
+    ('j_start', 8, '%.3f'), ('j_end', 8, '%.3f'), ('j_drift', 8, '%.3f'),
+]
+
+########################################################################
+### Run metrics ###
+########################################################################
+
+# Function: file_hash
+# DO: SHA1 of file contents (cache key, independent of file name and mtime)
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function: run_metrics
+# DO: Tracking, control and Jacobian metrics of one run log file
+# Inputs:
+#   filename: run log
+#   control_length: insertion depth where final error is taken (mm)
+#   tolerance: lateral error band for settling time (mm)
+# Output:
+#   dictionary of metrics (nan when not available) and Jacobian norm trajectory [[time, norm], ...]
+def run_metrics(filename, control_length=CONTROL_LENGTH, tolerance=SETTLE_TOLERANCE):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return runlog_metrics(log_loader.load(filename), name, control_length, tolerance)
+
+# Function: runlog_metrics
+# DO: Tracking, control and Jacobian metrics of a loaded run (recorded or simulated)
+# Inputs:
+#   log: RunLog
+#   name: run name (kind and gain are parsed from it)
+#   control_length, tolerance: as in run_metrics
+# Output:
+#   dictionary of metrics, as in run_metrics
+def runlog_metrics(log, name, control_length=CONTROL_LENGTH, tolerance=SETTLE_TOLERANCE):
+    metrics = {key: float('nan') for key, _, _ in SUMMARY}
+    metrics.update({'kind': parse_kind(name), 'gain': parse_gain(name), 'samples': len(log), 'commands': 0, 'j_norm': []})
+    if len(log) == 0:
+        return metrics
+    time = log.time()
+
+    control = log.get(['Control x', 'Control z'])
+    metrics['commands'] = int(np.count_nonzero(np.any(np.diff(control, axis=0) != 0, axis=1)))
+
+    # Tip deviation from entry point (x and z) along the insertion
+    rows, depth, error = tracking(log)
+    if rows.size > 0:
+        lateral = np.hypot(error[:,0], error[:,1])
+        metrics['depth'] = float(depth.max())
+        metrics['rms_x'], metrics['rms_z'] = np.sqrt(np.mean(error**2, axis=0)).tolist()
+        metrics['max_x'], metrics['max_z'] = np.abs(error).max(axis=0).tolist()
+        metrics['rms'] = float(np.sqrt(np.mean(lateral**2)))
+        metrics['max'] = float(lateral.max())
+        # Error when the insertion reaches CONTROL_LENGTH (controllers stop there)
+        reached = np.flatnonzero(depth >= control_length)
+        if reached.size > 0:
+            metrics['final_x'], metrics['final_z'] = error[reached[0]].tolist()
+            metrics['final'] = float(lateral[reached[0]])
+        # Time until lateral error stays inside tolerance
+        outside = np.flatnonzero(lateral > tolerance)
+        if outside.size == 0:
+            metrics['settle'] = 0.0
+        elif outside[-1] < len(lateral)-1:
+            metrics['settle'] = float(time[rows[outside[-1]+1]] - time[rows[0]])
+
+    # Jacobian Frobenius norm trajectory (estimator output)
+    if J_COLUMNS[0] in log:
+        J = log.get(J_COLUMNS)
+        valid = np.any(J != 0, axis=1)
+        if np.any(valid):
+            norm = np.linalg.norm(J[valid], axis=1)
+            metrics['j_start'] = float(norm[0])
+            metrics['j_end'] = float(norm[-1])
+            metrics['j_drift'] = float(np.abs(norm - norm[0]).max()/norm[0])
+            metrics['j_norm'] = np.column_stack((time[valid], norm)).tolist()
+    return metrics
+
+########################################################################
+### Batch report ###
+########################################################################
+
+# Function: batch_metrics
+# DO: Metrics of many runs, computed in parallel and cached by file hash
+# Inputs:
+#   files: list of run logs
+#   cache_file: json cache (None = no cache)
+#   workers: number of processes (None = cpu count)
+# Output:
+#   dictionary run name: metrics
+def batch_metrics(files, cache_file=None, control_length=CONTROL_LENGTH, tolerance=SETTLE_TOLERANCE, workers=None):
+    cache = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    options = '%d:%g:%g' % (METRICS_VERSION, control_length, tolerance)
+    keys = {filename: file_hash(filename) + ':' + options for filename in files}
+
+    missing = [filename for filename in files if keys[filename] not in cache]
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(filename, executor.submit(run_metrics, filename, control_length, tolerance)) for filename in missing]
+            for filename, future in futures:
+                try:
+                    cache[keys[filename]] = future.result()
+                except (ValueError, OSError) as e:
+                    print('Failed %s: %s' % (filename, e))
+        if cache_file is not None:
+            used = {key: cache[key] for key in keys.values() if key in cache}
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump(used, f)
+            os.replace(cache_file + '.tmp', cache_file)
+    return {os.path.splitext(os.path.basename(filename))[0]: cache[keys[filename]] for filename in files if keys[filename] in cache}
+
+# Function: format_row
+# DO: One line of the printed summary table
+def format_row(name, metrics):
+    fields = []
+    for key, width, fmt in SUMMARY:
+        value = metrics.get(key)
+        missing = value is None or (isinstance(value, float) and np.isnan(value))
+        fields.append(('-' if missing else fmt % value).rjust(width))
+    return '%-32s ' % (name) + ' '.join(fields)
+
+# Function: group_summary
+# DO: Mean metrics per group (kind or gain)
+def group_summary(results, group):
+    groups = {}
+    for metrics in results.values():
+        groups.setdefault(metrics[group], []).append(metrics)
+    names = [name for name, _, _ in SUMMARY if name not in ('kind', 'gain')]
+    summary = {}
+    for key, runs in sorted(groups.items(), key=lambda item: str(item[0])):
+        values = np.array([[run[name] for name in names] for run in runs], dtype=float)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')     # Metric not available in any run of the group
+            mean = dict(zip(names, np.nanmean(values, axis=0).tolist()))
+        mean.update({'kind': runs[0]['kind'] if group == 'kind' else 'mixed', 'gain': runs[0]['gain'] if group == 'gain' else None})
+        summary['%s=%s (%d)' % (group, key, len(runs))] = mean
+    return summary
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Tracking, control and Jacobian metrics of recorded runs')
+    parser.add_argument('files', nargs='*', help='run logs (default: every csv in --folder)')
+    parser.add_argument('--folder', default=os.path.join('src', 'trajcontrol', 'data'), help='data folder')
+    parser.add_argument('--control-length', type=float, default=CONTROL_LENGTH, help='insertion depth of final error (mm)')
+    parser.add_argument('--tolerance', type=float, default=SETTLE_TOLERANCE, help='lateral error band for settling time (mm)')
+    parser.add_argument('--group', choices=['kind', 'gain'], default=None, help='also print mean metrics per group')
+    parser.add_argument('--output', default=None, help='write summary table to csv')
+    parser.add_argument('--trajectories', default=None, help='folder for <run>_jnorm.csv Jacobian norm trajectories')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every run')
+    options = parser.parse_args(args)
+
+    files = options.files if options.files else sorted(glob.glob(os.path.join(options.folder, '*.csv')))
+    cache_file = None if options.no_cache else os.path.join(options.folder, CACHE_FILE)
+    results = batch_metrics(files, cache_file, options.control_length, options.tolerance, options.workers)
+
+    print('%-32s ' % ('run') + ' '.join(key.rjust(width) for key, width, _ in SUMMARY))
+    for name, metrics in results.items():
+        print(format_row(name, metrics))
+    if options.group is not None:
+        print()
+        for name, metrics in group_summary(results, options.group).items():
+            print(format_row(name, metrics))
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            f.write(','.join(['run'] + [key for key, _, _ in SUMMARY]) + '\n')
+            for name, metrics in results.items():
+                f.write(','.join([name] + ['' if metrics[key] is None else str(metrics[key]) for key, _, _ in SUMMARY]) + '\n')
+    if options.trajectories is not None:
+        os.makedirs(options.trajectories, exist_ok=True)
+        for name, metrics in results.items():
+            if metrics['j_norm']:
+                np.savetxt(os.path.join(options.trajectories, name + '_jnorm.csv'), np.array(metrics['j_norm']), \
+                    delimiter=',', header='time,J norm', comments='')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import os
+import time
+import rclpy
+import numpy as np
+
+from rclpy.node import Node
+from rclpy.duration import Duration
+from rclpy.qos import QoSProfile, ReliabilityPolicy
+from ros2_igtl_bridge.msg import Transform
+from geometry_msgs.msg import PoseStamped
+from rosgraph_msgs.msg import Clock
+from std_msgs.msg import Float64, Header
+from trajcontrol import log_loader
+from trajcontrol.log_join import load_stream
+from trajcontrol.log_writer import STREAMS, RECEIVE_COLUMNS
+from trajcontrol.sim_clock import ACK_TOPIC
+
+# Replayed sources: (stream name, log column prefix, number of values, ROS output)
+SOURCES = [
+    ('aurora_tip', 'AuroraTip', 7, 'NeedleToTracker'),     # IGTL_TRANSFORM_IN (name adjusted in Plus .xml)
+    ('aurora_base', 'AuroraBase', 7, 'BaseToTracker'),     # IGTL_TRANSFORM_IN
+    ('base', 'Base', 7, '/stage/state/needle_pose'),
+    ('entry_point', 'Entry_point', 3, '/subject/state/skin_entry'),
+]
+POSE = [' x', ' y', ' z', ' qw', ' qx', ' qy', ' qz']
+SUBSCRIBER_DEPTH = 10       # Queue depth of the subscribers of the replayed topics (max_rate: most messages published per step)
+REPLAY_DEPTH = 100          # Reliable publisher history (max_rate)
+
+########################################################################
+### Replay events ###
+########################################################################
+
+# Class: ReplayEvents
+# DO: Messages of a recorded run merged in one time ordered list
+#     time: replay time of each message (int64 ns), stamp: original header stamp (int64 ns)
+#     source: index in SOURCES, values: message values (7 columns, zero padded)
+class ReplayEvents():
+
+    def __init__(self, time, stamp, source, values):
+        order = np.lexsort((source, time))     # Deterministic order for simultaneous messages
+        self.time = time[order]
+        self.stamp = stamp[order]
+        self.source = source[order]
+        self.values = values[order]
+
+    def __len__(self):
+        return len(self.time)
+
+    # Function: from_log
+    # DO: Events from a snapshot log (any schema): one message per new sample of each source
+    @classmethod
+    def from_log(cls, log):
+        times, stamps, sources, values = [], [], [], []
+        for i, (_, prefix, n, _) in enumerate(SOURCES):
+            names = [prefix + axis for axis in POSE[:n]]
+            if names[0] not in log:
+                continue
+            rows, stamp = log.samples(prefix, POSE[:n])
+            times.append(stamp)
+            stamps.append(stamp)
+            sources.append(np.full(len(rows), i, dtype=np.int8))
+            values.append(np.pad(log.get(names)[rows], ((0, 0), (0, 7-n))))
+        return cls(np.concatenate(times), np.concatenate(stamps), np.concatenate(sources), np.concatenate(values))
+
+    # Function: from_streams
+    # DO: Events from a stream mode recording (every message, replayed at its receive time)
+    @classmethod
+    def from_streams(cls, folder):
+        times, stamps, sources, values = [], [], [], []
+        for i, (name, _, n, _) in enumerate(SOURCES):
+            time, data = load_stream(folder, name, len(RECEIVE_COLUMNS + STREAMS[name]))
+            times.append(time)
+            stamps.append(data[:,n].astype(np.int64)*1000000000 + data[:,n+1].astype(np.int64))
+            sources.append(np.full(len(time), i, dtype=np.int8))
+            values.append(np.pad(data[:,:n], ((0, 0), (0, 7-n))))
+        return cls(np.concatenate(times), np.concatenate(stamps), np.concatenate(sources), np.concatenate(values))
+
+    # Function: load
+    # DO: Events from <name>.csv / <name>.col (snapshot) or <name>/ (stream mode directory)
+    @classmethod
+    def load(cls, filename):
+        if os.path.isdir(filename) and not filename.rstrip(os.sep).endswith('.col'):
+            return cls.from_streams(filename)
+        return cls.from_log(log_loader.load(filename))
+
+########################################################################
+### Replay node ###
+########################################################################
+
+class LogReplay(Node):
+
+    def __init__(self):
+        super().__init__('log_replay')
+
+        #Declare node parameters
+        self.declare_parameter('filename', 'my_data')   #Recorded run in data folder (<name>.csv, <name>.col or stream directory <name>)
+        self.declare_parameter('speed', 1.0)            #Replay speed factor (real-time mode)
+        self.declare_parameter('max_rate', False)       #Replay as fast as possible, driving /clock with the recorded time
+        self.declare_parameter('step', 0.02)            #Clock step in max_rate mode (s, recorded time)
+        self.declare_parameter('max_wait', 0.5)         #Maximum wait for delivery and node acknowledgements in max_rate mode (s, wall time)
+        self.declare_parameter('start', 0.0)            #Replay start (seconds from beginning of run)
+        self.declare_parameter('stop', 0.0)             #Replay stop (seconds from beginning of run, 0 = end)
+        self.declare_parameter('publish_clock', False)  #Publish recorded time on /clock (always on in max_rate mode)
+        self.declare_parameter('publish_entry', True)   #Republish /subject/state/skin_entry (off when SensorProcessing defines it)
+
+        self.speed = self.get_parameter('speed').get_parameter_value().double_value
+        self.max_rate = self.get_parameter('max_rate').get_parameter_value().bool_value
+        self.publish_clock = self.max_rate or self.get_parameter('publish_clock').get_parameter_value().bool_value
+        publish_entry = self.get_parameter('publish_entry').get_parameter_value().bool_value
+        self.step = int(self.get_parameter('step').get_parameter_value().double_value*1e9)
+        self.max_wait = self.get_parameter('max_wait').get_parameter_value().double_value
+
+        #Load run
+        name = self.get_parameter('filename').get_parameter_value().string_value
+        folder = os.path.join(os.getcwd(),'src','trajcontrol','data')
+        filename = next((path for path in [os.path.join(folder, name + '.csv'), os.path.join(folder, name + '.col'), \
+            os.path.join(folder, name), name] if os.path.exists(path)), None)
+        if filename is None:
+            raise FileNotFoundError('Run %s not found in %s' % (name, folder))
+        self.events = ReplayEvents.load(filename)
+        if not publish_entry:
+            keep = self.events.source != 3
+            self.events = ReplayEvents(self.events.time[keep], self.events.stamp[keep], self.events.source[keep], self.events.values[keep])
+        self.origin = self.events.time[0] if len(self.events) > 0 else 0
+        stop = self.get_parameter('stop').get_parameter_value().double_value
+        self.end = len(self.events) if stop <= 0 else int(np.searchsorted(self.events.time, self.origin + int(stop*1e9), side='right'))
+
+        #Published topics (max_rate: reliable with a longer history, every step waits for delivery)
+        qos = QoSProfile(depth=REPLAY_DEPTH, reliability=ReliabilityPolicy.RELIABLE) if self.max_rate else 10
+        self.publisher_aurora = self.create_publisher(Transform, 'IGTL_TRANSFORM_IN', qos)
+        self.publisher_needle_pose = self.create_publisher(PoseStamped, '/stage/state/needle_pose', qos)
+        self.publisher_entry_point = self.create_publisher(PoseStamped, '/subject/state/skin_entry', qos)
+        self.publisher_clock = self.create_publisher(Clock, '/clock', 10)
+        self.publishers_source = [self.publisher_aurora, self.publisher_aurora, self.publisher_needle_pose, self.publisher_entry_point]
+
+        #Step acknowledgements of the nodes under test (max_rate, see sim_clock StepAck)
+        self.due = {}
+        self.late = 0               # Steps advanced by max_wait while a node had not acknowledged
+        self.unconfirmed = 0        # Messages not acknowledged by every subscriber or sent to a late node (possibly dropped)
+        self.step_messages = 0      # Messages published in the last step
+        if self.max_rate:
+            self.subscription_ack = self.create_subscription(Header, ACK_TOPIC, self.ack_callback, 100)
+            self.subscription_ack # prevent unused variable warning
+
+        #Seek command (seconds from beginning of run)
+        self.subscription_seek = self.create_subscription(Float64, '/replay/seek', self.seek_callback, 10)
+        self.subscription_seek # prevent unused variable warning
+
+        self.get_logger().info('Replaying %s: %d messages, %.1f s at %s' % (filename, len(self.events), \
+            (self.events.time[self.end-1]-self.origin)*1e-9 if self.end > 0 else 0.0, 'max rate' if self.max_rate else '%gx speed' % (self.speed)))
+        self.seek(self.get_parameter('start').get_parameter_value().double_value)
+        timer_period = 0.0002 if self.max_rate else 0.001 # seconds
+        self.timer = self.create_timer(timer_period, self.timer_replay_callback)
+
+    # Move replay position (and republish the last entry point before it)
+    def seek(self, position):
+        self.k = int(np.searchsorted(self.events.time, self.origin + int(position*1e9), side='left'))
+        self.log_time = self.origin + int(position*1e9)     # Recorded time at wall_time
+        self.wall_time = time.monotonic()
+        self.now = self.log_time - 1                        # Last recorded time published on /clock (max_rate)
+        self.step_wall = self.wall_time                     # Wall time of the last step (max_rate)
+        entry = np.flatnonzero(self.events.source[:self.k] == 3)
+        if entry.size > 0:
+            self.publish_event(entry[-1])
+
+    def seek_callback(self, msg):
+        self.get_logger().info('Seek to %.3f s' % (msg.data))
+        self.seek(msg.data)
+        if self.timer.is_canceled():
+            self.timer.reset()
+
+    def ack_callback(self, msg):
+        self.due[msg.frame_id] = msg.stamp.sec*1000000000 + msg.stamp.nanosec
+
+    # Publish every message up to current replay time
+    def timer_replay_callback(self):
+        if self.max_rate:
+            self.step_replay()
+            return
+        if self.k >= self.end:
+            self.get_logger().info('Replay finished')
+            self.timer.cancel()
+            return
+        now = self.log_time + int((time.monotonic() - self.wall_time)*self.speed*1e9)
+        j = min(int(np.searchsorted(self.events.time, now, side='right')), self.end)
+        if self.publish_clock:
+            msg = Clock()
+            msg.clock.sec = int(now // 1000000000)
+            msg.clock.nanosec = int(now % 1000000000)
+            self.publisher_clock.publish(msg)
+        for i in range(self.k, j):
+            self.publish_event(i)
+        self.k = max(j, self.k)
+
+    # Max rate: advance the recorded time one step once the nodes under test are done with the previous one
+    #   - messages of a step are confirmed delivered to every subscriber (reliable QoS)
+    #   - at most SUBSCRIBER_DEPTH messages per step, so that a subscriber queue cannot overflow within one step
+    #   - StepAck nodes due at the current time have acknowledged it (or max_wait passed: the step counts as late)
+    def step_replay(self):
+        late = [name for name, due in self.due.items() if due <= self.now]
+        if late:
+            if time.monotonic() - self.step_wall < self.max_wait:
+                return                          # Nodes still working on this step
+            self.late += 1
+            self.unconfirmed += self.step_messages
+            self.get_logger().info('No acknowledgement from %s after %.2f s: %d messages possibly dropped, not waited for until it answers again' % \
+                (', '.join(late), self.max_wait, self.step_messages))
+            for name in late:
+                del self.due[name]              # Stopped or stuck node
+        if self.k >= self.end:
+            self.get_logger().info('Replay finished: %d messages, %d possibly dropped (%d late steps)' % \
+                (self.end, self.unconfirmed, self.late))
+            self.timer.cancel()
+            return
+
+        now = self.now + self.step
+        j = min(int(np.searchsorted(self.events.time, now, side='right')), self.end)
+        if j - self.k > SUBSCRIBER_DEPTH:
+            j = self.k + SUBSCRIBER_DEPTH
+            now = max(self.events.time[j-1], self.now)
+        msg = Clock()
+        msg.clock.sec = int(now // 1000000000)
+        msg.clock.nanosec = int(now % 1000000000)
+        self.publisher_clock.publish(msg)
+        for i in range(self.k, j):
+            self.publish_event(i)
+
+        # Wait for delivery to every subscriber
+        counts = np.bincount(self.events.source[self.k:j], minlength=len(SOURCES))
+        for publisher in set(self.publishers_source[i] for i in np.flatnonzero(counts)):
+            if not publisher.wait_for_all_acked(Duration(nanoseconds=int(self.max_wait*1e9))):
+                unacked = sum(counts[i] for i in range(len(SOURCES)) if self.publishers_source[i] is publisher)
+                self.unconfirmed += int(unacked)
+                self.get_logger().info('%s: %d messages not acknowledged by every subscriber after %.2f s' % \
+                    (publisher.topic_name, unacked, self.max_wait))
+        self.step_messages = j - self.k
+        self.step_wall = time.monotonic()
+        self.now = now
+        self.k = j
+
+    # Publish one recorded message with its original stamp
+    def publish_event(self, i):
+        source = self.events.source[i]
+        value = self.events.values[i]
+        if source <= 1:
+            msg = Transform()
+            msg.name = SOURCES[source][3]
+            msg.transform.translation.x = float(value[0])
+            msg.transform.translation.y = float(value[1])
+            msg.transform.translation.z = float(value[2])
+            msg.transform.rotation.w = float(value[3])
+            msg.transform.rotation.x = float(value[4])
+            msg.transform.rotation.y = float(value[5])
+            msg.transform.rotation.z = float(value[6])
+            self.publisher_aurora.publish(msg)
+        else:
+            msg = PoseStamped()
+            msg.header.stamp.sec = int(self.events.stamp[i] // 1000000000)
+            msg.header.stamp.nanosec = int(self.events.stamp[i] % 1000000000)
+            msg.header.frame_id = 'stage'
+            msg.pose.position.x = float(value[0])
+            msg.pose.position.y = float(value[1])
+            msg.pose.position.z = float(value[2])
+            if source == 2:
+                msg.pose.orientation.w = float(value[3])
+                msg.pose.orientation.x = float(value[4])
+                msg.pose.orientation.y = float(value[5])
+                msg.pose.orientation.z = float(value[6])
+                self.publisher_needle_pose.publish(msg)
+            else:
+                self.publisher_entry_point.publish(msg)
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    log_replay = LogReplay()
+
+    rclpy.spin(log_replay)
+
+    # Destroy the node explicitly
+    # (optional - otherwise it will be done automatically
+    # when the garbage collector destroys the node object)
+    log_replay.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import os
+import glob
+import json
+import argparse
+import warnings
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from trajcontrol import log_loader
+from trajcontrol.log_join import save_table
+from trajcontrol.log_writer import MANIFEST_EXTENSION
+from trajcontrol.pose_filter import causal_median, pose_transform, FILTER_WINDOW, FILTER_SIZE
+
+DIST_NEEDLE_BASE = 30.9         # Base sensor offset along z (same as sensor_processing)
+AURORA_RATE = 40.0              # Aurora frame rate seen by the live filter (Hz, virtual_aurora default)
+DECIMATED = 0.5                 # Logs with readings slower than DECIMATED*aurora_rate are decimated (snapshot logs: 5 Hz)
+FILTERS = ('median', 'none')
+SUFFIX = '_reprocessed'
+RUN_EXTENSIONS = (MANIFEST_EXTENSION, '.csv.gz', '.csv.zst', '.csv', '.col')
+
+POSE = [' x', ' y', ' z', ' qw', ' qx', ' qy', ' qz']
+
+# Reprocessed sources: (raw Aurora prefix, output prefix, z offset)
+#   Tip: /sensor/tip_filtered (logged as Tip)
+#   SensorBase: /sensor/base_filtered (not logged live, the Base columns hold the stage pose)
+SOURCES = [
+    ('AuroraTip', 'Tip', 0.0),
+    ('AuroraBase', 'SensorBase', DIST_NEEDLE_BASE),
+]
+
+########################################################################
+### Sensor processing ###
+########################################################################
+
+# Function: filter_scale
+# DO: Filter window and size in logged readings covering the same time as the live filter over the Aurora stream
+#     Snapshot logs keep one reading every 0.2 s: the live 40 sample median (~1 s at 40 Hz) becomes ~5 readings
+# Inputs:
+#   stamp: reading stamps (int64 ns)
+#   window, size: live filter configuration (Aurora readings)
+#   aurora_rate: live Aurora rate (Hz, 0 = no scaling)
+# Output:
+#   window, size (scaled when the readings are decimated), logged reading rate (Hz, nan when unknown)
+def filter_scale(stamp, window=FILTER_WINDOW, size=FILTER_SIZE, aurora_rate=AURORA_RATE):
+    period = np.median(np.diff(stamp))*1e-9 if len(stamp) > 1 else float('nan')
+    rate = 1.0/period if period > 0 else float('nan')
+    if (aurora_rate > 0) and (rate < DECIMATED*aurora_rate):
+        scale = rate/aurora_rate
+        size = max(int(round(size*scale)), 1)
+        window = max(int(round(window*scale)), size)
+    return window, size, rate
+
+# Function: filter_source
+# DO: Filter and transform the readings of one Aurora sensor as SensorProcessing does, for the whole run at once
+#     Decimated logs (snapshot mode) get the filter scaled to the same time span, with a warning
+#     (stream mode recordings keep every reading and are filtered exactly as live)
+# Inputs:
+#   log: RunLog
+#   prefix: raw Aurora column prefix
+#   registration: transform from Aurora to stage frame ([x, y, z, qw, qx, qy, qz])
+#   filter: 'median' (live filter) or 'none'
+#   window, size: live filter configuration
+#   aurora_rate: live Aurora rate (Hz, 0 = filter the logged readings as they are)
+# Output:
+#   rows: row index of each Aurora reading
+#   stamp: reading stamps (int64 ns)
+#   poses: filtered readings in stage frame (one row per reading)
+def filter_source(log, prefix, registration, filter='median', window=FILTER_WINDOW, size=FILTER_SIZE, aurora_rate=AURORA_RATE):
+    rows, stamp = log.samples(prefix)
+    readings = log.get([prefix + axis for axis in POSE])[rows]
+    if filter == 'median':
+        scaled_window, scaled_size, rate = filter_scale(stamp, window, size, aurora_rate)
+        if scaled_size != size:
+            warnings.warn('%s: %s readings at %.1f Hz (decimated log, Aurora %.0f Hz): median filter scaled to size %d, window %d' % \
+                (os.path.basename(log.filename), prefix, rate, aurora_rate, scaled_size, scaled_window))
+        readings = causal_median(readings, scaled_window, scaled_size)
+    return rows, stamp, pose_transform(readings, registration)
+
+# Function: reprocess
+# DO: Recompute the sensor columns of a log with a new registration and filter configuration
+#     Tip columns are replaced; SensorBase columns (filtered base in stage frame) are appended when the base sensor was logged
+#     Every row gets the output for the latest reading at or before it
+# Inputs:
+#   log: RunLog
+#   registration: transform from Aurora to stage frame ([x, y, z, qw, qx, qy, qz])
+# Output:
+#   header: list of column names
+#   table: derived log (one row per input row)
+def reprocess(log, registration, filter='median', window=FILTER_WINDOW, size=FILTER_SIZE, aurora_rate=AURORA_RATE):
+    if filter not in FILTERS:
+        raise ValueError('filter must be one of %s' % (FILTERS,))
+    header = list(log.names)
+    table = np.array(log.data, dtype=float)
+    for raw, prefix, offset in SOURCES:
+        if raw + ' x' not in log:
+            continue
+        rows, stamp, poses = filter_source(log, raw, registration, filter, window, size, aurora_rate)
+        poses[:,2] -= offset
+        # Row 0 of the padded arrays: zeros before the first reading (like SaveFile initial values)
+        latest = np.searchsorted(rows, np.arange(len(log)), side='right')
+        values = np.vstack((np.zeros((1, 7)), poses))[latest]
+        stamps = np.concatenate(([0], stamp))[latest]
+        columns = [prefix + axis for axis in POSE]
+        if (prefix + ' sec' in log) or (prefix + ' x' not in log):     # Stamp of the reading (schema 4 and new columns)
+            columns += [prefix + ' sec', prefix + ' nanosec']
+            values = np.column_stack((values, stamps // 1000000000, stamps % 1000000000))
+        for column, value in zip(columns, values.T):
+            if column in log:
+                table[:, log.columns[column]] = value
+            else:
+                header.append(column)
+                table = np.column_stack((table, value))
+    return header, table
+
+########################################################################
+### Batch ###
+########################################################################
+
+# Function: run_name
+# DO: Run name without log extension
+def run_name(filename):
+    name = os.path.basename(filename.rstrip(os.sep))
+    for extension in RUN_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+# Function: reprocess_file
+# DO: Reprocess one log and write <output folder>/<run>_reprocessed.csv with a .json note of the configuration
+# Output:
+#   derived log file name
+def reprocess_file(filename, registration, filter='median', window=FILTER_WINDOW, size=FILTER_SIZE, folder=None, suffix=SUFFIX, \
+        aurora_rate=AURORA_RATE):
+    log = log_loader.load(filename, cache=False)
+    header, table = reprocess(log, registration, filter, window, size, aurora_rate)
+    folder = os.path.dirname(os.path.abspath(filename)) if folder is None else folder
+    output = os.path.join(folder, run_name(filename) + suffix + '.csv')
+    save_table(output + '.tmp', header, table)
+    os.replace(output + '.tmp', output)
+    with open(os.path.splitext(output)[0] + '.json', 'w') as f:
+        json.dump({'source': os.path.abspath(filename), 'registration': [float(value) for value in registration], \
+            'filter': filter, 'window': window, 'size': size, 'aurora_rate': aurora_rate}, f, indent=1)
+    return output
+
+# Function: reprocess_files
+# DO: Reprocess many logs in parallel
+# Output:
+#   list of derived log files, list of (file, error) that failed
+def reprocess_files(files, registration, filter='median', window=FILTER_WINDOW, size=FILTER_SIZE, folder=None, suffix=SUFFIX, workers=None, \
+        aurora_rate=AURORA_RATE):
+    outputs, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(filename, executor.submit(reprocess_file, filename, registration, filter, window, size, folder, suffix, aurora_rate)) for filename in files]
+        for filename, future in futures:
+            try:
+                outputs.append(future.result())
+            except (ValueError, OSError) as e:
+                failed.append((filename, str(e)))
+    return outputs, failed
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Recompute the sensor columns of recorded runs with a new registration and filter')
+    parser.add_argument('files', nargs='*', help='run logs (default: every csv in --folder)')
+    parser.add_argument('--folder', default=os.path.join('src', 'trajcontrol', 'data'), help='data folder')
+    parser.add_argument('--registration', default=os.path.join('src', 'trajcontrol', 'files', 'registration.csv'), help='registration file (x, y, z, qw, qx, qy, qz)')
+    parser.add_argument('--transform', type=float, nargs=7, default=None, metavar='V', help='registration values x y z qw qx qy qz (instead of file)')
+    parser.add_argument('--filter', choices=FILTERS, default='median', help='sensor filter')
+    parser.add_argument('--window', type=int, default=FILTER_WINDOW, help='number of last readings used by the filter')
+    parser.add_argument('--size', type=int, default=FILTER_SIZE, help='median filter size (samples)')
+    parser.add_argument('--aurora-rate', type=float, default=AURORA_RATE, help='live Aurora rate (Hz): window and size are scaled for decimated (snapshot) logs, 0 = no scaling')
+    parser.add_argument('-o', '--output', default=None, help='output folder (default: next to each log)')
+    parser.add_argument('--suffix', default=SUFFIX, help='derived log name suffix')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    options = parser.parse_args(args)
+
+    registration = np.array(options.transform) if options.transform is not None else np.loadtxt(options.registration, delimiter=',')
+    files = options.files if options.files else sorted(path for path in glob.glob(os.path.join(options.folder, '*.csv')) \
+        if not run_name(path).endswith(options.suffix))
+    if options.output is not None:
+        os.makedirs(options.output, exist_ok=True)
+    outputs, failed = reprocess_files(files, registration, options.filter, options.window, options.size, options.output, options.suffix, options.workers, \
+        options.aurora_rate)
+    print('%d runs reprocessed' % (len(outputs)))
+    for filename, error in failed:
+        print('Failed %s: %s' % (filename, error))
+
+if __name__ == '__main__':
+    main()
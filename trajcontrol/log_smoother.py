@@ -0,0 +1,194 @@
+import os
+import glob
+import json
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from scipy.linalg import solveh_banded
+from trajcontrol import log_loader
+from trajcontrol.log_catalog import despike
+from trajcontrol.log_join import save_table
+from trajcontrol.log_reprocess import SOURCES, POSE, run_name
+from trajcontrol.pose_filter import pose_transform
+
+SUFFIX = '_smoothed'
+DT_MIN = 1e-3                   # Minimum time between readings (s), readings with equal stamps are kept apart by DT_MIN
+
+# Noise models (white noise acceleration spectral density, measurement variance, initial velocity variance)
+POSITION_NOISE = (10.0, 0.25, 100.0)        # mm^2/s^3, mm^2, (mm/s)^2
+ROTATION_NOISE = (1e-3, 1e-5, 1e-2)         # quaternion components: 1/s^3, 1, 1/s^2
+
+VELOCITY = [' vx', ' vy', ' vz']
+
+########################################################################
+### RTS smoother ###
+########################################################################
+
+# Function: rts_smooth
+# DO: Fixed-interval (Rauch-Tung-Striebel) smoother with a constant velocity model, for several independent signals at once
+#     The smoothed means are the solution of the batch least squares problem over the whole run
+#     (measurement, process and prior terms), a block tridiagonal system solved with a banded Cholesky in O(N)
+# Inputs:
+#   time: reading times in seconds (numpy array N, increasing)
+#   values: readings (numpy array NxC, one column per signal)
+#   q: white noise acceleration spectral density
+#   r: measurement noise variance
+#   v0: prior variance of the initial velocity (prior mean zero)
+# Output:
+#   position: smoothed signals (numpy array NxC)
+#   velocity: smoothed rates (numpy array NxC)
+def rts_smooth(time, values, q, r, v0):
+    values = np.asarray(values, dtype=float)
+    n = values.shape[0]
+    if n < 2:
+        return values.copy(), np.zeros_like(values)
+    dt = np.maximum(np.diff(np.asarray(time, dtype=float)), DT_MIN)
+
+    # State [p0, v0, p1, v1, ...]; process residual x_k - F x_(k-1) = D_k [p_(k-1), v_(k-1), p_k, v_k]
+    D = np.zeros((n-1, 2, 4))
+    D[:,0,0] = -1.0
+    D[:,0,1] = -dt
+    D[:,0,2] = 1.0
+    D[:,1,1] = -1.0
+    D[:,1,3] = 1.0
+    W = np.empty((n-1, 2, 2))                   # Inverse process covariance
+    W[:,0,0] = 12.0/dt**3
+    W[:,0,1] = W[:,1,0] = -6.0/dt**2
+    W[:,1,1] = 4.0/dt
+    blocks = np.einsum('kai,kab,kbj->kij', D, W/q, D)
+
+    # Upper banded storage (3 super diagonals) of the information matrix
+    ab = np.zeros((4, 2*n))
+    i, j = np.triu_indices(4)
+    k = np.arange(n-1)[:,None]
+    np.add.at(ab, (3 + i - j, 2*k + j), blocks[:, i, j])
+    ab[3, 0::2] += 1.0/r                        # Measurements of position
+    ab[3, 1] += 1.0/v0                          # Initial velocity prior
+
+    b = np.zeros((2*n, values.shape[1]))
+    b[0::2] = values/r
+    x = solveh_banded(ab, b)
+    return x[0::2], x[1::2]
+
+# Function: smooth_poses
+# DO: Smooth Aurora readings (position and orientation), quaternion sign kept continuous and result normalized
+# Inputs:
+#   time: reading times in seconds
+#   readings: Aurora readings (numpy array Nx7)
+# Output:
+#   poses: smoothed poses (numpy array Nx7)
+#   velocity: smoothed linear velocity (numpy array Nx3)
+def smooth_poses(time, readings, position_noise=POSITION_NOISE, rotation_noise=ROTATION_NOISE, spike_window=0):
+    readings = np.array(readings, dtype=float)
+    if spike_window > 1:
+        for column in range(7):
+            readings[:,column] = despike(readings[:,column], spike_window)
+    # q and -q are the same rotation: flip signs so consecutive quaternions are on the same side
+    flip = np.sum(readings[1:,3:7]*readings[:-1,3:7], axis=1) < 0
+    sign = np.concatenate(([1.0], np.where(np.cumsum(flip) % 2 == 1, -1.0, 1.0)))
+    readings[:,3:7] *= sign[:,None]
+
+    position, velocity = rts_smooth(time, readings[:,0:3], *position_noise)
+    rotation, _ = rts_smooth(time, readings[:,3:7], *rotation_noise)
+    rotation /= np.linalg.norm(rotation, axis=1)[:,None]
+    return np.column_stack((position, rotation)), velocity
+
+########################################################################
+### Logs ###
+########################################################################
+
+# Function: smooth_log
+# DO: Append smoothed pose and velocity of each Aurora sensor (stage frame) to a log
+#     Columns Smooth<source> x..qz, vx, vy, vz (Tip: from AuroraTip, SensorBase: from AuroraBase),
+#     every row gets the smoothed state of the latest reading at or before it
+# Inputs:
+#   log: RunLog
+#   registration: transform from Aurora to stage frame ([x, y, z, qw, qx, qy, qz], None = Aurora frame)
+# Output:
+#   header: list of column names
+#   table: derived log (one row per input row)
+def smooth_log(log, registration=None, position_noise=POSITION_NOISE, rotation_noise=ROTATION_NOISE, spike_window=0):
+    header = list(log.names)
+    columns = [log.data]
+    for raw, prefix, offset in SOURCES:
+        if raw + ' x' not in log:
+            continue
+        rows, stamp = log.samples(raw)
+        readings = log.get([raw + axis for axis in POSE])[rows]
+        valid = np.all(np.isfinite(readings), axis=1)
+        rows, stamp, readings = rows[valid], stamp[valid], readings[valid]
+        poses, velocity = smooth_poses((stamp - stamp[0])*1e-9 if len(stamp) > 0 else stamp, readings, \
+            position_noise, rotation_noise, spike_window)
+        if registration is not None:
+            poses = pose_transform(poses, registration)
+            poses[:,2] -= offset
+            velocity = pose_transform(np.column_stack((velocity, np.tile([1.0, 0, 0, 0], (len(velocity), 1)))), \
+                np.concatenate(([0, 0, 0], registration[3:7])))[:,0:3]
+        # Row 0 of the padded values: zeros before the first reading (like SaveFile initial values)
+        latest = np.searchsorted(rows, np.arange(len(log)), side='right')
+        columns.append(np.vstack((np.zeros((1, 10)), np.column_stack((poses, velocity))))[latest])
+        header.extend('Smooth' + prefix + axis for axis in POSE + VELOCITY)
+    return header, np.column_stack(columns)
+
+# Function: smooth_file
+# DO: Smooth one log and write <output folder>/<run>_smoothed.csv with a .json note of the configuration
+# Output:
+#   derived log file name
+def smooth_file(filename, registration=None, position_noise=POSITION_NOISE, rotation_noise=ROTATION_NOISE, spike_window=0, folder=None, suffix=SUFFIX):
+    log = log_loader.load(filename, cache=False)
+    header, table = smooth_log(log, registration, position_noise, rotation_noise, spike_window)
+    folder = os.path.dirname(os.path.abspath(filename)) if folder is None else folder
+    output = os.path.join(folder, run_name(filename) + suffix + '.csv')
+    save_table(output + '.tmp', header, table)
+    os.replace(output + '.tmp', output)
+    with open(os.path.splitext(output)[0] + '.json', 'w') as f:
+        json.dump({'source': os.path.abspath(filename), 'registration': None if registration is None else [float(value) for value in registration], \
+            'position_noise': list(position_noise), 'rotation_noise': list(rotation_noise), 'spike_window': spike_window}, f, indent=1)
+    return output
+
+# Function: smooth_files
+# DO: Smooth many logs in parallel
+# Output:
+#   list of derived log files, list of (file, error) that failed
+def smooth_files(files, registration=None, position_noise=POSITION_NOISE, rotation_noise=ROTATION_NOISE, spike_window=0, folder=None, suffix=SUFFIX, workers=None):
+    outputs, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(filename, executor.submit(smooth_file, filename, registration, position_noise, rotation_noise, spike_window, folder, suffix)) \
+            for filename in files]
+        for filename, future in futures:
+            try:
+                outputs.append(future.result())
+            except (ValueError, OSError, np.linalg.LinAlgError) as e:
+                failed.append((filename, str(e)))
+    return outputs, failed
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Smoothed (RTS, constant velocity) sensor poses of recorded runs for offline evaluation')
+    parser.add_argument('files', nargs='*', help='run logs (default: every csv in --folder)')
+    parser.add_argument('--folder', default=os.path.join('src', 'trajcontrol', 'data'), help='data folder')
+    parser.add_argument('--registration', default=os.path.join('src', 'trajcontrol', 'files', 'registration.csv'), help='registration file (x, y, z, qw, qx, qy, qz)')
+    parser.add_argument('--sensor-frame', action='store_true', help='keep the Aurora frame (no registration)')
+    parser.add_argument('--position-noise', type=float, nargs=3, default=POSITION_NOISE, metavar=('Q', 'R', 'V0'), \
+        help='acceleration density (mm^2/s^3), measurement variance (mm^2), initial velocity variance ((mm/s)^2)')
+    parser.add_argument('--rotation-noise', type=float, nargs=3, default=ROTATION_NOISE, metavar=('Q', 'R', 'V0'), \
+        help='same for the quaternion components')
+    parser.add_argument('--despike', type=int, default=0, help='median window applied before smoothing (0 = off)')
+    parser.add_argument('-o', '--output', default=None, help='output folder (default: next to each log)')
+    parser.add_argument('--suffix', default=SUFFIX, help='derived log name suffix')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    options = parser.parse_args(args)
+
+    registration = None if options.sensor_frame else np.loadtxt(options.registration, delimiter=',')
+    files = options.files if options.files else sorted(path for path in glob.glob(os.path.join(options.folder, '*.csv')) \
+        if not run_name(path).endswith(('_reprocessed', options.suffix)))
+    if options.output is not None:
+        os.makedirs(options.output, exist_ok=True)
+    outputs, failed = smooth_files(files, registration, tuple(options.position_noise), tuple(options.rotation_noise), options.despike, \
+        options.output, options.suffix, options.workers)
+    print('%d runs smoothed' % (len(outputs)))
+    for filename, error in failed:
+        print('Failed %s: %s' % (filename, error))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import shutil
+import threading
+import numpy as np
+
+from collections import deque
+from trajcontrol.log_columnar import ColumnarFile, EXTENSION
+
+try:
+    import zstandard    # Optional (zstd compression)
+except ImportError:
+    zstandard = None
+
+FSYNC_POLICIES = ('never', 'flush', 'close')
+FORMATS = {'csv': '.csv', 'columnar': EXTENSION}                # Log format: file extension
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}      # Csv compression: file extension
+COMPRESSION_LEVEL = {'gzip': 3, 'zstd': 3}                      # Fast levels (float text still compresses ~3x)
+MANIFEST_EXTENSION = '.manifest.json'
+ERROR_REPORT = 100                                              # Write errors between two error messages
+
+########################################################################
+### Log layout ###
+########################################################################
+
+# Columns of each recorded topic, in the order they appear in the snapshot (wide) table
+def pose_columns(name):
+    return [name+' x', name+' y', name+' z', name+' qw', name+' qx', name+' qy', name+' qz', name+' sec', name+' nanosec']
+
+JACOBIAN_SHAPE = (7, 7)         # Logged Jacobian size (estimator Jacobian padded with zeros, e.g. 5x3)
+
+STREAMS = {
+    'entry_point': ['Entry_point x', 'Entry_point y', 'Entry_point z', ' Entry_point sec', ' Entry_point nanosec'],
+    'aurora_tip': pose_columns('AuroraTip'),
+    'tip': pose_columns('Tip'),
+    'aurora_base': pose_columns('AuroraBase'),
+    'base': pose_columns('Base'),
+    'jacobian': ['J%d%d' % (i, j) for i in range(JACOBIAN_SHAPE[0]) for j in range(JACOBIAN_SHAPE[1])] + ['J sec', 'J nanosec'],
+    'control': ['Control x', 'Control z', 'Control sec', 'Control nanosec'],
+}
+TIMESTAMP_COLUMNS = ['Timestamp sec', 'Timestamp nanosec']     # Snapshot time (wide table)
+RECEIVE_COLUMNS = ['Receive sec', 'Receive nanosec']           # Arrival time (stream files)
+SNAPSHOT_HEADER = TIMESTAMP_COLUMNS + [column for columns in STREAMS.values() for column in columns]
+
+# Function: jacobian_values
+# DO: Logged values of a Jacobian (row-major, padded with zeros to JACOBIAN_SHAPE: column Jij is always J[i,j])
+def jacobian_values(J):
+    J = np.atleast_2d(np.asarray(J, dtype=float))
+    if (J.shape[0] > JACOBIAN_SHAPE[0]) or (J.shape[1] > JACOBIAN_SHAPE[1]):
+        raise ValueError('Jacobian %dx%d does not fit the logged %dx%d columns' % (J.shape + JACOBIAN_SHAPE))
+    padded = np.zeros(JACOBIAN_SHAPE)
+    padded[0:J.shape[0], 0:J.shape[1]] = J
+    return padded.ravel().tolist()
+
+########################################################################
+### Compressed text files ###
+########################################################################
+
+# Function: open_text
+# DO: Open a (possibly compressed) csv log for reading, compression given by file extension
+def open_text(filename):
+    if filename.endswith(COMPRESSIONS['gzip']):
+        return gzip.open(filename, 'rt', newline='', encoding='UTF8')
+    if filename.endswith(COMPRESSIONS['zstd']):
+        if zstandard is None:
+            raise ValueError('%s: reading zstd logs requires the zstandard package' % (filename))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True), newline='', encoding='UTF8')
+    return open(filename, newline='', encoding='UTF8')
+
+# Function: read_text
+# DO: Whole text of a csv log; a compressed segment that is still being written (or was interrupted)
+#     returns the data decoded so far
+def read_text(filename):
+    chunks = []
+    with open_text(filename) as f:
+        try:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                chunks.append(chunk)
+        except EOFError:
+            pass
+    return ''.join(chunks)
+
+########################################################################
+### Background log writer ###
+########################################################################
+
+# Class: CsvFile
+# DO: Append rows to a csv log (used by LogWriter), optionally through a streaming gzip/zstd compressor
+class CsvFile():
+
+    def __init__(self, filename, header=None, compression='none'):
+        self.raw = open(filename, 'wb')
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=COMPRESSION_LEVEL['gzip'])
+        elif compression == 'zstd':
+            self.stream = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL['zstd']).stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = None
+        self.file = io.TextIOWrapper(self.raw if self.stream is None else self.stream, newline='', encoding='UTF8', write_through=False)
+        self.writer = csv.writer(self.file)
+        if header is not None:
+            self.writer.writerow(header)
+            self.flush()
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    # Flush text buffer and compressor (sync flush: data written so far can be decoded)
+    def flush(self):
+        self.file.flush()
+        self.raw.flush()
+
+    def sync(self):
+        os.fsync(self.raw.fileno())
+
+    # Bytes on disk
+    def size(self):
+        return self.raw.tell()
+
+    def close(self):
+        self.file.close()               # Also ends the compressed stream
+        if not self.raw.closed:
+            self.raw.close()
+
+# Function: path_size
+# DO: Disk usage of a file or directory (columnar logs)
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(path_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+# Function: remove_path
+# DO: Delete a log file or columnar directory
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+# Class: DiskBudget
+# DO: Disk budget (bytes) of the files written by a set of LogWriters (SaveFile stream mode: every topic file of one run)
+#     Only the segments and current file of the registered writers are counted; other files in the folder are never counted or touched
+#     Closed segments are evicted oldest first; when the open files alone exceed the budget it cannot be met:
+#     full is set and the writers refuse new rows (counted as dropped)
+class DiskBudget():
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.writers = []
+        self.lock = threading.Lock()    # Writers enforce the budget from their own threads
+        self.full = False
+
+    def register(self, writer):
+        with self.lock:
+            self.writers.append(writer)
+
+    # Bytes written by the registered writers (closed segments from the manifests, current files from the last flush)
+    def usage(self):
+        return sum(writer.usage() for writer in self.writers)
+
+    # Evict closed segments until the writers fit in the budget
+    # Output:
+    #   list of removed segments
+    def enforce(self):
+        removed = []
+        with self.lock:
+            usage = self.usage()
+            if usage > self.budget:
+                closed = sorted(((segment['closed'], i, writer, segment) for i, writer in enumerate(self.writers) \
+                    for segment in writer.closed_segments()), key=lambda item: item[0:2])
+                for _, _, writer, segment in closed:
+                    if usage <= self.budget:
+                        break
+                    usage -= writer.evict(segment)
+                    removed.append(writer.evicted[-1])
+            self.full = usage > self.budget
+        return removed
+
+# Class: LogWriter
+# DO: Write log rows from a background thread so that disk stalls do not delay ROS callbacks
+#     Rows are handed over in a bounded queue (deque append/popleft are atomic, no lock on the hot path)
+#     One file handle stays open; rows are written in batches and flushed every flush_interval seconds
+#     or flush_rows rows, with an explicit fsync policy ('never', 'flush' = after every flush, 'close' = at close)
+#     Format 'csv' writes a text file, 'columnar' a typed binary directory (see log_columnar)
+#     Csv files can be compressed while written ('gzip', 'zstd'; done in the writer thread)
+#     With rotation (rotate_size bytes and/or rotate_interval seconds) the log is split in segments
+#     <name>_000.csv, <name>_001.csv, ... each with the header, listed in <name>.manifest.json;
+#     disk_budget (bytes or a DiskBudget shared with other writers) is enforced after every flush: closed segments
+#     are evicted oldest first, and rows are refused once the open files alone exceed it (always the case without rotation)
+#     A batch that cannot be written is dropped and reported through logger; the thread keeps writing
+class LogWriter(threading.Thread):
+
+    def __init__(self, filename, header=None, flush_interval=1.0, flush_rows=50, fsync='close', queue_size=10000, format='csv', \
+            compression='none', rotate_size=0, rotate_interval=0.0, disk_budget=0, logger=None):
+        super().__init__(daemon=True)
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync policy must be one of %s' % (FSYNC_POLICIES,))
+        if format not in FORMATS:
+            raise ValueError('log format must be one of %s' % (tuple(FORMATS),))
+        if compression not in COMPRESSIONS:
+            raise ValueError('compression must be one of %s' % (tuple(COMPRESSIONS),))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        if compression != 'none' and format != 'csv':
+            raise ValueError('compression is only available for csv logs')
+        self.filename = filename
+        self.header = header
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.fsync = fsync
+        self.queue_size = queue_size
+        self.format = format
+        self.compression = compression
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        if not isinstance(disk_budget, DiskBudget):
+            disk_budget = DiskBudget(disk_budget) if disk_budget > 0 else None
+        self.disk_budget = disk_budget
+        self.rotating = (rotate_size > 0) or (rotate_interval > 0)
+
+        self.queue = deque()
+        self.dropped = 0            # Rows discarded because the queue was full or could not be written
+        self.errors = 0             # Failed writes and flushes
+        self.logger = logger        # Node logger for write errors (None = print)
+        self.written = 0            # Rows written to file
+        self.evicted = []           # Segments removed to respect the disk budget
+        self.refused = False        # Rows refused because the disk budget cannot be met
+        self.current_size = 0       # Bytes of the current file at the last flush
+        self.stale_manifest = False # Segments evicted since the manifest was written
+        self.running = True
+
+        self.segments = []          # Manifest entries (rotation only)
+        self.open_segment()
+        if self.disk_budget is not None:
+            self.disk_budget.register(self)
+            if not self.rotating:
+                self.report('%s: disk budget without rotation, the log stops when the file reaches %.1f MB' % \
+                    (self.filename, self.disk_budget.budget*1e-6))
+        self.start()
+
+    # Queue a row (called from ROS callbacks, never blocks)
+    def write(self, row):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        self.queue.append(row)
+        return True
+
+    def run(self):
+        pending = 0                         # Rows written since last flush
+        last_flush = time.monotonic()
+        while self.running or self.queue:
+            batch = []
+            while self.queue and (len(batch) < self.flush_rows):
+                batch.append(self.queue.popleft())
+            if batch and (self.disk_budget is not None) and self.disk_budget.full:
+                self.dropped += len(batch)      # Disk budget cannot be met: refuse rows
+                if not self.refused:
+                    self.refused = True
+                    self.report('%s: disk budget of %.1f MB reached with no closed segment left to evict, rows dropped' % \
+                        (self.filename, self.disk_budget.budget*1e-6))
+            elif batch:
+                try:
+                    self.file.writerows(batch)
+                    self.written += len(batch)
+                    self.segment_rows += len(batch)
+                    pending += len(batch)
+                except Exception as e:      # Bad row or disk error: drop the batch, keep the thread alive
+                    self.dropped += len(batch)
+                    self.error('writing %d rows' % (len(batch)), e)
+            now = time.monotonic()
+            if (pending > 0) and ((pending >= self.flush_rows) or (now - last_flush >= self.flush_interval) or not self.running):
+                pending = 0
+                last_flush = now
+                try:
+                    self.flush()
+                    self.current_size = self.file.size()
+                    if self.rotating and (((self.rotate_size > 0) and (self.file.size() >= self.rotate_size)) or \
+                            ((self.rotate_interval > 0) and (now - self.segment_start >= self.rotate_interval))):
+                        self.rotate()
+                    if self.disk_budget is not None:
+                        self.disk_budget.enforce()
+                except Exception as e:
+                    self.error('flushing', e)
+            if self.stale_manifest:         # Segments evicted by this or another writer of the budget
+                self.stale_manifest = False
+                try:
+                    self.write_manifest()
+                except Exception as e:
+                    self.error('writing manifest', e)
+            if not batch:
+                time.sleep(min(self.flush_interval, 0.05))
+
+    # Report a write failure (first one and then every ERROR_REPORT failures, the log goes on)
+    def error(self, action, e):
+        self.errors += 1
+        if (self.errors == 1) or (self.errors % ERROR_REPORT == 0):
+            self.report('%s: error %s (%s: %s), %d rows dropped, %d errors' % (self.filename, action, type(e).__name__, e, self.dropped, self.errors))
+
+    def report(self, message):
+        if self.logger is not None:
+            self.logger.error(message)
+        else:
+            print(message)
+
+    def flush(self):
+        self.file.flush()
+        if self.fsync == 'flush':
+            self.file.sync()
+
+    # Stop thread after writing every queued row
+    def close(self):
+        self.running = False
+        self.join()
+        self.close_segment()
+        if self.disk_budget is not None:
+            self.disk_budget.enforce()      # Last segment counted as closed
+        if self.rotating:
+            self.write_manifest(complete=True)
+
+    ### Segments ###
+
+    # Name of next file (single file: filename + compression extension)
+    def segment_name(self):
+        extension = COMPRESSIONS[self.compression]
+        if not self.rotating:
+            return self.filename + extension
+        base, ext = os.path.splitext(self.filename)
+        return '%s_%03d%s%s' % (base, len(self.segments), ext, extension)
+
+    def open_segment(self):
+        name = self.segment_name()
+        if self.format == 'csv':
+            self.file = CsvFile(name, self.header, self.compression)
+        else:
+            self.file = ColumnarFile(name, self.header)
+        self.segment_start = time.monotonic()
+        self.segment_rows = 0
+        self.current_size = 0
+        if self.rotating:
+            self.segments.append({'file': os.path.basename(name), 'rows': 0, 'bytes': 0, 'opened': time.time(), 'closed': None})
+            self.write_manifest()
+
+    def close_segment(self):
+        self.file.flush()
+        if self.fsync != 'never':
+            self.file.sync()
+        size = self.file.size()
+        self.file.close()
+        if self.rotating:
+            self.segments[-1].update({'rows': self.segment_rows, 'bytes': size, 'closed': time.time()})
+            self.current_size = 0           # Now counted in the closed segments
+            self.write_manifest()
+
+    def rotate(self):
+        self.close_segment()
+        self.open_segment()
+
+    ### Disk budget ###
+
+    # Bytes of this log: closed segments still on disk and current file
+    def usage(self):
+        return sum(segment['bytes'] for segment in self.closed_segments()) + self.current_size
+
+    def closed_segments(self):
+        return [segment for segment in self.segments if (segment['closed'] is not None) and not segment.get('evicted')]
+
+    # Delete a closed segment (called by DiskBudget from any writer thread, manifest rewritten by this writer thread)
+    # Output:
+    #   bytes freed
+    def evict(self, segment):
+        path = os.path.join(os.path.dirname(os.path.abspath(self.filename)), segment['file'])
+        remove_path(path)
+        segment['evicted'] = True
+        self.evicted.append(path)
+        self.stale_manifest = True
+        return segment['bytes']
+
+    # Manifest: ties the segments of one log together (evicted segments stay listed with evicted = true)
+    def write_manifest(self, complete=False):
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        for segment in self.segments:
+            segment['evicted'] = not os.path.exists(os.path.join(folder, segment['file']))
+        manifest = {'log': os.path.basename(self.filename), 'format': self.format, 'compression': self.compression, \
+            'header': self.header, 'complete': complete, 'segments': self.segments}
+        filename = os.path.splitext(self.filename)[0] + MANIFEST_EXTENSION
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(filename + '.tmp', filename)
@@ -0,0 +1,323 @@
+import os
+import time
+import argparse
+import itertools
+import warnings
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from trajcontrol.log_loader import RunLog
+from trajcontrol.log_join import save_table
+from trajcontrol.log_metrics import runlog_metrics, SUMMARY
+from trajcontrol.log_writer import SNAPSHOT_HEADER
+from trajcontrol.needle_sim import NeedleSim, CURVATURE, TISSUE_LENGTH, GUIDE_GAP, STAGE_SPEED, INSERTION_SPEED, SENSOR_NOISE
+from trajcontrol.pose_filter import median_last, FILTER_WINDOW, FILTER_SIZE
+from trajcontrol.control_law import J_INITIAL, CONTROL_LENGTH, tip_outputs, jacobian_update, discrete_command, mpc_command
+
+# Node timing (same as the ROS pipeline with the virtual robot)
+SIM_PERIOD = 0.02           # VirtualRobot simulation step, stage pose and Aurora readings (s)
+TIP_PERIOD = 0.5            # SensorProcessing tip_filtered and skin_entry timers (s)
+JACOBIAN_PERIOD = 0.3       # Estimator Jacobian timer (s)
+SNAPSHOT_PERIOD = 0.2       # SaveFile snapshot timer (s)
+START_TIME = 1.0            # Simulation clock at the first step (s, keeps every stamp > 0)
+MAX_TIME = 600.0            # Trial time limit (s, simulation time)
+
+ENTRY = np.array([12.5, 0.0, 11.0])         # Needle tip at entry point (stage frame, same as virtual_robot)
+CONTROLLERS = ('discrete', 'mpc', 'none')
+NAMES = [name.strip() for name in SNAPSHOT_HEADER]
+
+# Trial parameters (grid keys) and their defaults (node parameter defaults)
+DEFAULTS = {
+    'controller': 'discrete',
+    'K': -0.5,                          # controller_discrete gain
+    'hold_x': True,                     # controller_discrete keeps x at the entry point
+    'alpha': 0.65,                      # estimator Jacobian update gain
+    'filter_window': FILTER_WINDOW,     # sensor_processing median filter
+    'filter_size': FILTER_SIZE,
+    'P': 10,                            # controller_mpc horizons and input weight
+    'C': 3,
+    'wu': 0.8,
+    'curvature': CURVATURE,             # virtual_robot needle, tissue and operator
+    'bevel': 0.0,
+    'tissue_length': TISSUE_LENGTH,
+    'guide_gap': GUIDE_GAP,
+    'stage_speed': STAGE_SPEED,
+    'insertion_speed': INSERTION_SPEED,
+    'sensor_noise': SENSOR_NOISE,
+    'insertion_step': 5.0,
+    'max_depth': 100.0,
+    'step_wait': 1.0,
+}
+
+# Metrics of each trial: log_metrics summary (from the simulated SaveFile log) and true tip errors
+TRUTH = ['true_rms', 'true_max', 'true_final']
+METRICS = [name for name, _, _ in SUMMARY if name not in ('kind', 'gain')] + TRUTH + ['wall']
+PRINTED = ['commands', 'rms', 'final', 'settle', 'true_rms', 'true_final']
+
+########################################################################
+### Closed-loop trial ###
+########################################################################
+
+# Function: stamp_columns
+# DO: [sec, nanosec] of a simulation time (s)
+def stamp_columns(t):
+    ns = int(round(t*1e9))
+    return [ns // 1000000000, ns % 1000000000]
+
+# Function: simulate
+# DO: One closed-loop insertion with the pipeline of the virtual robot launch, in process and without ROS
+#     Every node callback is replayed at its own period on the simulation clock:
+#     VirtualRobot (NeedleSim, operator stand-in), SensorProcessing (median filter, auto entry point),
+#     Estimator (Jacobian update on each stage pose), controller (on SPACE) and SaveFile (snapshot table)
+#     Aurora frame = stage frame (identity registration, it does not change the closed loop)
+# Inputs:
+#   params: trial parameters (DEFAULTS keys, missing keys take the default)
+#   seed: noise seed (NeedleSim sensor noise)
+# Output:
+#   table: SaveFile snapshot table (numpy array, SNAPSHOT_HEADER columns)
+#   truth: true tip deviation from the entry point at each snapshot (numpy array Nx3 [depth, x, z], nan before entry)
+def simulate(params, seed):
+    p = dict(DEFAULTS)
+    p.update(params)
+    if p['controller'] not in CONTROLLERS:
+        raise ValueError('Unknown controller %s' % (p['controller']))
+    sim = NeedleSim(ENTRY, curvature=p['curvature'], bevel=p['bevel'], tissue_length=p['tissue_length'], guide_gap=p['guide_gap'], \
+        stage_speed=p['stage_speed'], insertion_speed=p['insertion_speed'], sensor_noise=p['sensor_noise'], seed=seed)
+    every_tip = int(round(TIP_PERIOD/SIM_PERIOD))
+    every_jacobian = int(round(JACOBIAN_PERIOD/SIM_PERIOD))
+    every_snapshot = int(round(SNAPSHOT_PERIOD/SIM_PERIOD))
+
+    aurora_tip = deque(maxlen=p['filter_window'])   # Last Aurora readings (SensorProcessing window)
+    entry = None                    # Entry point (stage frame) and its stamp
+    entry_stamp = [0, 0]
+    tip = None                      # Last filtered tip (tip_filtered)
+    tip_stamp = [0, 0]
+    Z = Zant = X = Xant = None      # Estimator outputs and inputs with their times
+    TZ = TZant = TX = TXant = 0.0
+    J = J_INITIAL.copy()
+    J_published = None              # Last Jacobian received by the controller
+    J_stamp = [0, 0]
+    control = [0.0, 0.0, 0, 0]
+    wait = None                     # Operator: time when SPACE was hit
+    rows, truth = [], []
+    zeros = [0.0]*9
+
+    for k in range(int(MAX_TIME/SIM_PERIOD)):
+        # VirtualRobot: simulation step, stage pose and Aurora readings
+        sim.step(SIM_PERIOD)
+        now = START_TIME + sim.time
+        stamp = stamp_columns(now)
+        stage = sim.stage_pose()[0]
+        readings = [reading[0] for reading in sim.aurora()]
+        aurora_tip.append(readings[0])
+
+        # SensorProcessing: filtered tip (and entry point on its first value)
+        if k % every_tip == 0:
+            tip = median_last(np.array(aurora_tip), p['filter_size'])
+            tip_stamp = stamp
+            if entry is None:
+                entry, entry_stamp = tip[0:3].copy(), stamp
+            # Estimator: new output Z
+            Zant, TZant = Z, TZ
+            Z, TZ = tip_outputs(tip), now
+
+        # Estimator: Jacobian update on each stage pose
+        Xant, TXant = X, TX
+        X, TX = stage[0:3], now
+        if (Xant is not None) and (Zant is not None):
+            J = jacobian_update(J, (X - Xant)/(TX - TXant), (Z - Zant)/(TZ - TZant), p['alpha'])
+        if k % every_jacobian == 0:
+            J_published, J_stamp = J.copy(), stamp
+
+        # Operator stand-in (VirtualRobot auto_step): insert one step, hit SPACE, wait for the stage, repeat
+        if (entry is not None) and (not sim.moving()[0]):
+            if wait is None:
+                if sim.depth[0] > 0:
+                    cmd = controller_step(p, entry, tip, stage, J_published)
+                    if cmd is not None:
+                        sim.move(cmd)
+                        control = [float(cmd[0]), float(cmd[1])] + stamp
+                wait = sim.time
+            elif sim.time - wait >= p['step_wait']:
+                if sim.depth[0] + p['insertion_step'] > p['max_depth']:
+                    break
+                sim.insert(p['insertion_step'])
+                wait = None
+
+        # SaveFile snapshot
+        if k % every_snapshot == 0:
+            J_padded = np.zeros((7, 7))
+            if J_published is not None:
+                J_padded[:J_published.shape[0], :J_published.shape[1]] = J_published
+            rows.append(stamp + (zeros[0:3] + [0, 0] if entry is None else list(entry) + entry_stamp) + \
+                list(readings[0]) + stamp + (zeros if tip is None else list(tip) + tip_stamp) + \
+                list(readings[1]) + stamp + list(stage) + stamp + \
+                J_padded.ravel().tolist() + J_stamp + control)
+            position = sim.tip_pose()[0][0:3] - sim.entry[0]
+            truth.append([position[1], position[0], position[2]] if entry is not None else [np.nan]*3)
+    return np.array(rows, dtype=float), np.array(truth)
+
+# Function: controller_step
+# DO: Controller response to SPACE (controller_discrete or controller_mpc with the same target)
+# Output:
+#   stage command [x, z] (None when the controller does not move the stage)
+def controller_step(p, entry, tip, stage, J):
+    if (p['controller'] == 'none') or (tip is None) or (J is None) or (stage[1] - entry[1] >= CONTROL_LENGTH):
+        return None
+    if p['controller'] == 'discrete':
+        cmd, _ = discrete_command(tip, stage[[0,2]], entry, J, p['K'], hold_x=bool(p['hold_x']))
+        return cmd
+    cmd, _ = mpc_command(tip, stage[[0,2]], entry, J, P=p['P'], C=p['C'], wu=p['wu'])
+    return cmd
+
+# Function: run_trial
+# DO: Simulate one trial and compute its metrics
+# Inputs:
+#   name: trial name
+#   params: trial parameters
+#   seed: noise seed
+#   folder: write the simulated SaveFile log here (None = no log)
+# Output:
+#   dictionary of METRICS
+def run_trial(name, params, seed, folder=None):
+    start = time.perf_counter()
+    table, truth = simulate(params, seed)
+    if folder is not None:
+        save_table(os.path.join(folder, name + '.csv'), NAMES, table)
+    metrics = runlog_metrics(RunLog(NAMES, table, name), name)
+    results = {key: metrics[key] for key in METRICS if key in metrics}
+
+    # True tip deviation from the entry point (the logged tip is filtered and noisy)
+    valid = ~np.isnan(truth[:,0])
+    lateral = np.hypot(truth[valid,1], truth[valid,2])
+    results['true_rms'] = float(np.sqrt(np.mean(lateral**2))) if lateral.size > 0 else float('nan')
+    results['true_max'] = float(lateral.max()) if lateral.size > 0 else float('nan')
+    reached = np.flatnonzero(truth[valid,0] >= CONTROL_LENGTH)
+    results['true_final'] = float(lateral[reached[0]]) if reached.size > 0 else float('nan')
+    results['wall'] = time.perf_counter() - start
+    return results
+
+########################################################################
+### Parameter sweep ###
+########################################################################
+
+# Function: parse_grid
+# DO: Parameter grid from 'name=value,value,...' items (values converted to the type of the default)
+# Output:
+#   dictionary name: list of values
+def parse_grid(items):
+    grid = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        if name not in DEFAULTS or not values:
+            raise ValueError('Bad grid item %s (parameters: %s)' % (item, ', '.join(DEFAULTS)))
+        kind = type(DEFAULTS[name])
+        if kind == bool:
+            kind = lambda value: value.lower() in ('1', 'true', 'yes')
+        grid[name] = [kind(value) for value in values.split(',')]
+    return grid
+
+# Function: trials
+# DO: Every parameter combination of the grid with every noise seed
+#     (the same seeds are used for every combination, so that combinations are compared on the same noise)
+# Inputs:
+#   grid: dictionary name: list of values
+#   seeds: number of noise seeds per combination
+#   seed: master seed
+# Output:
+#   list of (name, combination index, parameters, seed)
+def trials(grid, seeds, seed=0):
+    noise = np.random.SeedSequence(seed).generate_state(seeds).tolist()
+    names = list(grid)
+    result = []
+    for index, values in enumerate(itertools.product(*[grid[name] for name in names])):
+        params = dict(zip(names, values))
+        for i, s in enumerate(noise):
+            result.append(('trial_%04d_%03d' % (index, i), index, params, s))
+    return result
+
+# Function: run_trials
+# DO: Run trials in parallel (one process per core)
+# Output:
+#   dictionary trial name: metrics, list of failed (name, error)
+def run_trials(trial_list, folder=None, workers=None):
+    results, failed = {}, []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(name, executor.submit(run_trial, name, params, seed, folder)) for name, _, params, seed in trial_list]
+        for name, future in futures:
+            try:
+                results[name] = future.result()
+            except (ValueError, OSError, np.linalg.LinAlgError) as e:
+                failed.append((name, str(e)))
+    return results, failed
+
+# Function: aggregate
+# DO: Mean and standard deviation of the metrics of each parameter combination over its seeds
+# Output:
+#   list of dictionaries (grid parameters, 'n', '<metric>' mean and '<metric>_std')
+def aggregate(trial_list, results):
+    groups = {}
+    for name, index, params, _ in trial_list:
+        if name in results:
+            groups.setdefault(index, (params, []))[1].append(results[name])
+    table = []
+    for index, (params, runs) in sorted(groups.items()):
+        values = np.array([[run[key] for key in METRICS] for run in runs], dtype=float)
+        row = dict(params)
+        row['n'] = len(runs)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')     # Metric not available in any seed
+            for key, mean, std in zip(METRICS, np.nanmean(values, axis=0), np.nanstd(values, axis=0)):
+                row[key], row[key + '_std'] = float(mean), float(std)
+        table.append(row)
+    return table
+
+# Function: write_table
+# DO: Csv with one row per dictionary
+def write_table(filename, columns, rows):
+    with open(filename, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for row in rows:
+            f.write(','.join(str(row.get(column, '')) for column in columns) + '\n')
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Monte Carlo sweep of closed-loop needle insertions over the simulator')
+    parser.add_argument('--grid', nargs='*', default=[], metavar='NAME=V1,V2', help='parameter values to sweep (%s)' % (', '.join(DEFAULTS)))
+    parser.add_argument('--seeds', type=int, default=10, help='noise seeds per parameter combination')
+    parser.add_argument('--seed', type=int, default=0, help='master seed (same seed = same trials)')
+    parser.add_argument('--output', default=None, help='write aggregated table to csv')
+    parser.add_argument('--trials', default=None, help='write one row per trial to csv')
+    parser.add_argument('--logs', default=None, help='folder for simulated SaveFile logs (one csv per trial)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    options = parser.parse_args(args)
+
+    try:
+        grid = parse_grid(options.grid)
+    except ValueError as e:
+        parser.error(str(e))
+    trial_list = trials(grid, options.seeds, options.seed)
+    if options.logs is not None:
+        os.makedirs(options.logs, exist_ok=True)
+    start = time.perf_counter()
+    results, failed = run_trials(trial_list, options.logs, options.workers)
+    table = aggregate(trial_list, results)
+    print('%d trials in %.1f s' % (len(results), time.perf_counter() - start))
+
+    # Mean (std) of the main metrics per combination
+    names = list(grid)
+    print(' '.join([name.rjust(12) for name in names] + ['n'.rjust(4)] + [key.rjust(15) for key in PRINTED]))
+    for row in table:
+        print(' '.join([str(row[name]).rjust(12) for name in names] + [str(row['n']).rjust(4)] + \
+            [('%.2f (%.2f)' % (row[key], row[key + '_std'])).rjust(15) for key in PRINTED]))
+    for name, error in failed:
+        print('Failed %s: %s' % (name, error))
+
+    if options.output is not None:
+        write_table(options.output, names + ['n'] + [column for key in METRICS for column in (key, key + '_std')], table)
+    if options.trials is not None:
+        rows = [dict(params, trial=name, seed=seed, **results[name]) for name, _, params, seed in trial_list if name in results]
+        write_table(options.trials, ['trial'] + names + ['seed'] + METRICS, rows)
+
+if __name__ == '__main__':
+    main()
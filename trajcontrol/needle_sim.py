@@ -0,0 +1,110 @@
+import numpy as np
+
+from trajcontrol.pose_filter import pose_transform, quaternion_multiply, rotvec_quaternion
+
+DIST_NEEDLE_BASE = 30.9         # Base sensor height above the needle axis (same as sensor_processing)
+MM_2_COUNT = 1088.9             # Stage encoder resolution (same as smart_template)
+
+# Default needle and tissue parameters (robot frame, mm)
+CURVATURE = 0.002               # Bevel tip path curvature (1/mm, radius 500 mm)
+TISSUE_LENGTH = 20.0            # Decay length of the guide motion transmitted to the tip (depth)
+GUIDE_GAP = 20.0                # Distance from needle guide to skin entry
+STAGE_SPEED = 5.0               # Stage axes speed (mm/s)
+INSERTION_SPEED = 2.0           # Insertion speed (mm/s)
+SENSOR_NOISE = 0.1              # Aurora position noise (mm, standard deviation)
+
+########################################################################
+### Needle-tissue simulator ###
+########################################################################
+
+# Class: NeedleSim
+# DO: Kinematic bevel tip needle driven by the stage (x, z) and the insertion (y), for n needles at once
+#     Robot frame: y = insertion axis. The needle enters the tissue at the entry point; the tip advances
+#     along its heading, which bends with the bevel curvature and turns when the needle guide moves.
+#     Guide motion also drags the tip sideways, less as the needle goes deeper in the tissue
+#     Every quantity is a numpy array with one row per simulated needle (parameters can be scalars or arrays)
+class NeedleSim():
+
+    def __init__(self, entry, n=1, curvature=CURVATURE, bevel=0.0, tissue_length=TISSUE_LENGTH, guide_gap=GUIDE_GAP, \
+            stage_speed=STAGE_SPEED, insertion_speed=INSERTION_SPEED, sensor_noise=SENSOR_NOISE, seed=None):
+        self.n = n
+        self.entry = np.array(np.broadcast_to(entry, (n, 3)), dtype=float)      # Entry point [x, y, z]
+        self.curvature = self.parameter(curvature)
+        self.bevel = self.parameter(bevel)                  # Bevel direction (rad, 0 = +x, pi/2 = +z)
+        self.tissue_length = self.parameter(tissue_length)
+        self.guide_gap = self.parameter(guide_gap)
+        self.stage_speed = self.parameter(stage_speed)
+        self.insertion_speed = self.parameter(insertion_speed)
+        self.sensor_noise = self.parameter(sensor_noise)
+        self.rng = np.random.default_rng(seed)
+
+        # State
+        self.time = 0.0
+        self.stage = self.entry[:,[0,2]].copy()     # Needle guide position [x, z]
+        self.target = self.stage.copy()             # Commanded guide position [x, z]
+        self.depth = np.zeros(n)                    # Insertion depth
+        self.depth_target = np.zeros(n)             # Commanded insertion depth
+        self.offset = np.zeros((n, 2))              # Tip deviation from the entry point [x, z]
+        self.heading = np.zeros((n, 2))             # Tip direction [dx/dy, dz/dy]
+
+    def parameter(self, value):
+        return np.array(np.broadcast_to(value, (self.n,)), dtype=float)
+
+    ### Commands ###
+
+    # Move the needle guide to [x, z] (robot frame, one row per needle or one for all)
+    def move(self, target):
+        self.target[:] = np.broadcast_to(target, (self.n, 2))
+
+    # Insert the needle a further step (mm)
+    def insert(self, step):
+        self.depth_target += np.broadcast_to(step, (self.n,))
+
+    # Needles still moving (stage or insertion)
+    def moving(self):
+        return np.any(np.abs(self.target - self.stage) > 1e-9, axis=1) | (self.depth < self.depth_target - 1e-9)
+
+    # Advance simulation by dt seconds
+    def step(self, dt):
+        # Stage axes and insertion move towards their targets at constant speed
+        ds = np.clip(self.target - self.stage, -(self.stage_speed*dt)[:,None], (self.stage_speed*dt)[:,None])
+        dd = np.clip(self.depth_target - self.depth, 0.0, self.insertion_speed*dt)
+        self.stage += ds
+
+        # Needle: guide motion drags the tip and turns the needle, the bevel bends the path while inserting
+        self.offset += ds*np.exp(-self.depth/self.tissue_length)[:,None]
+        self.heading += ds/(self.guide_gap + self.depth)[:,None]
+        self.heading += (self.curvature*dd)[:,None]*np.column_stack((np.cos(self.bevel), np.sin(self.bevel)))
+        self.offset += self.heading*dd[:,None]
+        self.depth += dd
+        self.time += dt
+
+    ### Outputs (robot frame, [x, y, z, qw, qx, qy, qz] per needle) ###
+
+    # Needle tip pose (orientation: needle tilted by the heading and rolled by the bevel angle)
+    def tip_pose(self):
+        position = np.column_stack((self.entry[:,0] + self.offset[:,0], self.entry[:,1] + self.depth, self.entry[:,2] + self.offset[:,1]))
+        tilt = rotvec_quaternion(np.column_stack((np.arctan(self.heading[:,1]), np.zeros(self.n), -np.arctan(self.heading[:,0]))))
+        roll = rotvec_quaternion(np.column_stack((np.zeros(self.n), self.bevel, np.zeros(self.n))))
+        return np.column_stack((position, quaternion_multiply(tilt, roll)))
+
+    # Base sensor pose (on the needle guide, DIST_NEEDLE_BASE above the needle axis)
+    def base_pose(self):
+        position = np.column_stack((self.stage[:,0], self.entry[:,1] + self.depth, self.stage[:,1] + DIST_NEEDLE_BASE))
+        roll = rotvec_quaternion(np.column_stack((np.zeros(self.n), self.bevel, np.zeros(self.n))))
+        return np.column_stack((position, roll))
+
+    # Stage pose as published on /stage/state/needle_pose (encoder positions, y = base sensor depth)
+    def stage_pose(self):
+        encoder = np.round(self.stage*MM_2_COUNT)/MM_2_COUNT
+        return np.column_stack((encoder[:,0], self.entry[:,1] + self.depth, encoder[:,1], np.ones(self.n), np.zeros((self.n, 3))))
+
+    # Aurora readings of tip and base sensors (position noise added, in Aurora frame)
+    # Input:
+    #   tf: transformation from robot to Aurora frame (inverse registration, None = readings in robot frame)
+    def aurora(self, tf=None):
+        readings = []
+        for pose in (self.tip_pose(), self.base_pose()):
+            pose[:,0:3] += self.rng.normal(size=(self.n, 3))*self.sensor_noise[:,None]
+            readings.append(pose if tf is None else pose_transform(pose, tf))
+        return readings
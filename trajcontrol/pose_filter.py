@@ -0,0 +1,103 @@
+import numpy as np
+
+FILTER_WINDOW = 500     # Number of last Aurora readings kept for filtering
+FILTER_SIZE = 40        # Median filter size (samples, column-wise)
+
+########################################################################
+### Median filter ###
+########################################################################
+
+# Function: reflect_index
+# DO: Fold indices into [0, n) with the 'reflect' boundary of scipy.ndimage (d c b a | a b c d | d c b a)
+def reflect_index(index, n):
+    index = np.mod(index, 2*n)
+    return np.where(index >= n, 2*n-1-index, index)
+
+# Function: median_last
+# DO: Last row of median_filter(window, size=(size,1)) without filtering the whole window
+#     (same result: reflect boundary, rank size//2 element of each column)
+# Inputs:
+#   window: last Aurora readings (numpy array Nx7)
+#   size: filter size
+# Output:
+#   filtered last reading (numpy array [x, y, z, qw, qx, qy, qz])
+def median_last(window, size=FILTER_SIZE):
+    n = window.shape[0]
+    rows = reflect_index(np.arange(n-1-size//2, n-1-size//2+size), n)
+    return np.partition(window[rows], size//2, axis=0)[size//2]
+
+# Function: causal_median
+# DO: Output of the live filter after each reading (median_last of the last 'window' readings), for a whole run at once
+# Inputs:
+#   samples: Aurora readings in arrival order (numpy array Nx7)
+#   window: number of last readings kept (FILTER_WINDOW)
+#   size: filter size (FILTER_SIZE)
+#   chunk: readings processed per batch (bounds memory to chunk x size x 7 values)
+# Output:
+#   filtered readings (numpy array Nx7), row k = filter output when reading k arrived
+def causal_median(samples, window=FILTER_WINDOW, size=FILTER_SIZE, chunk=4096):
+    samples = np.asarray(samples, dtype=float)
+    filtered = np.empty_like(samples)
+    offsets = np.arange(size) - size//2
+    for start in range(0, samples.shape[0], chunk):
+        k = np.arange(start, min(start+chunk, samples.shape[0]))
+        n = np.minimum(k+1, window)[:,None]         # Readings in the window of each output
+        first = k[:,None] + 1 - n                   # Index of the oldest reading in the window
+        rows = first + reflect_index(n - 1 + offsets[None,:], n)
+        filtered[k] = np.partition(samples[rows], size//2, axis=1)[:,size//2]
+    return filtered
+
+########################################################################
+### Pose transform ###
+########################################################################
+
+# Function: quaternion_multiply
+# DO: Hamilton product of quaternions [w, x, y, z] (numpy arrays ...x4, broadcast)
+def quaternion_multiply(a, b):
+    aw, ax, ay, az = a[...,0], a[...,1], a[...,2], a[...,3]
+    bw, bx, by, bz = b[...,0], b[...,1], b[...,2], b[...,3]
+    return np.stack((aw*bw - ax*bx - ay*by - az*bz,
+                     aw*bx + ax*bw + ay*bz - az*by,
+                     aw*by - ax*bz + ay*bw + az*bx,
+                     aw*bz + ax*by - ay*bx + az*bw), axis=-1)
+
+# Function: pose_transform
+# DO: Transform poses to new reference frame (one pose or a batch)
+# Inputs:
+#   x_orig: pose(s) in original reference frame (numpy array [x, y, z, qw, qx, qy, qz] or Nx7)
+#   x_tf: transformation from original to new frame (numpy array [x, y, z, qw, qx, qy, qz])
+# Output:
+#   x_new: pose(s) in new reference frame (same shape as x_orig)
+def pose_transform(x_orig, x_tf):
+    x_orig = np.asarray(x_orig, dtype=float)
+    x_tf = np.asarray(x_tf, dtype=float)
+
+    #Define frame transformation
+    q_tf = x_tf[3:7]
+    q_conj = q_tf*[1, -1, -1, -1]
+
+    #Define original position and orientation
+    p_orig = np.concatenate((np.zeros(x_orig.shape[:-1]+(1,)), x_orig[...,0:3]), axis=-1)
+    q_orig = x_orig[...,3:7]
+
+    #Transform to new frame
+    q_new = quaternion_multiply(q_tf, q_orig)
+    p_new = quaternion_multiply(quaternion_multiply(q_tf, p_orig), q_conj)[...,1:4] + x_tf[0:3]
+
+    return np.concatenate((p_new, q_new), axis=-1)
+
+# Function: pose_inverse
+# DO: Inverse of a frame transformation (numpy array [x, y, z, qw, qx, qy, qz])
+def pose_inverse(x_tf):
+    x_tf = np.asarray(x_tf, dtype=float)
+    q_inv = x_tf[3:7]*[1, -1, -1, -1]/np.dot(x_tf[3:7], x_tf[3:7])
+    p_inv = -pose_transform(np.concatenate((x_tf[0:3], [1, 0, 0, 0])), np.concatenate(([0, 0, 0], q_inv)))[0:3]
+    return np.concatenate((p_inv, q_inv))
+
+# Function: rotvec_quaternion
+# DO: Unit quaternions [w, x, y, z] of rotation vectors (numpy arrays ...x3, angle = norm in radians)
+def rotvec_quaternion(v):
+    v = np.asarray(v, dtype=float)
+    angle = np.linalg.norm(v, axis=-1, keepdims=True)
+    scale = np.where(angle > 1e-12, np.sin(angle/2)/np.where(angle > 1e-12, angle, 1.0), 0.5)
+    return np.concatenate((np.cos(angle/2), v*scale), axis=-1)
@@ -1,6 +1,5 @@
 import rclpy
 import os
-import csv
 import numpy as np
 
 from rclpy.node import Node
@@ -9,6 +8,9 @@ from ros2_igtl_bridge.msg import Transform
 from cv_bridge import CvBridge
 from sensor_msgs.msg import Image
 from numpy import asarray
+from trajcontrol.sim_clock import StepAck
+from trajcontrol.log_writer import LogWriter, DiskBudget, STREAMS, RECEIVE_COLUMNS, SNAPSHOT_HEADER, FORMATS, COMPRESSIONS, zstandard, \
+    jacobian_values
 
 
 class SaveFile(Node):
@@ -18,7 +20,33 @@ class SaveFile(Node):
         
         #Declare node parameters
         self.declare_parameter('filename', 'my_data') #Name of file where data values are saved
-        self.filename = os.path.join(os.getcwd(),'src','trajcontrol','data',self.get_parameter('filename').get_parameter_value().string_value + '.csv') #String with full path to file
+        self.declare_parameter('mode', 'snapshot')    #'snapshot' (one wide row every 0.2 s) or 'stream' (every message, one file per topic)
+        self.declare_parameter('format', 'csv')       #Log file format: 'csv' (text) or 'columnar' (typed binary, see log_columnar)
+        self.declare_parameter('flush_interval', 1.0) #Maximum time between file flushes (seconds)
+        self.declare_parameter('flush_rows', 50)      #Maximum number of rows between file flushes
+        self.declare_parameter('fsync', 'close')      #fsync policy: 'never' / 'flush' (every flush) / 'close'
+        self.declare_parameter('queue_size', 10000)   #Maximum number of rows waiting to be written
+        self.declare_parameter('compression', 'none') #Csv compression: 'none' / 'gzip' / 'zstd'
+        self.declare_parameter('rotate_size', 0.0)    #Start a new segment when the file reaches this size (MB, 0 = no rotation)
+        self.declare_parameter('rotate_interval', 0.0)#Start a new segment after this time (seconds, 0 = no rotation)
+        self.declare_parameter('disk_budget', 0.0)    #Maximum size of this run's log files, oldest closed segments evicted, logging stops if not met (MB, 0 = no limit)
+        self.mode = self.get_parameter('mode').get_parameter_value().string_value
+        if self.mode not in ('snapshot', 'stream'):
+            self.get_logger().info('Invalid mode %s, using snapshot' % (self.mode))
+            self.mode = 'snapshot'
+        self.filename = os.path.join(os.getcwd(),'src','trajcontrol','data',self.get_parameter('filename').get_parameter_value().string_value) #String with full path to file (without extension)
+        self.format = self.get_parameter('format').get_parameter_value().string_value
+        if self.format not in FORMATS:
+            self.get_logger().info('Invalid format %s, using csv' % (self.format))
+            self.format = 'csv'
+        compression = self.get_parameter('compression').get_parameter_value().string_value
+        if (compression not in COMPRESSIONS) or (self.format != 'csv'):
+            compression = 'none'
+        elif (compression == 'zstd') and (zstandard is None):
+            self.get_logger().info('zstandard package not found, using gzip compression')
+            compression = 'gzip'
+        if self.mode == 'snapshot':
+            self.filename = self.filename + FORMATS[self.format]
 
         #Topics from aurora node (NeedleToTracker and BaseToTracker sensors)
         self.subscription_aurora = self.create_subscription(Transform, 'IGTL_TRANSFORM_IN', self.aurora_callback, 10)
@@ -41,30 +69,33 @@ class SaveFile(Node):
         self.subscription_controller  # prevent unused variable warning
 
         
-        #Published topics
-        timer_period = 0.2  # seconds
-        self.timer = self.create_timer(timer_period, self.write_file_callback)
-
-        #Array of data
-        header = ['Timestamp sec', 'Timestamp nanosec', \
-            'Entry_point x', 'Entry_point y', 'Entry_point z', ' Entry_point sec', ' Entry_point nanosec', \
-            'AuroraTip x', 'AuroraTip y', 'AuroraTip z', 'AuroraTip qw', 'AuroraTip qx', 'AuroraTip qy', 'AuroraTip qz', 'AuroraTip sec', 'AuroraTip nanosec', \
-            'Tip x', 'Tip y', 'Tip z', 'Tip qw', 'Tip qx', 'Tip qy', 'Tip qz', 'Tip sec', 'Tip nanosec', \
-            'AuroraBase x', 'AuroraBase y', 'AuroraBase z', 'AuroraBase qw', 'AuroraBase qx', 'AuroraBase qy', 'AuroraBase qz', 'AuroraBase sec', 'AuroraBase nanosec', \
-            'Base x', 'Base y', 'Base z', 'Base qw', 'Base qx', 'Base qy', 'Base qz', 'Base sec', 'Base nanosec',
-            'J00', 'J01', 'J02', 'J03', 'J04', 'J05', 'J06', \
-            'J10', 'J11', 'J12', 'J13', 'J14', 'J15', 'J16', \
-            'J20', 'J21', 'J22', 'J23', 'J24', 'J25', 'J26', \
-            'J30', 'J31', 'J32', 'J33', 'J34', 'J35', 'J36', \
-            'J40', 'J41', 'J42', 'J43', 'J44', 'J45', 'J46', \
-            'J50', 'J51', 'J52', 'J53', 'J54', 'J55', 'J56', \
-            'J60', 'J61', 'J62', 'J63', 'J64', 'J65', 'J66', 'J sec', 'J nanosec', \
-            'Control x', 'Control z', 'Control sec', 'Control nanosec' 
-        ]
-        
-        with open(self.filename, 'w', newline='', encoding='UTF8') as f: # open the file in the write mode
-            writer = csv.writer(f)  # create the csv writer
-            writer.writerow(header) # write a row to the csv file
+        #Background writer options (keeps the file open and writes in batches)
+        disk_budget = int(self.get_parameter('disk_budget').get_parameter_value().double_value*1e6)
+        writer_options = {
+            'flush_interval': self.get_parameter('flush_interval').get_parameter_value().double_value,
+            'flush_rows': self.get_parameter('flush_rows').get_parameter_value().integer_value,
+            'fsync': self.get_parameter('fsync').get_parameter_value().string_value,
+            'queue_size': self.get_parameter('queue_size').get_parameter_value().integer_value,
+            'format': self.format,
+            'compression': compression,
+            'rotate_size': int(self.get_parameter('rotate_size').get_parameter_value().double_value*1e6),
+            'rotate_interval': self.get_parameter('rotate_interval').get_parameter_value().double_value,
+            'disk_budget': DiskBudget(disk_budget) if disk_budget > 0 else 0,     # Shared by the topic files (stream mode)
+            'logger': self.get_logger()}
+
+        if self.mode == 'snapshot':
+            #Latest values sampled in one wide row
+            self.writer = LogWriter(self.filename, SNAPSHOT_HEADER, **writer_options)
+            self.streams = None
+            timer_period = 0.2  # seconds
+            self.step_ack = StepAck(self)
+            self.timer = self.step_ack.create_timer(timer_period, self.write_file_callback)
+        else:
+            #Every message written at arrival to its topic file (rebuild wide table with log_join)
+            os.makedirs(self.filename, exist_ok=True)
+            self.writer = None
+            self.streams = {name: LogWriter(os.path.join(self.filename, name + FORMATS[self.format]), RECEIVE_COLUMNS + columns, **writer_options) \
+                for name, columns in STREAMS.items()}
 
         #Last data received
         self.entry_point = [0,0,0, 0,0]             #skin entry point + sec nanosec
@@ -72,13 +103,7 @@ class SaveFile(Node):
         self.aurora_base = [0,0,0,0,0,0,0, 0,0]     #aurora base data + sec nanosec
         self.Z = [0,0,0,0,0,0,0, 0,0]       #/sensor/tip_filtered (filtered and transformed to robot frame)
         self.X = [0,0,0,0,0,0,0, 0,0]       #/robot/needle_pose (transformed to robot frame)
-        self.J = [0,0,0,0,0,0,0, \
-                  0,0,0,0,0,0,0, \
-                  0,0,0,0,0,0,0, \
-                  0,0,0,0,0,0,0, \
-                  0,0,0,0,0,0,0, \
-                  0,0,0,0,0,0,0, \
-                  0,0,0,0,0,0,0]    #Jacobian matrix
+        self.J = jacobian_values([[0]])     #Jacobian matrix (padded to the logged 7x7 columns)
         self.Jtime = [0,0]          #Jacobian sec nanosec
         self.cmd = [0,0, 0,0]       #Control output + sec nanosec
         self.get_logger().info('Log data will be saved at %s' %(self.filename))   
@@ -87,6 +112,7 @@ class SaveFile(Node):
     #Get current entry_point
     def entry_point_callback(self, msg):
         self.entry_point = [msg.pose.position.x, msg.pose.position.y, msg.pose.position.z, int(msg.header.stamp.sec), int(msg.header.stamp.nanosec)]
+        self.stream('entry_point', self.entry_point)
 
     #Get Aurora data
     def aurora_callback(self, msg):
@@ -95,15 +121,18 @@ class SaveFile(Node):
         if msg.name=="NeedleToTracker": # Name is adjusted in Plus .xml
             self.aurora_tip = [aurora.translation.x, aurora.translation.y, aurora.translation.z, \
                 aurora.rotation.w, aurora.rotation.x, aurora.rotation.y, aurora.rotation.z, int(now.sec), int(now.nanosec)]
+            self.stream('aurora_tip', self.aurora_tip)
         if msg.name=="BaseToTracker": # Name is adjusted in Plus .xml
             self.aurora_base = [aurora.translation.x, aurora.translation.y, aurora.translation.z, \
                 aurora.rotation.w, aurora.rotation.x, aurora.rotation.y, aurora.rotation.z, int(now.sec), int(now.nanosec)]
+            self.stream('aurora_base', self.aurora_base)
 
     #Get current Z (filtered and in robot frame)
     def sensortip_callback(self, msg):
         tip = msg.pose
         self.Z = [tip.position.x, tip.position.y, tip.position.z, \
             tip.orientation.w, tip.orientation.x, tip.orientation.y, tip.orientation.z, int(msg.header.stamp.sec), int(msg.header.stamp.nanosec)]
+        self.stream('tip', self.Z)
         #self.get_logger().info('Received Z = %s in %s frame' % (self.Z, msg.header.frame_id))
 
     #Get current X
@@ -111,39 +140,44 @@ class SaveFile(Node):
         base = msg.pose
         self.X = [base.position.x, base.position.y, base.position.z, \
             base.orientation.w, base.orientation.x, base.orientation.y, base.orientation.z, int(msg.header.stamp.sec), int(msg.header.stamp.nanosec)]
+        self.stream('base', self.X)
         #self.get_logger().info('Received X = %s in %s frame' % (self.X, msg.header.frame_id))
         
     #Get current J
     def estimator_callback(self,msg):
-        self.J = np.array(CvBridge().imgmsg_to_cv2(msg)).flatten()
+        self.J = jacobian_values(CvBridge().imgmsg_to_cv2(msg))     # Estimator Jacobian is 5x3
         self.Jtime = [int(msg.header.stamp.sec), int(msg.header.stamp.nanosec)]
+        self.stream('jacobian', self.J + self.Jtime)
 
     #Get current control output
     def control_callback(self,msg):
         self.cmd = [msg.point.x, msg.point.z, int(msg.header.stamp.sec), int(msg.header.stamp.nanosec)]        
+        self.stream('control', self.cmd)
+
+    #Write received message to its topic file (stream mode only)
+    def stream(self, name, values):
+        if self.streams is not None:
+            now = self.get_clock().now().to_msg()
+            self.streams[name].write([now.sec, now.nanosec] + list(values))
         
     #Save data do file
     def write_file_callback(self):
         now = self.get_clock().now().to_msg()
        
-        data = [now.sec, now.nanosec, \
-            self.entry_point[0], self.entry_point[1], self.entry_point[2], self.entry_point[3], self.entry_point[4],\
-            self.aurora_tip[0], self.aurora_tip[1], self.aurora_tip[2], self.aurora_tip[3], self.aurora_tip[4], self.aurora_tip[5], self.aurora_tip[6], self.aurora_tip[7], self.aurora_tip[8], \
-            self.Z[0], self.Z[1], self.Z[2], self.Z[3], self.Z[4], self.Z[5], self.Z[6], self.Z[7], self.Z[8], \
-            self.aurora_base[0], self.aurora_base[1], self.aurora_base[2], self.aurora_base[3], self.aurora_base[4], self.aurora_base[5], self.aurora_base[6], self.aurora_base[7], self.aurora_base[8],\
-            self.X[0], self.X[1], self.X[2], self.X[3], self.X[4], self.X[5], self.X[6], self.X[7], self.X[8],\
-            self.J[0], self.J[1], self.J[2], self.J[3], self.J[4], self.J[5], self.J[6], \
-            self.J[7], self.J[8], self.J[9], self.J[10], self.J[11], self.J[12], self.J[13], \
-            self.J[14], self.J[15], self.J[16], self.J[17], self.J[18], self.J[19], self.J[20], \
-            self.J[21], self.J[22], self.J[23], self.J[24], self.J[25], self.J[26], self.J[27], \
-            self.J[28], self.J[29], self.J[30], self.J[31], self.J[32], self.J[33], self.J[34], \
-            self.J[35], self.J[36], self.J[37], self.J[38], self.J[39], self.J[40], self.J[41], \
-            self.J[42], self.J[43], self.J[44], self.J[45], self.J[46], self.J[47], self.J[48], self.Jtime[0] , self.Jtime[1], \
-            self.cmd[0], self.cmd[1], self.cmd[2], self.cmd[3]]
+        data = [now.sec, now.nanosec] + self.entry_point + self.aurora_tip + self.Z + self.aurora_base + self.X + \
+            self.J + self.Jtime + self.cmd      # Same order as SNAPSHOT_HEADER
         
-        with open(self.filename, 'a', newline='', encoding='UTF8') as f: # open the file in append mode
-            writer = csv.writer(f) # create the csv writer
-            writer.writerow(data)  # append a new row to the existing csv file     
+        if not self.writer.write(data): # queue row for the background writer
+            self.get_logger().info('Log queue full, %d rows dropped' % (self.writer.dropped))
+
+    # Write remaining rows and close file
+    def destroy_node(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.streams is not None:
+            for writer in self.streams.values():
+                writer.close()
+        super().destroy_node()
 
 def main(args=None):
     rclpy.init(args=args)
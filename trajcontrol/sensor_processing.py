@@ -3,15 +3,18 @@ import rclpy
 import numpy as np
 import time
 import keyboard
+import socket
+import threading
 import numpy.matlib 
-import quaternion
 
 from rclpy.node import Node
 from ros2_igtl_bridge.msg import Transform
 from numpy import asarray, savetxt, loadtxt
 from std_msgs.msg import Int8
 from geometry_msgs.msg import PoseStamped, Point, Quaternion
-from scipy.ndimage import median_filter
+from trajcontrol.pose_filter import median_last, pose_transform, FILTER_WINDOW, FILTER_SIZE
+from trajcontrol.igtl import MessageReader, unpack_transform, IGTL_PORT
+from trajcontrol.sim_clock import StepAck
 
 DIST_NEEDLE_BASE = 30.9
 
@@ -22,10 +25,27 @@ class SensorProcessing(Node):
 
         #Declare node parameters
         self.declare_parameter('registration',0) # Registration parameter: 0 = load previous / 1 = obtain new
-
-        #Topics from Aurora sensor node
-        self.subscription_sensor = self.create_subscription(Transform, 'IGTL_TRANSFORM_IN', self.aurora_callback, 10)
-        self.subscription_sensor # prevent unused variable warning
+        self.declare_parameter('filter_window', FILTER_WINDOW) # Number of last Aurora readings used by the median filter
+        self.declare_parameter('filter_size', FILTER_SIZE)     # Median filter size (samples)
+        self.declare_parameter('auto_entry', False) # Take the first filtered tip pose as entry point (simulation, no SPACE needed)
+        self.declare_parameter('igtl_direct', False)        # Read Aurora TRANSFORM messages from the OpenIGTLink server (no igtl_node)
+        self.declare_parameter('igtl_host', 'localhost')    # OpenIGTLink server (PLUS) address (igtl_direct)
+        self.declare_parameter('igtl_port', IGTL_PORT)      # OpenIGTLink server port (igtl_direct)
+
+        self.filter_window = self.get_parameter('filter_window').get_parameter_value().integer_value
+        self.filter_size = self.get_parameter('filter_size').get_parameter_value().integer_value
+
+        self.igtl_direct = self.get_parameter('igtl_direct').get_parameter_value().bool_value
+        if self.igtl_direct:
+            #Aurora readings from the OpenIGTLink socket (reader thread), republished for logging
+            self.publisher_sensor = self.create_publisher(Transform, 'IGTL_TRANSFORM_IN', 10)
+            self.igtl_socket = None
+            self.igtl_stop = threading.Event()
+            self.igtl_thread = threading.Thread(target=self.igtl_reader, daemon=True)    # Started once the stored values exist
+        else:
+            #Topics from Aurora sensor node
+            self.subscription_sensor = self.create_subscription(Transform, 'IGTL_TRANSFORM_IN', self.aurora_callback, 10)
+            self.subscription_sensor # prevent unused variable warning
 
         #Topic from keypress node
         self.subscription_keyboard = self.create_subscription(Int8, '/keyboard/key', self.keyboard_callback, 10)
@@ -34,11 +54,12 @@ class SensorProcessing(Node):
 
         #Published topics
         timer_period_entry = 0.5  # seconds
-        self.timer = self.create_timer(timer_period_entry, self.timer_entry_point_callback)        
+        self.step_ack = StepAck(self)
+        self.timer = self.step_ack.create_timer(timer_period_entry, self.timer_entry_point_callback)        
         self.publisher_entry_point = self.create_publisher(PoseStamped, '/subject/state/skin_entry', 10)
 
         timer_period = 0.2
-        self.timer = self.create_timer(timer_period_entry, self.timer_aurora_filtered_callback)
+        self.timer = self.step_ack.create_timer(timer_period_entry, self.timer_aurora_filtered_callback)
         self.publisher_tipfiltered = self.create_publisher(PoseStamped, '/sensor/tip_filtered', 10)
         self.publisher_basefiltered = self.create_publisher(PoseStamped,'/sensor/base_filtered', 10)
 
@@ -61,6 +82,10 @@ class SensorProcessing(Node):
         self.B = np.array([[25, 25, 25, 0, 0, 25, 25, 25, 0, 0], [0, 25, 40, 40, 25, 0, 25, 40, 40, 25], [0, 0, 0, 0, 0, 22.3, 22.3, 22.3, 22.3, 22.3]])     # registration points in stage frame
         self.keyboard_request = np.zeros(self.B.shape[1]+1)  # requests for key pressing (1 = already requested / 0 = to be requested). Quantity: #registration points + entry point
 
+        # Start reading the OpenIGTLink server (last: the reader thread uses every stored value)
+        if self.igtl_direct:
+            self.igtl_thread.start()
+
     def timer_entry_point_callback(self):
         # Publishes only after experiment started (stored entry point is available)
         if (self.entry_point.size != 0):
@@ -95,22 +120,22 @@ class SensorProcessing(Node):
     # Get current Aurora sensor measurements and publishes to '/needle/state/pose_filtered'
     def aurora_callback(self, msg_sensor):
         # Get needle shape from Aurora IGTL
-        name = msg_sensor.name      
+        self.aurora_reading(msg_sensor.name, np.array([[msg_sensor.transform.translation.x, msg_sensor.transform.translation.y, msg_sensor.transform.translation.z, \
+            msg_sensor.transform.rotation.w, msg_sensor.transform.rotation.x, msg_sensor.transform.rotation.y, msg_sensor.transform.rotation.z]]))
+
+    # Filter a new Aurora reading (1x7 [x, y, z, qw, qx, qy, qz]) of a tool
+    # Stored arrays are replaced, never modified in place (read safely by the timers while the IGTL reader thread runs)
+    def aurora_reading(self, name, reading):
         if name=="NeedleToTracker": # Name is adjusted in Plus .xml
             # Get aurora new reading
-            self.Z_sensor = np.array([[msg_sensor.transform.translation.x, msg_sensor.transform.translation.y, msg_sensor.transform.translation.z, \
-                msg_sensor.transform.rotation.w, msg_sensor.transform.rotation.x, msg_sensor.transform.rotation.y, msg_sensor.transform.rotation.z]])
+            self.Z_sensor = reading
 
             # Filter and transform Aurora data only after registration was performed or loaded from file
             if (self.registration.size != 0): 
                 self.auroraZ = np.row_stack((self.auroraZ, self.Z_sensor))
 
                 # Smooth the measurements with a median filter 
-                n = self.auroraZ.shape[0]
-                size_win = min(n, 500) #array window size
-                if (size_win>0): 
-                    Z_filt = median_filter(self.auroraZ[n-size_win:n,:], size=(40,1)) # use 40 samples median filter (column-wise)
-                    Z_sensor = Z_filt[size_win-1,:]                                  # get last value
+                Z_sensor = median_last(self.auroraZ[-self.filter_window:,:], self.filter_size) # last value of median filter (column-wise)
                             
                 # Transform from sensor to robot frame
                 self.Z = pose_transform(Z_sensor, self.registration)
@@ -118,23 +143,85 @@ class SensorProcessing(Node):
     
         if name=="BaseToTracker": # Name is adjusted in Plus .xml
             # Get aurora new reading
-            self.X_sensor = np.array([[msg_sensor.transform.translation.x, msg_sensor.transform.translation.y, msg_sensor.transform.translation.z, \
-                msg_sensor.transform.rotation.w, msg_sensor.transform.rotation.x, msg_sensor.transform.rotation.y, msg_sensor.transform.rotation.z]])
+            self.X_sensor = reading
 
             # Filter and transform Aurora data only after registration was loaded from file
             if (self.registration.size != 0): 
                 self.auroraX = np.row_stack((self.auroraX, self.X_sensor))
 
                 # Smooth the measurements with a median filter 
-                n = self.auroraX.shape[0]
-                size_win = min(n, 500) #array window size
-                if (size_win>0): 
-                    X_filt = median_filter(self.auroraX[n-size_win:n,:], size=(40,1)) # use 40 samples median filter (column-wise)
-                    X_sensor = X_filt[size_win-1,:]                                  # get last value
+                X_sensor = median_last(self.auroraX[-self.filter_window:,:], self.filter_size) # last value of median filter (column-wise)
                             
                 # Transform from sensor to robot frame
                 self.X = pose_transform(X_sensor, self.registration)
 
+    # Reader thread (igtl_direct): connect to the OpenIGTLink server, decode TRANSFORM messages in place
+    # and feed the filters, reconnecting when the server goes away
+    def igtl_reader(self):
+        host = self.get_parameter('igtl_host').get_parameter_value().string_value
+        port = self.get_parameter('igtl_port').get_parameter_value().integer_value
+        waiting = False
+        while not self.igtl_stop.is_set():
+            try:
+                self.igtl_socket = socket.create_connection((host, port), timeout=1.0)
+            except OSError:
+                if not waiting:
+                    self.get_logger().info('Waiting for OpenIGTLink server at %s:%d' % (host, port))
+                    waiting = True
+                self.igtl_stop.wait(1.0)
+                continue
+            waiting = False
+            self.igtl_socket.settimeout(None)
+            self.igtl_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.get_logger().info('Connected to OpenIGTLink server at %s:%d' % (host, port))
+            reader = MessageReader()
+            try:
+                while True:
+                    messages = reader.recv(self.igtl_socket)
+                    if messages is None:    # Server closed
+                        break
+                    for msg_type, name, _, body in messages:
+                        try:
+                            if msg_type == 'TRANSFORM':
+                                reading = unpack_transform(body)
+                                self.aurora_reading(name, reading[None,:])
+                                self.publish_sensor(name, reading)
+                        except Exception as e:     # Bad frame or processing error: skip the reading, keep the connection
+                            self.get_logger().error('OpenIGTLink %s %s skipped (%s: %s)' % (msg_type, name, type(e).__name__, e), \
+                                throttle_duration_sec=1.0)
+                        body.release()
+                    del messages
+            except OSError:
+                pass
+            except Exception as e:                  # Stream error: reconnect
+                self.get_logger().error('OpenIGTLink reader error (%s: %s), reconnecting' % (type(e).__name__, e))
+            self.igtl_socket.close()
+            if not self.igtl_stop.is_set():
+                self.get_logger().info('OpenIGTLink server disconnected')
+
+    # Republish a raw Aurora reading on IGTL_TRANSFORM_IN (logging, same message as igtl_node)
+    def publish_sensor(self, name, reading):
+        msg = Transform()
+        msg.name = name
+        msg.transform.translation.x = float(reading[0])
+        msg.transform.translation.y = float(reading[1])
+        msg.transform.translation.z = float(reading[2])
+        msg.transform.rotation.w = float(reading[3])
+        msg.transform.rotation.x = float(reading[4])
+        msg.transform.rotation.y = float(reading[5])
+        msg.transform.rotation.z = float(reading[6])
+        self.publisher_sensor.publish(msg)
+
+    def destroy_node(self):
+        if self.igtl_direct:
+            self.igtl_stop.set()
+            if self.igtl_socket is not None:
+                try:
+                    self.igtl_socket.shutdown(socket.SHUT_RDWR)     # Wake up the reader thread
+                except OSError:
+                    pass
+            self.igtl_thread.join(timeout=2.0)
+        return super().destroy_node()
 
     # A keyboard hotkey was pressed 
     def keyboard_callback(self, msg):
@@ -181,7 +268,11 @@ class SensorProcessing(Node):
             
     def get_entry_point(self):
         # Get entry point if nothing was stored
-        if (self.entry_point.size == 0):
+        if self.get_parameter('auto_entry').get_parameter_value().bool_value:
+            # No keyboard: wait for the first filtered reading (no wall clock sleep, runs with simulated time)
+            if (self.entry_point.size == 0) and (self.Z.size != 0):
+                self.entry_point = self.Z #Store entry point
+        elif (self.entry_point.size == 0):
             #Listen to keyboard
             self.listen_keyboard = True         
             if (self.keyboard_request[-1] == 0): # Print request message only once 
@@ -232,32 +323,6 @@ def find_registration(A, B):
 
 ########################################################################
 
-# Function: pose_transform
-# DO: Transform pose to new reference frame
-# Inputs: 
-#   x_origin: pose in original reference frame (numpy array [x, y, z, qw, qx, qy, qz])
-#   x_tf: transformation from original to new frame (numpy array [x, y, z, qw, qx, qy, qz])
-# Output:
-#   x_new: pose in new reference frame (numpy array [x, y, z, qw, qx, qy, qz])
-def pose_transform(x_orig, x_tf):
-
-    #Define frame transformation
-    p_tf = np.quaternion(0, x_tf[0], x_tf[1], x_tf[2])
-    q_tf= np.quaternion(x_tf[3], x_tf[4], x_tf[5], x_tf[6])
-
-    #Define original position and orientation
-    p_orig = np.quaternion(0, x_orig[0], x_orig[1], x_orig[2])
-    q_orig = np.quaternion(x_orig[3], x_orig[4], x_orig[5], x_orig[6])
-
-    #Transform to new frame
-    q_new = q_tf*q_orig
-    p_new = q_tf*p_orig*q_tf.conj() + p_tf
-
-    x_new = np.array([p_new.x, p_new.y, p_new.z, q_new.w, q_new.x, q_new.y, q_new.z])
-    return x_new
-
-########################################################################
-
 def main(args=None):
     rclpy.init(args=args)
 
@@ -0,0 +1,196 @@
+import rclpy
+import numpy as np
+
+from rclpy.node import Node
+from geometry_msgs.msg import PoseArray, PoseStamped, Vector3Stamped
+from geometry_msgs.msg import Quaternion, Point, Vector3
+from sensor_msgs.msg import PointCloud2, PointField
+from std_msgs.msg import Float64
+from trajcontrol.pose_filter import pose_transform
+
+FITS = ('polynomial', 'arc')
+STRAIGHT_RADIUS = 1e4           # Arcs with a larger radius are fitted as straight lines (mm)
+NEEDLE_AXIS = np.array([0.0, 0.0, 1.0])     # Insertion axis of the shape (needle) frame
+# Shape (needle) frame to stage frame rotation: needle z = stage y (insertion), needle y = stage -z
+SHAPE_ROTATION = [0.7071068, -0.7071068, 0.0, 0.0]
+POINT_TYPES = {PointField.FLOAT32: '<f4', PointField.FLOAT64: '<f8'}
+
+# Class: ShapeProcessing
+# DO: Tip pose, tangent and curvature from the FBG needle shape (/needle/state/shape or /needle/state/shape_cloud)
+#     Fits a cubic polynomial in arc length or a constant curvature arc to the last 'fit_length' mm of each shape
+#     and publishes the tip in the stage frame on /sensor/tip_shape
+#     Standalone node (ros2 run trajcontrol shape_processing): no launch file starts it and the estimator
+#     and controllers still use the Aurora tip (/sensor/tip_filtered) only
+#     Shape frame origin is the skin entry point (shape length = insertion depth)
+class ShapeProcessing(Node):
+
+    def __init__(self):
+        super().__init__('shape_processing')
+
+        #Declare node parameters
+        self.declare_parameter('fit', 'polynomial')         #Shape model: polynomial / arc (constant curvature)
+        self.declare_parameter('degree', 3)                 #Polynomial degree
+        self.declare_parameter('fit_length', 30.0)          #Length of shape fitted behind the tip (mm, 0 = whole shape)
+        self.declare_parameter('rotation', SHAPE_ROTATION)  #Shape frame orientation in stage frame [qw, qx, qy, qz]
+
+        self.fit = self.get_parameter('fit').get_parameter_value().string_value
+        if self.fit not in FITS:
+            raise ValueError('Unknown shape fit %s (%s)' % (self.fit, ', '.join(FITS)))
+        self.degree = self.get_parameter('degree').get_parameter_value().integer_value
+        self.fit_length = self.get_parameter('fit_length').get_parameter_value().double_value
+        self.rotation = np.array(self.get_parameter('rotation').get_parameter_value().double_array_value)
+
+        #Topics from virtual sensor (or FBG interrogator) node
+        self.subscription_shape = self.create_subscription(PoseArray, '/needle/state/shape', self.shape_callback, 10)
+        self.subscription_shape # prevent unused variable warning
+        self.subscription_cloud = self.create_subscription(PointCloud2, '/needle/state/shape_cloud', self.cloud_callback, 10)
+        self.subscription_cloud # prevent unused variable warning
+
+        #Topics from sensor processing node
+        self.subscription_entry_point = self.create_subscription(PoseStamped, '/subject/state/skin_entry', self.entry_callback, 10)
+        self.subscription_entry_point  # prevent unused variable warning
+
+        #Published topics
+        self.publisher_tip = self.create_publisher(PoseStamped, '/sensor/tip_shape', 10)
+        self.publisher_tangent = self.create_publisher(Vector3Stamped, '/needle/state/tip_tangent', 10)
+        self.publisher_curvature = self.create_publisher(Float64, '/needle/state/curvature', 10)
+
+        # Stored values
+        self.registration = np.empty(shape=[0])     # Shape frame to stage frame (after entry point)
+
+    # Get current entry point (origin of the shape frame)
+    def entry_callback(self, msg):
+        if (self.registration.size == 0):
+            entry_point = msg.pose.position
+            self.registration = np.concatenate(([entry_point.x, entry_point.y, entry_point.z], self.rotation))
+            self.get_logger().info('Shape registered at entry point: x=%f, y=%f, z=%f' % (entry_point.x, entry_point.y, entry_point.z))
+
+    def shape_callback(self, msg):
+        X = np.array([(pose.position.x, pose.position.y, pose.position.z) for pose in msg.poses], dtype=float).reshape(-1, 3)
+        self.publish_tip(X, msg.header.stamp)
+
+    def cloud_callback(self, msg):
+        self.publish_tip(cloud_points(msg), msg.header.stamp)
+
+    # Fit shape and publish tip (stage frame), tangent and curvature
+    def publish_tip(self, X, stamp):
+        if (self.registration.size == 0) or (X.shape[0] < 2):
+            return
+        X = shape_window(X, self.fit_length)
+        if self.fit == 'arc':
+            tip, tangent, curvature = fit_arc(X)
+        else:
+            tip, tangent, curvature = fit_polynomial(X, self.degree)
+        pose = pose_transform(np.concatenate((tip, axis_quaternion(tangent))), self.registration)
+        tangent = pose_transform(np.concatenate((tangent, [1.0, 0.0, 0.0, 0.0])), np.concatenate(([0.0, 0.0, 0.0], self.rotation)))[0:3]
+
+        msg = PoseStamped()
+        msg.header.stamp = stamp
+        msg.header.frame_id = 'stage'
+        msg.pose.position = Point(x=pose[0], y=pose[1], z=pose[2])
+        msg.pose.orientation = Quaternion(w=pose[3], x=pose[4], y=pose[5], z=pose[6])
+        self.publisher_tip.publish(msg)
+
+        msg = Vector3Stamped()
+        msg.header.stamp = stamp
+        msg.header.frame_id = 'stage'
+        msg.vector = Vector3(x=tangent[0], y=tangent[1], z=tangent[2])
+        self.publisher_tangent.publish(msg)
+
+        self.publisher_curvature.publish(Float64(data=float(curvature)))
+
+########################################################################
+### Shape fitting ###
+########################################################################
+
+# Function: cloud_points
+# DO: Shape points of a PointCloud2 (x, y, z fields read in place from the data buffer)
+def cloud_points(msg):
+    fields = {field.name: field for field in msg.fields}
+    dtype = np.dtype({'names': ['x', 'y', 'z'], 'formats': [POINT_TYPES[fields[name].datatype] for name in 'xyz'], \
+        'offsets': [fields[name].offset for name in 'xyz'], 'itemsize': msg.point_step})
+    points = np.frombuffer(msg.data, dtype=dtype, count=msg.width*msg.height)
+    return np.column_stack((points['x'], points['y'], points['z'])).astype(float)
+
+# Function: shape_window
+# DO: Last points of a shape (base to tip) covering fit_length of arc length (all points if fit_length <= 0)
+def shape_window(X, fit_length):
+    if fit_length <= 0:
+        return X
+    s = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(X, axis=0), axis=1))))
+    first = min(int(np.searchsorted(s, s[-1] - fit_length, side='right')), X.shape[0]-2)
+    return X[max(first-1, 0):]
+
+# Function: fit_polynomial
+# DO: Least squares polynomial of the shape in arc length (all coordinates at once), evaluated at the tip
+# Inputs:
+#   X: shape points from base to tip (numpy array Nx3)
+#   degree: polynomial degree (reduced for short shapes)
+# Output:
+#   tip: tip position, tangent: unit tangent at the tip, curvature: curvature at the tip (1/mm)
+def fit_polynomial(X, degree=3):
+    s = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(X, axis=0), axis=1))))
+    length = max(s[-1], 1e-9)
+    u = s/length                                        # Normalized arc length (conditioning)
+    coef = np.polynomial.polynomial.polyfit(u, X, min(degree, X.shape[0]-1))
+    tip = np.polynomial.polynomial.polyval(1.0, coef)
+    d1 = np.polynomial.polynomial.polyval(1.0, np.polynomial.polynomial.polyder(coef))/length
+    d2 = np.polynomial.polynomial.polyval(1.0, np.polynomial.polynomial.polyder(coef, 2))/length**2
+    speed = np.linalg.norm(d1)
+    curvature = np.linalg.norm(np.cross(d1, d2))/max(speed, 1e-12)**3
+    return tip, d1/max(speed, 1e-12), curvature
+
+# Function: fit_arc
+# DO: Constant curvature (circular arc) fit of the shape: best plane by SVD, algebraic circle fit in the plane
+#     Nearly straight shapes are fitted by a line (curvature 0)
+# Inputs:
+#   X: shape points from base to tip (numpy array Nx3)
+# Output:
+#   tip: tip position (last point projected on the arc), tangent: unit tangent at the tip, curvature: 1/radius
+def fit_arc(X):
+    center = X.mean(axis=0)
+    _, _, V = np.linalg.svd(X - center, full_matrices=False)
+    P = (X - center) @ V[0:2].T                         # Points in the best fit plane
+    direction = X[-1] - X[0]
+
+    A = np.column_stack((2*P, np.ones(P.shape[0])))
+    (a, b, c), _, rank, _ = np.linalg.lstsq(A, np.sum(P**2, axis=1), rcond=None)
+    radius = np.sqrt(max(c + a*a + b*b, 0.0))
+    if (X.shape[0] < 3) or (rank < 3) or (radius > STRAIGHT_RADIUS) or (radius == 0):
+        # Straight line: principal direction through the centroid
+        tangent = V[0]*np.sign(np.dot(V[0], direction) or 1.0)
+        return center + np.dot(X[-1] - center, tangent)*tangent, tangent, 0.0
+
+    radial = P[-1] - [a, b]
+    radial = radial/np.linalg.norm(radial)
+    tip = center + ([a, b] + radius*radial) @ V[0:2]
+    tangent = np.array([-radial[1], radial[0]]) @ V[0:2]
+    if np.dot(tangent, X[-1] - X[-2]) < 0:              # Tangent along the insertion (base to tip)
+        tangent = -tangent
+    return tip, tangent, 1.0/radius
+
+# Function: axis_quaternion
+# DO: Shortest rotation [qw, qx, qy, qz] taking the needle axis (shape frame z) to a unit vector
+def axis_quaternion(t):
+    w = 1.0 + np.dot(NEEDLE_AXIS, t)
+    if w < 1e-9:
+        return np.array([0.0, 1.0, 0.0, 0.0])            # Opposite direction: half turn about x
+    q = np.concatenate(([w], np.cross(NEEDLE_AXIS, t)))
+    return q/np.linalg.norm(q)
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    shape_processing = ShapeProcessing()
+
+    rclpy.spin(shape_processing)
+
+    # Destroy the node explicitly
+    # (optional - otherwise it will be done automatically
+    # when the garbage collector destroys the node object)
+    shape_processing.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
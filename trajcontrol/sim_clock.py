@@ -0,0 +1,194 @@
+import time
+import rclpy
+
+from rclpy.node import Node
+from rosgraph_msgs.msg import Clock
+from std_msgs.msg import Header
+from rosidl_runtime_py.utilities import get_message
+
+ACK_TOPIC = '/sim_clock/ack'
+IGNORED_TOPICS = ('/clock', '/rosout', '/parameter_events', ACK_TOPIC)     # Traffic that does not mean a node is busy
+
+########################################################################
+### Step acknowledgement ###
+########################################################################
+
+# Class: StepAck
+# DO: Per-step acknowledgement of a node timers to sim_clock (only with use_sim_time)
+#     Timers created here publish on ACK_TOPIC after each callback: frame_id = node name,
+#     stamp = next time one of the node timers is due (the node is done with every step before it)
+#     sim_clock does not advance past a step while an acknowledging node is due and has not answered
+class StepAck():
+
+    def __init__(self, node):
+        self.node = node
+        self.timers = []
+        self.publisher = None
+        if node.get_parameter('use_sim_time').get_parameter_value().bool_value:
+            self.publisher = node.create_publisher(Header, ACK_TOPIC, 100)
+
+    # Same as Node.create_timer, acknowledged after each callback
+    def create_timer(self, period, callback):
+        def acknowledged():
+            callback()
+            self.done()
+        timer = self.node.create_timer(period, acknowledged)
+        self.timers.append(timer)
+        return timer
+
+    def done(self):
+        waits = [timer.time_until_next_call() for timer in self.timers if not timer.is_canceled()]
+        waits = [wait for wait in waits if wait is not None]
+        if (self.publisher is None) or (not waits):
+            return
+        due = self.node.get_clock().now().nanoseconds + max(min(waits), 0)
+        msg = Header()
+        msg.stamp.sec = int(due // 1000000000)
+        msg.stamp.nanosec = int(due % 1000000000)
+        msg.frame_id = self.node.get_name()
+        self.publisher.publish(msg)
+
+########################################################################
+### Simulation clock ###
+########################################################################
+
+# Class: SimClock
+# DO: Stepping master for simulated runs (nodes started with use_sim_time = true)
+#     Publishes /clock in fixed steps and advances as soon as the graph is done with the step:
+#     - every StepAck node due at the step has acknowledged it (it published its outputs before acknowledging)
+#     - no subscription traffic is outstanding: messages seen after the last acknowledgement come from
+#       subscription driven chains, so the step then also waits until nothing was published for 'quiet' seconds
+#       (a few ms at most: far below the step, only covers DDS delivery of those chains)
+#     Steps where no node is due and nothing is published end at once
+#     After 'max_wait' seconds it advances anyway, so that a stuck node cannot stall the run
+#     Timers of all nodes then fire as fast as the pipeline can process them instead of in real time
+class SimClock(Node):
+
+    def __init__(self):
+        super().__init__('sim_clock')
+
+        #Declare node parameters
+        self.declare_parameter('step', 0.02)        #Clock step (s, simulation time)
+        self.declare_parameter('quiet', 0.002)      #Idle time after subscription traffic before the next step (s, wall time, a few ms at most)
+        self.declare_parameter('max_wait', 0.5)     #Maximum wait for acknowledgements and idle graph (s, wall time)
+        self.declare_parameter('max_speed', 0.0)    #Maximum speed factor over real time (0 = as fast as possible)
+        self.declare_parameter('start', 0.0)        #Initial simulation time (s, 0 = current wall time)
+        self.declare_parameter('duration', 0.0)     #Stop stepping after this simulation time (s, 0 = never)
+
+        self.step = int(self.get_parameter('step').get_parameter_value().double_value*1e9)
+        self.quiet = self.get_parameter('quiet').get_parameter_value().double_value
+        self.max_wait = self.get_parameter('max_wait').get_parameter_value().double_value
+        self.max_speed = self.get_parameter('max_speed').get_parameter_value().double_value
+        start = self.get_parameter('start').get_parameter_value().double_value
+        self.start = int(start*1e9) if start > 0 else time.time_ns()
+        self.duration = int(self.get_parameter('duration').get_parameter_value().double_value*1e9)
+        self.now = self.start
+
+        #Published topics
+        self.publisher_clock = self.create_publisher(Clock, '/clock', 10)
+
+        #Step acknowledgements (StepAck nodes: next time each node is due)
+        self.subscription_ack = self.create_subscription(Header, ACK_TOPIC, self.ack_callback, 100)
+        self.subscription_ack  # prevent unused variable warning
+        self.due = {}
+        self.late = 0           # Steps advanced by max_wait while a node had not acknowledged
+        self.last_ack = 0.0     # Wall time of the last acknowledgement
+
+        #Graph activity (one raw subscription per topic, discovered while running)
+        self.watched = {}
+        self.last_activity = time.monotonic()
+        self.last_discovery = 0.0
+        self.wall_start = time.monotonic()
+        self.last_report = self.wall_start
+
+    # Stepping finished (duration reached)
+    def finished(self):
+        return (self.duration > 0) and (self.now - self.start >= self.duration)
+
+    # Subscribe to topics created since last call
+    def discover(self):
+        for name, types in self.get_topic_names_and_types():
+            if (name in IGNORED_TOPICS) or (name in self.watched) or (not types):
+                continue
+            try:
+                msg_type = get_message(types[0])
+            except (AttributeError, ModuleNotFoundError, ValueError):
+                continue                # Message package not available here: topic not watched
+            self.watched[name] = self.create_subscription(msg_type, name, self.activity_callback, 10, raw=True)
+
+    def activity_callback(self, msg):
+        self.last_activity = time.monotonic()
+
+    def ack_callback(self, msg):
+        self.due[msg.frame_id] = msg.stamp.sec*1000000000 + msg.stamp.nanosec
+        self.last_ack = time.monotonic()
+
+    # Acknowledging nodes still working on the current step
+    def pending(self):
+        return [name for name, due in self.due.items() if due <= self.now]
+
+    # Publish current time, wait until the graph is idle and advance one step
+    def tick(self):
+        wall = time.monotonic()
+        if wall - self.last_discovery >= 1.0:
+            self.discover()
+            self.last_discovery = wall
+
+        msg = Clock()
+        msg.clock.sec = int(self.now // 1000000000)
+        msg.clock.nanosec = int(self.now % 1000000000)
+        self.publisher_clock.publish(msg)
+
+        self.last_activity = 0.0
+        self.last_ack = 0.0
+        while rclpy.ok():
+            if not self.pending():
+                # Acknowledged: done unless subscription traffic followed the last acknowledgement
+                if self.last_activity <= self.last_ack:
+                    rclpy.spin_once(self, timeout_sec=0.0)      # Traffic already delivered to this node
+                    if self.last_activity <= self.last_ack:
+                        break
+                elif time.monotonic() - self.last_activity >= self.quiet:
+                    break
+            now = time.monotonic()
+            if now - wall >= self.max_wait:
+                late = self.pending()
+                if late:
+                    self.late += 1
+                    self.get_logger().info('No acknowledgement from %s after %.2f s (%d late steps), not waited for until it answers again' % \
+                        (', '.join(late), self.max_wait, self.late))
+                    for name in late:
+                        del self.due[name]      # Stopped or stuck node
+                break
+            rclpy.spin_once(self, timeout_sec=self.quiet)
+        if self.max_speed > 0:
+            remaining = self.step*1e-9/self.max_speed - (time.monotonic() - wall)
+            if remaining > 0:
+                time.sleep(remaining)
+        self.now += self.step
+
+        if time.monotonic() - self.last_report >= 10.0:
+            self.last_report = time.monotonic()
+            self.get_logger().info('Simulation time %.1f s (%.1fx real time)' % ((self.now - self.start)*1e-9, \
+                (self.now - self.start)*1e-9/(self.last_report - self.wall_start)))
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    sim_clock = SimClock()
+
+    while rclpy.ok() and not sim_clock.finished():
+        sim_clock.tick()
+    wall = time.monotonic() - sim_clock.wall_start
+    sim_clock.get_logger().info('Simulation finished at %.1f s in %.1f s (%.1fx real time, %d late steps)' % \
+        ((sim_clock.now - sim_clock.start)*1e-9, wall, (sim_clock.now - sim_clock.start)*1e-9/max(wall, 1e-9), sim_clock.late))
+
+    # Destroy the node explicitly
+    # (optional - otherwise it will be done automatically
+    # when the garbage collector destroys the node object)
+    sim_clock.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
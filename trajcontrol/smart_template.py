@@ -4,24 +4,29 @@ import numpy as np
 import ament_index_python 
 import serial
 import time
-import quaternion
+import threading
 
 from rclpy.action import ActionServer, CancelResponse, GoalResponse
 from rclpy.callback_groups import ReentrantCallbackGroup
 from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
+from rclpy.time import Time
+from rclpy.task import Future
 from stage_control_interfaces.action import MoveStage
 from ros2_igtl_bridge.msg import Transform
 from numpy import asarray, savetxt, loadtxt
-from scipy.ndimage import median_filter
 
 from geometry_msgs.msg import PoseStamped
 from geometry_msgs.msg import Quaternion
 from transforms3d.euler import euler2quat
 from scipy.io import loadmat
 from std_msgs.msg import Int8
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
 from datetime import datetime
+from trajcontrol.pose_filter import median_last, pose_transform, FILTER_WINDOW, FILTER_SIZE
+from trajcontrol.galil import GalilPort, GalilError, GalilConnection, DataRecordParser, DataRecordReader, SampleClock, axes_command, axes_list, \
+    record_bandwidth, min_record_period
 
 MM_2_COUNT = 1088.9
 COUNT_2_MM = 1.0/1088.9
@@ -32,6 +37,19 @@ class SmartTemplate(Node):
     def __init__(self):
         super().__init__('smart_template')      
 
+        #Declare node parameters
+        self.declare_parameter('position_source', 'poll')   # Stage position source: 'poll' = TP request / 'record' = Galil data record stream
+        self.declare_parameter('record_period', 8)          # Data record period (controller samples between records)
+        self.declare_parameter('record_port', 0)            # Data record output port/handle (DR second argument)
+        self.declare_parameter('serial_port', '')           # Galil serial port ('' = discover by USB attributes or probe handshake)
+        self.declare_parameter('usb_vid', 0)                # USB vendor id of the Galil serial adapter (0 = any)
+        self.declare_parameter('usb_pid', 0)                # USB product id of the Galil serial adapter (0 = any)
+        self.declare_parameter('usb_serial', '')            # USB serial number of the Galil serial adapter ('' = any)
+        self.declare_parameter('ping_period', 1.0)          # Link health check period (seconds)
+        self.declare_parameter('poll_period', 0.2)          # TP polling period (seconds)
+        self.declare_parameter('move_tolerance', 0.05)      # MoveStage goal reached when both axes are within tolerance (mm), unless goal eps > 0
+        self.declare_parameter('move_timeout', 10.0)        # MoveStage goal aborted if not reached after timeout (seconds)
+
         #Topics from Aurora sensor node
         self.subscription_sensor = self.create_subscription(Transform, 'IGTL_TRANSFORM_IN', self.aurora_callback, 10)
         self.subscription_sensor # prevent unused variable warning
@@ -41,92 +59,230 @@ class SmartTemplate(Node):
         self.subscription_entry_point  # prevent unused variable warning
 
         #Published topics
-        timer_period = 0.2  # seconds
-        self.timer = self.create_timer(timer_period, self.timer_needle_pose_callback)
+        self.position_source = self.get_parameter('position_source').get_parameter_value().string_value
+        self.timer = None
+        if self.position_source != 'record':
+            timer_period = self.get_parameter('poll_period').get_parameter_value().double_value  # seconds
+            self.timer = self.create_timer(timer_period, self.timer_needle_pose_callback)
         self.publisher_needle_pose = self.create_publisher(PoseStamped, '/stage/state/needle_pose', 10)
+        self.publisher_link = self.create_publisher(DiagnosticArray, '/diagnostics', 10)
+        self.timer_link = self.create_timer(1.0, self.timer_link_callback)
+        self.timer_goal_timeout = self.create_timer(0.1, self.timer_goal_timeout_callback)
 
         #Action server
         self._action_server = ActionServer(self, MoveStage, '/move_stage', execute_callback=self.execute_callback,\
             callback_group=ReentrantCallbackGroup(), goal_callback=self.goal_callback, cancel_callback=self.cancel_callback)
 
-        #Start serial communication
-        try:
-            self.ser = serial.Serial('/dev/ttyUSB1', baudrate=115200, timeout=1)  # open serial port
-            self.connectionStatus = True
-            self.get_logger().info('Serial connection open ttyUSB1')
-            print(self.ser.is_open)
-        except:
-            try:
-                self.ser = serial.Serial('/dev/ttyUSB2', baudrate=115200, timeout=1)  # open serial port
-                self.get_logger().info('Serial connection open ttyUSB2')
-                print(self.ser.is_open)
-            except:
-                try:
-                    self.ser = serial.Serial('/dev/ttyUSB3', baudrate=115200, timeout=1)  # open serial port
-                    self.get_logger().info('Serial connection open ttyUSB3')
-                    print(self.ser.is_open)
-                except:
-                    self.get_logger().info('Could not open Serial connection')
-
-
 
         #Stored values
         self.entry_point = np.empty(shape=[0,7])    # Initial needle tip pose
         self.registration = np.empty(shape=[0,7])   # Registration transform (from aurora to stage)
         self.aurora = np.empty(shape=[0,7])         # All stored Aurora readings as they are sent
         self.needle_base = np.empty(shape=[0,7])    # Base sensor value (filtered and transformed to stage frame)
+        self.record_reader = None                   # Galil data record reader thread
+        self.record_rate = None                     # Requested / configured / bandwidth data record rates (Hz)
+        self.motor_position = None                  # Last encoder reading [A, B] (counts)
+        self.active_goals = {}                      # MoveStage goals waiting for motion completion
+        self.goals_lock = threading.Lock()
+
+        #Start serial communication (link monitor reconnects if the controller is lost)
+        self.galil = GalilPort(None)
+        self.connection = GalilConnection(self.galil, \
+            port=self.get_parameter('serial_port').get_parameter_value().string_value, \
+            vid=self.get_parameter('usb_vid').get_parameter_value().integer_value, \
+            pid=self.get_parameter('usb_pid').get_parameter_value().integer_value, \
+            serial_number=self.get_parameter('usb_serial').get_parameter_value().string_value, \
+            ping_period=self.get_parameter('ping_period').get_parameter_value().double_value, \
+            on_connect=self.connect_callback, on_disconnect=self.disconnect_callback, log=self.get_logger().info)
+        if not self.connection.connect():
+            self.get_logger().info('Could not open Serial connection (retrying)')
+        self.connection.start()
+
+    # Serial link (re)established
+    def connect_callback(self, ser):
+        # Stream stage position from Galil data records instead of polling TP
+        if self.position_source == 'record':
+            self.start_data_record()
+
+    # Serial link lost
+    def disconnect_callback(self):
+        if self.record_reader is not None:
+            self.record_reader.stop()
+            self.record_reader = None
+            self.galil.streaming = False
+
+    # Publish serial link health and round-trip latency statistics
+    def timer_link_callback(self):
+        stats = self.connection.stats()
+        status = DiagnosticStatus()
+        status.name = 'smart_template: galil link'
+        status.hardware_id = stats['device']
+        status.level = DiagnosticStatus.OK if stats['connected'] else DiagnosticStatus.ERROR
+        status.message = 'connected' if stats['connected'] else 'disconnected'
+        status.values = [KeyValue(key=key, value=str(value)) for key, value in stats.items()]
+        msg = DiagnosticArray()
+        msg.header.stamp = self.get_clock().now().to_msg()
+        msg.status = [status]
+        if self.position_source == 'record':
+            msg.status.append(self.record_status())
+        self.publisher_link.publish(msg)
+
+    # Data record stream: configured and measured record rate
+    def record_status(self):
+        status = DiagnosticStatus()
+        status.name = 'smart_template: galil data record'
+        status.hardware_id = self.connection.device
+        reader = self.record_reader
+        if (reader is None) or (self.record_rate is None):
+            status.level = DiagnosticStatus.WARN
+            status.message = 'not streaming (polling TP)' if self.timer is not None else 'not streaming'
+            return status
+        values = dict(self.record_rate, measured_rate=reader.rate(), records=reader.records, dropped_bytes=reader.parser.dropped)
+        status.level = DiagnosticStatus.OK if values['measured_rate'] >= 0.9*values['configured_rate'] else DiagnosticStatus.WARN
+        status.message = '%.1f Hz measured (%.1f Hz configured)' % (values['measured_rate'], values['configured_rate'])
+        status.values = [KeyValue(key=key, value=str(value)) for key, value in values.items()]
+        return status
 
     def getMotorPosition(self):
         try:
-            self.ser.flushInput()
-            time.sleep(0.05)
-            self.ser.write(str.encode("TP;"))
-            time.sleep(0.05)
-            bytesToRead = self.ser.inWaiting()
-            data_temp = self.ser.read(bytesToRead-3)
+            data_temp = self.galil.query("TP")
         except:
             self.status = 0
             return str(0)
         return data_temp
 
+    # Configure Galil periodic data record output and start reader thread
+    def start_data_record(self):
+        try:
+            layout = self.galil.query("QZ")
+            sample_time = float(self.galil.query("MG TM"))*1e-6
+            parser = DataRecordParser.from_qz(str.encode(layout))
+        except Exception as e:
+            self.get_logger().info('Could not configure Galil data record (%s), polling TP instead' % (e))
+            if self.timer is None:
+                self.timer = self.create_timer(self.get_parameter('poll_period').get_parameter_value().double_value, self.timer_needle_pose_callback)
+            return
+        self.sample_clock = SampleClock(sample_time)
+        self.record_reader = DataRecordReader(self.galil.ser, parser, self.record_callback, self.galil.on_text)
+        self.galil.streaming = True
+        self.record_reader.start()
+        requested = self.get_parameter('record_period').get_parameter_value().integer_value
+        record_port = self.get_parameter('record_port').get_parameter_value().integer_value
+        # Records cannot be sent faster than the serial line carries them: clamp the period to the bandwidth
+        baudrate = self.galil.ser.baudrate
+        record_period = max(requested, min_record_period(parser.record_size, sample_time, baudrate))
+        if record_period != requested:
+            self.get_logger().info('Requested data record rate %.1f Hz exceeds the serial bandwidth (%.1f Hz for %d byte records at %d baud), using DR %d' % \
+                (1.0/(requested*sample_time), record_bandwidth(parser.record_size, baudrate), parser.record_size, baudrate, record_period))
+        self.galil.send("DR %d,%d" % (record_period, record_port))
+        self.record_rate = {'requested_rate': 1.0/(requested*sample_time), 'configured_rate': 1.0/(record_period*sample_time), \
+            'bandwidth_rate': record_bandwidth(parser.record_size, baudrate), 'record_period': record_period, 'record_size': parser.record_size}
+        self.get_logger().info('Galil data record every %d samples (%.1f Hz)' % (record_period, self.record_rate['configured_rate']))
+
+    # Stop Galil data record output
+    def stop_data_record(self):
+        if self.record_reader is not None:
+            try:
+                self.galil.send("DR 0")
+            except (GalilError, OSError) as e:
+                self.get_logger().info('Could not stop Galil data record: %s' % (e))
+            self.record_reader.stop()
+            self.record_reader.join(timeout=1.0)
+            self.record_reader = None
+            self.galil.streaming = False
+
+    # New Galil data record (called from reader thread)
+    def record_callback(self, sample, positions):
+        stamp = Time(nanoseconds=self.sample_clock.stamp(sample, self.get_clock().now().nanoseconds)).to_msg()
+        self.update_motion(positions[0], positions[1])
+        self.publish_needle_pose(positions[0], positions[1], stamp)
+
     # Timer to publish '/stage/state/needle_pose'  
     def timer_needle_pose_callback(self):
-        if (self.needle_base.size != 0): 
+        # Read motors while a goal is running (motion feedback) or once the needle base is known
+        if (self.needle_base.size != 0) or self.active_goals: 
             # Read needle guide position from robot motors
-            read_position = str(self.getMotorPosition())
-            read_position = read_position[2 : : ]
+            read_position = self.getMotorPosition()
             read_position = read_position.replace(':', '')
             Z = read_position.split(',')
+            if len(Z) < 2:
+                return
+            self.update_motion(float(Z[0]), float(Z[1]))
+            if (self.needle_base.size != 0): 
+                self.get_logger().info('motor read: %f %f ' % (float(Z[0]),float(Z[1])))
+                self.publish_needle_pose(float(Z[0]), float(Z[1]), self.get_clock().now().to_msg(), verbose=True)
+
+    # New encoder reading: cache it and update running MoveStage goals
+    def update_motion(self, count_A, count_B):
+        self.motor_position = np.array([count_A, count_B])
+        with self.goals_lock:
+            goals = list(self.active_goals.items())
+        for goal_handle, goal in goals:
+            if goal['done'].done():
+                continue
+            # Stream real stage position (stage frame) as feedback
+            feedback_msg = MoveStage.Feedback()
+            feedback_msg.x, feedback_msg.z = self.counts_to_stage(count_A, count_B)
+            goal_handle.publish_feedback(feedback_msg)
+            if goal_handle.is_cancel_requested:
+                self.finish_goal(goal, 'canceled')
+            elif np.max(np.abs(self.motor_position - goal['target'])) <= goal['tolerance']:
+                self.finish_goal(goal, 'succeeded')
+
+    # Complete goal future only once (encoder updates and timeout timer run in different threads)
+    def finish_goal(self, goal, status):
+        with self.goals_lock:
+            if not goal['done'].done():
+                goal['done'].set_result(status)
+
+    # Finish MoveStage goals that were canceled or did not reach the target in time (also without encoder readings)
+    def timer_goal_timeout_callback(self):
+        with self.goals_lock:
+            goals = list(self.active_goals.items())
+        now = time.monotonic()
+        for goal_handle, goal in goals:
+            if goal['done'].done():
+                continue
+            if goal_handle.is_cancel_requested:
+                self.finish_goal(goal, 'canceled')
+            elif now > goal['deadline']:
+                self.finish_goal(goal, 'timeout')
+
+    # Stage position in mm (stage frame) from motor counts
+    def counts_to_stage(self, count_A, count_B):
+        x = float(count_A)*COUNT_2_MM
+        # WARNING: Galil channel B inverted
+        z = -float(count_B)*COUNT_2_MM
+        if self.entry_point.size != 0:
+            x += self.entry_point[0,0]
+            z += self.entry_point[2,0]
+        return x, z
+
+    # Publish '/stage/state/needle_pose' from motor counts (channels A and B)
+    def publish_needle_pose(self, count_A, count_B, stamp, verbose=False):
+        if (self.needle_base.size != 0) and (self.entry_point.size != 0):
             # Construct robot message to publish             
             # Add the initial entry point (home position)
             msg = PoseStamped()
-            msg.header.stamp = self.get_clock().now().to_msg()
+            msg.header.stamp = stamp
             msg.header.frame_id = "stage"
-            msg.pose.position.x = float(Z[0])*COUNT_2_MM + self.entry_point[0,0]
+            msg.pose.position.x, msg.pose.position.z = self.counts_to_stage(count_A, count_B)
             msg.pose.position.y = float(self.needle_base[1])
-            # WARNING: Galil channel B inverted, that is why the my_goal is negative
-            msg.pose.position.z = -float(Z[1])*COUNT_2_MM + self.entry_point[2,0]
-
-            self.get_logger().info('motor read: %f %f ' % (float(Z[0]),float(Z[2])))
   
             msg.pose.orientation = Quaternion(w=float(1), x=float(0), y=float(0), z=float(0))
             self.publisher_needle_pose.publish(msg)
 
-            self.get_logger().info('needle_pose: x=%f, y=%f, z=%f, q=[%f, %f, %f, %f] in %s frame'  % (msg.pose.position.x, msg.pose.position.y, \
-                msg.pose.position.z,  msg.pose.orientation.w, msg.pose.orientation.x, msg.pose.orientation.y, msg.pose.orientation.z, msg.header.frame_id))
+            if verbose:
+                self.get_logger().info('needle_pose: x=%f, y=%f, z=%f, q=[%f, %f, %f, %f] in %s frame'  % (msg.pose.position.x, msg.pose.position.y, \
+                    msg.pose.position.z,  msg.pose.orientation.w, msg.pose.orientation.x, msg.pose.orientation.y, msg.pose.orientation.z, msg.header.frame_id))
 
     # Initialization after needle is positioned in the entry point (after SPACE hit)
     def entry_callback(self, msg):
         if (self.entry_point.size == 0):
-            self.ser.write(str.encode("DPA=0;"))
-            time.sleep(0.02)
-            self.ser.write(str.encode("PTA=1;"))
-            time.sleep(0.02)
-            self.ser.write(str.encode("DPB=0;"))
-            time.sleep(0.02)
-            self.ser.write(str.encode("PTB=1;"))
-            time.sleep(0.02)
-            self.ser.write(str.encode("SH;")) #Check this code
+            try:
+                self.galil.send([axes_command("DP", [0, 0]), axes_command("PT", [1, 1]), "SH"]) #Check this code
+            except (GalilError, OSError) as e:
+                self.get_logger().info('Could not initialize Galil: %s' % (e))
             self.AbsoluteMode = True
             self.get_logger().info('Needle guide at position zero')
 
@@ -158,11 +314,7 @@ class SmartTemplate(Node):
                 self.aurora = np.row_stack((self.aurora, Z_sensor))
 
                 # Smooth the measurements with a median filter 
-                n = self.aurora.shape[0]
-                size_win = min(n, 500) #array window size
-                if (size_win>0): 
-                    Z_filt = median_filter(self.aurora[n-size_win:n,:], size=(40,1)) # use 40 samples median filter (column-wise)
-                    Z_sensor = Z_filt[size_win-1,:]                                  # get last value
+                Z_sensor = median_last(self.aurora[-FILTER_WINDOW:,:], FILTER_SIZE) # last value of median filter (column-wise)
                             
                 # Transform from sensor to robot frame
                 self.needle_base = pose_transform(Z_sensor, self.registration)
@@ -170,6 +322,8 @@ class SmartTemplate(Node):
                 
     # Destroy de action server
     def destroy(self):
+        self.connection.stop()
+        self.stop_data_record()
         self._action_server.destroy()
         super().destroy_node()
 
@@ -180,15 +334,21 @@ class SmartTemplate(Node):
         return GoalResponse.ACCEPT
 
     # Accept or reject a client request to cancel an action
+    # Running goal finishes at the next encoder reading and motion is stopped
     def cancel_callback(self, goal_handle):
         self.get_logger().info('Received cancel request')
         return CancelResponse.ACCEPT
 
+    # Stop both channels
+    def stop_motion(self):
+        try:
+            self.galil.send(axes_list("ST", 2))
+        except (GalilError, OSError) as e:
+            self.get_logger().info("*** could not stop motion: %s ***" % (e))
+
     def exec_motion(self):
         try:
-            self.ser.write(str.encode("BG \r"))
-            time.sleep(0.1)
-            self.ser.write(str.encode("PR 0,0,0,0 \r"))
+            self.galil.send(["BG", axes_command("PR", [0, 0, 0, 0])])
             # self.get_logger().info("Sent BG to Galil")
             return 1
         except:
@@ -204,27 +364,25 @@ class SmartTemplate(Node):
             X = -SAFE_LIMIT*MM_2_COUNT
         return X
 
-    def send_movement_in_counts(self,X,Channel):
-   #     try:
-        X = self.check_limits(X,Channel)
-        send = "PA%s=%d;" % (Channel,int(X))
-        self.ser.write(str.encode(send))
-        time.sleep(0.01)
-        self.get_logger().info("Sent to Galil PA%s=%d" % (Channel,X))
-    #    except:
-    #        self.get_logger().info("*** could not send command ***")
-    #        return 0
+    # Send both channels in a single coordinated PA command (axes start together in position tracking mode)
+    # Returns the commanded position in counts (after limits) or None if the controller did not accept it
+    def send_movement_in_counts(self,X_A,X_B):
+        X_A = self.check_limits(X_A,"A")
+        X_B = self.check_limits(X_B,"B")
+        try:
+            self.galil.send(axes_command("PA", [X_A, X_B]))
+            self.get_logger().info("Sent to Galil PA %d,%d" % (X_A,X_B))
+            return np.array([int(X_A), int(X_B)])
+        except (GalilError, OSError) as e:
+            self.get_logger().info("*** could not send command: %s ***" % (e))
+            return None
 
 
     # Execute a goal
+    # Waits (without blocking the executor) until the encoders reach the target, the goal is canceled or the timeout expires
     async def execute_callback(self, goal_handle):
         # self.get_logger().info('Executing goal...')
 
-        feedback_msg = MoveStage.Feedback()
-        #TODO
-        feedback_msg.x = 0.0 #self.needle_base[0,0]
-        feedback_msg.z = 0.0 #self.needle_base[1,0]
-
         # Start executing the action
         if goal_handle.is_cancel_requested:
             goal_handle.canceled()
@@ -244,22 +402,38 @@ class SmartTemplate(Node):
 
         self.get_logger().info("command %f %f" % (my_goal.x,my_goal.z))
         # Update control input
-        self.send_movement_in_counts(my_goal.x*MM_2_COUNT,"A")
         # WARNING: Galil channel B inverted, that is why the my_goal is negative
-        self.send_movement_in_counts(-my_goal.z*MM_2_COUNT,"B")
-        time.sleep(0.01)
-
-        feedback_msg.x = float(0.0)
-
-        # self.get_logger().info('Publishing feedback: {0}'.format(feedback_msg.x))
-
-        # Publish the feedback
-        goal_handle.publish_feedback(feedback_msg)
-        goal_handle.succeed()
+        target = self.send_movement_in_counts(my_goal.x*MM_2_COUNT,-my_goal.z*MM_2_COUNT)
+        result = MoveStage.Result()
+        if target is None:
+            goal_handle.abort()
+            return result
+
+        # Wait for encoder feedback to reach target
+        tolerance = my_goal.eps if (my_goal.eps > 0) else self.get_parameter('move_tolerance').get_parameter_value().double_value
+        goal = {'target': target, 'tolerance': tolerance*MM_2_COUNT, 'done': Future(executor=self.executor), \
+            'deadline': time.monotonic() + self.get_parameter('move_timeout').get_parameter_value().double_value}
+        with self.goals_lock:
+            self.active_goals[goal_handle] = goal
+        try:
+            status = await goal['done']
+        finally:
+            with self.goals_lock:
+                del self.active_goals[goal_handle]
 
         # Populate result message
-        result = MoveStage.Result()
-        result.x = feedback_msg.x
+        if self.motor_position is not None:
+            result.x, _ = self.counts_to_stage(self.motor_position[0], self.motor_position[1])
+        if status != 'succeeded':
+            self.stop_motion()
+        if status == 'succeeded':
+            goal_handle.succeed()
+        elif status == 'canceled':
+            goal_handle.canceled()
+            self.get_logger().info('Goal canceled')
+        else:
+            goal_handle.abort()
+            self.get_logger().info('Goal aborted: target not reached after %.1f s' % (self.get_parameter('move_timeout').get_parameter_value().double_value))
 
         # self.get_logger().info('Returning result: {0}'.format(result.x))
 
@@ -267,32 +441,6 @@ class SmartTemplate(Node):
 
 ########################################################################
 
-# Function: pose_transform
-# DO: Transform pose to new reference frame
-# Inputs: 
-#   x_origin: pose in original reference frame (numpy array [x, y, z, qw, qx, qy, qz])
-#   x_tf: transformation from original to new frame (numpy array [x, y, z, qw, qx, qy, qz])
-# Output:
-#   x_new: pose in new reference frame (numpy array [x, y, z, qw, qx, qy, qz])
-def pose_transform(x_orig, x_tf):
-
-    #Define frame transformation
-    p_tf = np.quaternion(0, x_tf[0], x_tf[1], x_tf[2])
-    q_tf= np.quaternion(x_tf[3], x_tf[4], x_tf[5], x_tf[6])
-
-    #Define original position and orientation
-    p_orig = np.quaternion(0, x_orig[0], x_orig[1], x_orig[2])
-    q_orig = np.quaternion(x_orig[3], x_orig[4], x_orig[5], x_orig[6])
-
-    #Transform to new frame
-    q_new = q_tf*q_orig
-    p_new = q_tf*p_orig*q_tf.conj() + p_tf
-
-    x_new = np.array([p_new.x, p_new.y, p_new.z, q_new.w, q_new.x, q_new.y, q_new.z])
-    return x_new
-
-########################################################################
-
 def main(args=None):
     rclpy.init(args=args)
 
@@ -10,6 +10,7 @@ from action_msgs.msg import GoalStatus
 
 from geometry_msgs.msg import PoseStamped, PointStamped
 from stage_control_interfaces.action import MoveStage
+from trajcontrol.galil import GalilPort, GalilError, GalilConnection, axes_command, axes_list
 
 MM_2_COUNT = 1170.8 #1088.9
 COUNT_2_MM = 1.0/1170.8
@@ -23,40 +24,46 @@ class SmartTemplateManual(Node):
     def __init__(self):
         super().__init__('smart_template_manual')
 
+        #Declare node parameters
+        self.declare_parameter('serial_port', '')   # Galil serial port ('' = discover by USB attributes or probe handshake)
+        self.declare_parameter('usb_vid', 0)        # USB vendor id of the Galil serial adapter (0 = any)
+        self.declare_parameter('usb_pid', 0)        # USB product id of the Galil serial adapter (0 = any)
+        self.declare_parameter('usb_serial', '')    # USB serial number of the Galil serial adapter ('' = any)
+        self.declare_parameter('ping_period', 1.0)  # Link health check period (seconds)
+
         #Topic from keypress node
         self.subscription_keyboard = self.create_subscription(Int8, '/keyboard/key', self.keyboard_callback, 10)
         self.subscription_keyboard # prevent unused variable warning
 
-        #Start serial communication
+        #Start serial communication (link monitor reconnects if the controller is lost)
+        self.initialized = False    # DP/PT sent (once: later connections keep the stage origin)
+        self.galil = GalilPort(None)
+        self.connection = GalilConnection(self.galil, \
+            port=self.get_parameter('serial_port').get_parameter_value().string_value, \
+            vid=self.get_parameter('usb_vid').get_parameter_value().integer_value, \
+            pid=self.get_parameter('usb_pid').get_parameter_value().integer_value, \
+            serial_number=self.get_parameter('usb_serial').get_parameter_value().string_value, \
+            ping_period=self.get_parameter('ping_period').get_parameter_value().double_value, \
+            on_connect=self.connect_callback, log=self.get_logger().info)
+        if not self.connection.connect():
+            self.get_logger().info('Could not open Serial connection (retrying)')
+        self.connection.start()
+
+    # Serial link (re)established
+    def connect_callback(self, ser):
         try:
-            self.ser = serial.Serial('/dev/ttyUSB1', baudrate=115200, timeout=1)  # open serial port
-            self.connectionStatus = True
-            self.get_logger().info('Serial connection open ttyUSB1')
-            print(self.ser.is_open)
-        except:
-            try:
-                self.ser = serial.Serial('/dev/ttyUSB2', baudrate=115200, timeout=1)  # open serial port
-                self.get_logger().info('Serial connection open ttyUSB2')
-                print(self.ser.is_open)
-            except:
-                try:
-                    self.ser = serial.Serial('/dev/ttyUSB3', baudrate=115200, timeout=1)  # open serial port
-                    self.get_logger().info('Serial connection open ttyUSB3')
-                    print(self.ser.is_open)
-                except:
-                    self.get_logger().info('Could not open Serial connection')
-
-
-        #Initialize robot at current position
-        self.ser.write(str.encode("DPA=0;"))
-        time.sleep(0.02)
-        self.ser.write(str.encode("PTA=1;"))
-        time.sleep(0.02)
-        self.ser.write(str.encode("DPB=0;"))
-        time.sleep(0.02)
-        self.ser.write(str.encode("PTB=1;"))
-        time.sleep(0.02)
-        self.ser.write(str.encode("SH;")) #Check this code
+            if not self.initialized:
+                #Initialize robot at current position (first connection only: DP redefines the stage origin)
+                self.galil.send([axes_command("DP", [0, 0]), axes_command("PT", [1, 1]), "SH"]) #Check this code
+                self.initialized = True
+            else:
+                #Reconnection: keep the origin, enable the motors and read back the position
+                self.galil.send("SH")
+                position = [float(value) for value in self.galil.query("TP").split(',')[0:2]]
+                self.get_logger().info('Galil reconnected at A=%.3f mm, B=%.3f mm (origin kept)' % \
+                    (position[0]*COUNT_2_MM, position[1]*COUNT_2_MM))
+        except (GalilError, OSError, ValueError) as e:
+            self.get_logger().info('Could not initialize Galil: %s' % (e))
         self.AbsoluteMode = True
 
     def check_limits(self,X,Channel):
@@ -68,15 +75,15 @@ class SmartTemplateManual(Node):
             X = -SAFE_LIMIT*MM_2_COUNT
         return X
 
-    def send_movement_in_counts(self,X,Channel):
-        X = self.check_limits(X,Channel)
-        send = "PR%s=%d;" % (Channel,int(X))
-        self.ser.write(str.encode(send))
-        time.sleep(0.1)
-        send = "BG%s;" % (Channel)
-        self.ser.write(str.encode(send))
-        time.sleep(0.1)        
-        self.get_logger().info("Sent to Galil PR%s=%d" % (Channel,X))
+    # Send relative move and begin both channels in a single serial transaction
+    def send_movement_in_counts(self,X_A,X_B):
+        X_A = self.check_limits(X_A,"A")
+        X_B = self.check_limits(X_B,"B")
+        try:
+            self.galil.send([axes_command("PR", [X_A, X_B]), axes_list("BG", 2)])
+            self.get_logger().info("Sent to Galil PR %d,%d" % (X_A,X_B))
+        except (GalilError, OSError) as e:
+            self.get_logger().info("*** could not send command: %s ***" % (e))
 
     # A keyboard hotkey was pressed 
     def keyboard_callback(self, msg):
@@ -96,9 +103,8 @@ class SmartTemplateManual(Node):
         #########################################################
 
         # Send command to stage
-        self.send_movement_in_counts(float(cmd[0])*MM_2_COUNT,"A")
         # WARNING: Galil channel B inverted, that is why the my_goal is negative
-        self.send_movement_in_counts(-float(cmd[1])*MM_2_COUNT,"B")
+        self.send_movement_in_counts(float(cmd[0])*MM_2_COUNT,-float(cmd[1])*MM_2_COUNT)
 
 def main(args=None):
     rclpy.init(args=args)
@@ -108,6 +114,7 @@ def main(args=None):
     # Destroy the node explicitly
     # (optional - otherwise it will be done automatically
     # when the garbage collector destroys the node object)
+    smart_template_manual.connection.stop()
     smart_template_manual.destroy_node()
     rclpy.shutdown()
 
@@ -5,46 +5,215 @@ import numpy as np
 from rclpy.node import Node
 from geometry_msgs.msg import PoseStamped
 from ros2_igtl_bridge.msg import Transform
-from scipy.io import loadmat
-
+from numpy import loadtxt
+from trajcontrol import dataset
+from trajcontrol.log_replay import ReplayEvents, SOURCES as REPLAY_SOURCES
+from trajcontrol.needle_sim import NeedleSim, CURVATURE, TISSUE_LENGTH, GUIDE_GAP
+from trajcontrol.pose_filter import pose_inverse, quaternion_multiply, rotvec_quaternion
+from trajcontrol.sim_clock import StepAck
+
+POSE_SOURCES = ('needle', 'log', 'dataset')
+NEEDLE_TOOLS = {'NeedleToTracker': 0, 'BaseToTracker': 1}     # Tool name: NeedleSim.aurora reading (tip, base)
+IDENTITY = [0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0]
+
+# Class: VirtualAurora
+# DO: Simulated Aurora tracker publishing named tools on IGTL_TRANSFORM_IN
+#     Tool poses come from a needle simulation mirroring the stage (/stage/state/needle_pose),
+#     from the Aurora readings of a recorded run or from a .mat dataset (tip position only)
+#     Tools without a source stay at 'static_pose' (reference tool fixed in the tracker frame)
+#     Readings get Gaussian position and orientation noise, occasional spikes and dropouts,
+#     and the publishing period is jittered around 1/rate
 class VirtualAurora(Node):
 
-    def __init__(self):
-        super().__init__('virtual_aurora')
+    def __init__(self, node_name='virtual_aurora'):
+        super().__init__(node_name)
 
         #Declare node parameters
-        self.declare_parameter('dataset', 'aurora_26') #Dataset file name
+        self.declare_parameter('source', 'dataset')        #Pose source: needle / log / dataset
+        self.declare_parameter('tools', self.default_tools())  #Published tool names (name adjusted in Plus .xml)
+        self.declare_parameter('rate', 40.0)               #Tracker frame rate (Hz)
+        self.declare_parameter('noise', 0.1)               #Position noise (mm, standard deviation)
+        self.declare_parameter('rotation_noise', 0.002)    #Orientation noise (rad, standard deviation)
+        self.declare_parameter('spike_rate', 0.0)          #Probability of a spike in each reading
+        self.declare_parameter('spike_size', 5.0)          #Spike position error (mm)
+        self.declare_parameter('dropout', 0.0)             #Probability of a missing reading (each tool)
+        self.declare_parameter('jitter', 0.0)              #Frame period jitter (s, standard deviation)
+        self.declare_parameter('seed', -1)                 #Random seed (-1 = random)
+        self.declare_parameter('static_pose', IDENTITY)    #Pose of tools without a source (Aurora frame)
+        self.declare_parameter('dataset', 'fbg_10')        #Dataset file name (source = dataset, files/<dataset>.mat)
+        self.declare_parameter('sample_period', 0.5)       #Time between dataset samples (s, source = dataset)
+        self.declare_parameter('log', '')                  #Recorded run (source = log, csv / col / stream directory)
+        self.declare_parameter('loop', False)              #Restart the log when it ends (source = log)
+        self.declare_parameter('entry', [12.5, 0.0, 11.0]) #Needle simulation (source = needle, same as virtual_robot)
+        self.declare_parameter('curvature', CURVATURE)
+        self.declare_parameter('bevel', 0.0)
+        self.declare_parameter('tissue_length', TISSUE_LENGTH)
+        self.declare_parameter('guide_gap', GUIDE_GAP)
+
+        self.source = self.get_parameter('source').get_parameter_value().string_value
+        if self.source not in POSE_SOURCES:
+            raise ValueError('Unknown pose source %s (%s)' % (self.source, ', '.join(POSE_SOURCES)))
+        self.tools = list(self.get_parameter('tools').get_parameter_value().string_array_value)
+        self.rate = self.get_parameter('rate').get_parameter_value().double_value
+        self.noise = self.get_parameter('noise').get_parameter_value().double_value
+        self.rotation_noise = self.get_parameter('rotation_noise').get_parameter_value().double_value
+        self.spike_rate = self.get_parameter('spike_rate').get_parameter_value().double_value
+        self.spike_size = self.get_parameter('spike_size').get_parameter_value().double_value
+        self.dropout = self.get_parameter('dropout').get_parameter_value().double_value
+        self.jitter = self.get_parameter('jitter').get_parameter_value().double_value
+        seed = self.get_parameter('seed').get_parameter_value().integer_value
+        self.rng = np.random.default_rng(None if seed < 0 else seed)
+
+        # Current true pose of each tool (Aurora frame), tools without a source keep the static pose
+        self.poses = np.tile(np.array(self.get_parameter('static_pose').get_parameter_value().double_array_value), (len(self.tools), 1))
+
+        #Pose sources
+        if self.source == 'needle':
+            self.load_needle()
+        elif self.source == 'log':
+            self.load_log()
+        else:
+            self.load_dataset()
 
         #Published topics
-        #Topics from Aurora sensor node
+        self.create_output()
+        self.period = 1.0/self.rate
+        self.step_ack = StepAck(self)
+        self.timer = self.step_ack.create_timer(self.period, self.timer_callback)
+        self.start = self.get_clock().now().nanoseconds
+        self.get_logger().info('Tracking %s at %.1f Hz from %s' % (', '.join(self.tools), self.rate, self.source))
+
+    def default_tools(self):
+        return ['NeedleToTracker', 'BaseToTracker']
+
+    #Topics from Aurora sensor node
+    def create_output(self):
         self.publisher = self.create_publisher(Transform, 'IGTL_TRANSFORM_IN', 10)
-        timer_period = 0.5  # seconds
-        self.timer = self.create_timer(timer_period, self.timer_callback)
-
-        #Load data from matlab file
-        file_path = os.path.join(os.getcwd(),'src','trajcontrol','files',self.get_parameter('dataset').get_parameter_value().string_value + '.mat') #String with full path to file
-        trial_data = loadmat(file_path, mat_dtype=True)
-        self.sensor = trial_data['sensor'][0]
-        self.i=0
-
-    def timer_callback(self):        
-
-        msg = Transform()
-        msg.name = "NeedleToTracker"    
-
-        if (self.i < self.sensor.size):
-            X = self.sensor[self.i]
-            j = int((X.size/3)-1)
-            msg.transform.translation.x = float(X[0][j])
-            msg.transform.translation.y = float(X[1][j])
-            msg.transform.translation.z = float(X[2][j])
-
-            self.i += 1
-
-        self.publisher.publish(msg)
-        # self.get_logger().info('Publish IGTL_Transform : %s'  % (msg.transform))
 
-        #self.get_logger().info('Tip Position = [%f, %f, %f] ' % (msg.transform.translation.x,msg.transform.translation.y,msg.transform.translation.z))
+    # Needle simulation following the stage (tip and base sensors)
+    def load_needle(self):
+        self.sim = NeedleSim(np.array(self.get_parameter('entry').get_parameter_value().double_array_value), \
+            curvature=self.get_parameter('curvature').get_parameter_value().double_value, \
+            bevel=self.get_parameter('bevel').get_parameter_value().double_value, \
+            tissue_length=self.get_parameter('tissue_length').get_parameter_value().double_value, \
+            guide_gap=self.get_parameter('guide_gap').get_parameter_value().double_value, \
+            stage_speed=np.inf, insertion_speed=np.inf, sensor_noise=0.0)
+        #Aurora frame: inverse of the registration loaded by sensor_processing
+        try:
+            registration = np.array(loadtxt(os.path.join(os.getcwd(),'src','trajcontrol','files','registration.csv'), delimiter=','))
+        except IOError:
+            self.get_logger().info('Could not find registration.csv file, Aurora frame = stage frame')
+            registration = np.array(IDENTITY)
+        self.aurora_tf = pose_inverse(registration)
+        self.needle_tools = [(i, NEEDLE_TOOLS[name]) for i, name in enumerate(self.tools) if name in NEEDLE_TOOLS]
+        self.update_needle()
+
+        #Topics from robot node
+        self.subscription_robot = self.create_subscription(PoseStamped, '/stage/state/needle_pose', self.robot_callback, 10)
+        self.subscription_robot # prevent unused variable warning
+
+    # Aurora readings of a recorded run, one trajectory per tool
+    def load_log(self):
+        filename = self.get_parameter('log').get_parameter_value().string_value
+        events = ReplayEvents.load(filename)
+        self.loop = self.get_parameter('loop').get_parameter_value().bool_value
+        self.trajectories = []
+        for i, name in enumerate(self.tools):
+            source = [k for k, (_, _, _, output) in enumerate(REPLAY_SOURCES) if output == name]
+            selected = (events.source == source[0]) if source else np.zeros(len(events), dtype=bool)
+            if np.any(selected):
+                self.trajectories.append((i, events.time[selected], events.values[selected]))
+        if not self.trajectories:
+            raise ValueError('%s: no Aurora readings for %s' % (filename, ', '.join(self.tools)))
+        self.log_start = min(time[0] for _, time, _ in self.trajectories)
+        self.log_duration = max(time[-1] for _, time, _ in self.trajectories) - self.log_start
+
+    # Tip positions of a .mat dataset (last shape point of each sample)
+    def load_dataset(self):
+        #Load dataset (converted from the matlab file once, memory mapped)
+        self.samples = dataset.load(self.get_parameter('dataset').get_parameter_value().string_value).last('sensor')
+        self.sample_period = self.get_parameter('sample_period').get_parameter_value().double_value
+        self.tip_tool = self.tools.index('NeedleToTracker') if 'NeedleToTracker' in self.tools else None
+
+    # Follow stage and insertion depth (y = entry y + depth) with the mirrored needle
+    def robot_callback(self, msg_robot):
+        robot = msg_robot.pose
+        self.sim.move([robot.position.x, robot.position.z])
+        self.sim.insert(robot.position.y - self.sim.entry[0,1] - self.sim.depth_target[0])
+        self.sim.step(self.period)
+        self.update_needle()
+
+    def update_needle(self):
+        readings = self.sim.aurora(self.aurora_tf)
+        for i, reading in self.needle_tools:
+            self.poses[i] = readings[reading][0]
+
+    # Update true tool poses from the log or dataset at the current time
+    def update_recorded(self, elapsed):
+        if self.source == 'log':
+            t = self.log_start + elapsed
+            if self.loop and self.log_duration > 0:
+                t = self.log_start + elapsed % (self.log_duration + int(self.period*1e9))
+            for i, time, values in self.trajectories:
+                k = int(np.searchsorted(time, t, side='right')) - 1
+                if k >= 0:
+                    self.poses[i] = values[k]
+        elif self.tip_tool is not None:
+            k = min(int(elapsed*1e-9/self.sample_period), len(self.samples)-1)
+            self.poses[self.tip_tool] = np.concatenate((self.samples[k], [1.0, 0.0, 0.0, 0.0]))
+
+    # Publish one tracker frame
+    def timer_callback(self):
+        if self.source != 'needle':
+            self.update_recorded(self.get_clock().now().nanoseconds - self.start)
+
+        readings = noisy_readings(self.poses, self.rng, self.noise, self.rotation_noise, self.spike_rate, self.spike_size)
+        visible = self.rng.random(len(self.tools)) >= self.dropout
+        self.publish_readings([name for name, seen in zip(self.tools, visible) if seen], readings[visible])
+
+        # Next frame after a jittered period
+        if self.jitter > 0:
+            period = max(self.period + self.rng.normal()*self.jitter, 0.1*self.period)
+            self.timer.timer_period_ns = int(period*1e9)
+
+    # Publish the visible tools of one frame
+    def publish_readings(self, names, readings):
+        for name, X in zip(names, readings):
+            msg = Transform()
+            msg.name = name
+            msg.transform.translation.x = float(X[0])
+            msg.transform.translation.y = float(X[1])
+            msg.transform.translation.z = float(X[2])
+            msg.transform.rotation.w = float(X[3])
+            msg.transform.rotation.x = float(X[4])
+            msg.transform.rotation.y = float(X[5])
+            msg.transform.rotation.z = float(X[6])
+            self.publisher.publish(msg)
+
+########################################################################
+### Auxiliar functions ###
+########################################################################
+
+# Function: noisy_readings
+# DO: Tracker readings of true tool poses
+# Inputs:
+#   poses: true poses (numpy array Nx7 [x, y, z, qw, qx, qy, qz])
+#   rng: numpy random Generator
+#   noise: position noise (standard deviation)
+#   rotation_noise: orientation noise (rad, standard deviation of a random rotation vector)
+#   spike_rate: probability of a spike in each reading
+#   spike_size: spike position error (random direction)
+# Output:
+#   readings (numpy array Nx7)
+def noisy_readings(poses, rng, noise, rotation_noise, spike_rate, spike_size):
+    n = poses.shape[0]
+    position = poses[:,0:3] + rng.normal(size=(n, 3))*noise
+    spikes = rng.random(n) < spike_rate
+    if np.any(spikes):
+        direction = rng.normal(size=(np.count_nonzero(spikes), 3))
+        position[spikes] += spike_size*direction/np.linalg.norm(direction, axis=1, keepdims=True)
+    orientation = quaternion_multiply(rotvec_quaternion(rng.normal(size=(n, 3))*rotation_noise), poses[:,3:7])
+    return np.column_stack((position, orientation))
 
 def main(args=None):
     rclpy.init(args=args)
@@ -1,26 +1,45 @@
-from sympy import Point3D
 import rclpy
 import os
+import threading
 import numpy as np
 
 from rclpy.action import ActionServer, CancelResponse, GoalResponse
 from rclpy.callback_groups import ReentrantCallbackGroup
 from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
+from rclpy.task import Future
 from stage_control_interfaces.action import MoveStage
+from ros2_igtl_bridge.msg import Transform
 
 from geometry_msgs.msg import PoseStamped
 from geometry_msgs.msg import Quaternion, Point
-from transforms3d.euler import euler2quat
-from scipy.io import loadmat
+from std_msgs.msg import Int8
+from numpy import loadtxt
+from trajcontrol.needle_sim import NeedleSim, CURVATURE, TISSUE_LENGTH, GUIDE_GAP, STAGE_SPEED, INSERTION_SPEED, SENSOR_NOISE
+from trajcontrol.pose_filter import pose_inverse
+from trajcontrol.sim_clock import StepAck
 
 class VirtualRobot(Node):
 
     def __init__(self):
         super().__init__('virtual_robot')
-        
+
         #Declare node parameters
-        self.declare_parameter('dataset', 'fbg_10') #Dataset file name
+        self.declare_parameter('entry', [12.5, 0.0, 11.0])     #Needle tip at entry point (stage frame)
+        self.declare_parameter('curvature', CURVATURE)         #Bevel tip path curvature (1/mm)
+        self.declare_parameter('bevel', 0.0)                   #Bevel direction (rad, 0 = +x, pi/2 = +z)
+        self.declare_parameter('tissue_length', TISSUE_LENGTH) #Decay length of guide motion transmitted to the tip (mm)
+        self.declare_parameter('guide_gap', GUIDE_GAP)         #Distance from needle guide to skin (mm)
+        self.declare_parameter('stage_speed', STAGE_SPEED)     #Stage axes speed (mm/s)
+        self.declare_parameter('insertion_speed', INSERTION_SPEED) #Insertion speed (mm/s)
+        self.declare_parameter('insertion_step', 5.0)          #Insertion step between control commands (mm)
+        self.declare_parameter('max_depth', 100.0)             #Stop inserting at this depth (mm)
+        self.declare_parameter('sensor_noise', SENSOR_NOISE)   #Aurora position noise (mm)
+        self.declare_parameter('seed', -1)                     #Random seed (-1 = random)
+        self.declare_parameter('publish_aurora', True)         #Publish simulated Aurora readings on IGTL_TRANSFORM_IN
+        self.declare_parameter('auto_step', True)              #Insert and hit SPACE after each step (operator stand-in)
+        self.declare_parameter('step_wait', 1.0)               #Time after SPACE to wait for a control command (s)
+        self.declare_parameter('period', 0.02)                 #Simulation step and publishing period (s)
 
         #Topics from sensor processing node
         self.subscription_entry_point = self.create_subscription(PoseStamped, '/subject/state/skin_entry', self.entry_callback, 10)
@@ -28,52 +47,102 @@ class VirtualRobot(Node):
 
         #Published topics
         self.publisher_needle_pose = self.create_publisher(PoseStamped, '/stage/state/needle_pose', 10)
-        timer_period = 0.8  # seconds
-        self.timer = self.create_timer(timer_period, self.timer_needlepose_callback)
+        self.publisher_aurora = self.create_publisher(Transform, 'IGTL_TRANSFORM_IN', 10)
+        self.publisher_keyboard = self.create_publisher(Int8, '/keyboard/key', 10)
+        self.period = self.get_parameter('period').get_parameter_value().double_value
+        self.step_ack = StepAck(self)
+        self.timer = self.step_ack.create_timer(self.period, self.timer_simulation_callback)
 
         #Action server
         self._action_server = ActionServer(self, MoveStage, '/move_stage', execute_callback=self.execute_callback,\
             callback_group=ReentrantCallbackGroup(), goal_callback=self.goal_callback, cancel_callback=self.cancel_callback)
 
-        #Load data from matlab file
-        file_path = os.path.join('src','trajcontrol','files',self.get_parameter('dataset').get_parameter_value().string_value+ '.mat') #String with full path to file
-        trial_data = loadmat(file_path, mat_dtype=True)
-        
+        #Needle-tissue simulator
+        seed = self.get_parameter('seed').get_parameter_value().integer_value
+        self.sim = NeedleSim(np.array(self.get_parameter('entry').get_parameter_value().double_array_value), \
+            curvature=self.get_parameter('curvature').get_parameter_value().double_value, \
+            bevel=self.get_parameter('bevel').get_parameter_value().double_value, \
+            tissue_length=self.get_parameter('tissue_length').get_parameter_value().double_value, \
+            guide_gap=self.get_parameter('guide_gap').get_parameter_value().double_value, \
+            stage_speed=self.get_parameter('stage_speed').get_parameter_value().double_value, \
+            insertion_speed=self.get_parameter('insertion_speed').get_parameter_value().double_value, \
+            sensor_noise=self.get_parameter('sensor_noise').get_parameter_value().double_value, \
+            seed=None if seed < 0 else seed)
+        self.publish_aurora = self.get_parameter('publish_aurora').get_parameter_value().bool_value
+        self.auto_step = self.get_parameter('auto_step').get_parameter_value().bool_value
+        self.insertion_step = self.get_parameter('insertion_step').get_parameter_value().double_value
+        self.max_depth = self.get_parameter('max_depth').get_parameter_value().double_value
+        self.step_wait = self.get_parameter('step_wait').get_parameter_value().double_value
+
+        #Aurora frame: inverse of the registration loaded by sensor_processing
+        try:
+            registration = np.array(loadtxt(os.path.join(os.getcwd(),'src','trajcontrol','files','registration.csv'), delimiter=','))
+        except IOError:
+            self.get_logger().info('Could not find registration.csv file, Aurora frame = stage frame')
+            registration = np.array([0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0])
+        self.aurora_tf = pose_inverse(registration)
+
         # Stored values
         self.entry_point = np.empty(shape=[7,0])    # Initial needle tip pose
-        self.needle_pose = trial_data['needle_pose'][0]
-        self.time_stamp = trial_data['time_stamp'][0]
-        self.i = 0
+        self.goals = {}                             # Active MoveStage goals (goal handle: Future)
+        self.goals_lock = threading.Lock()
+        self.wait = None                            # Simulation time when SPACE was sent (waiting for a command)
 
     # Get current entry point
     def entry_callback(self, msg):
-        entry_point = msg.pose
-        self.entry_point = np.array([[entry_point.position.x, entry_point.position.y, entry_point.position.z, \
-                                entry_point.orientation.w, entry_point.orientation.x, entry_point.orientation.y, entry_point.orientation.z]]).T
-
-    # Publish current needle_pose
-    def timer_needlepose_callback(self):
-        # Publish needle_pose only after entry point is acquired
-        if (self.entry_point.size != 0):
-            # Use Aurora timestamp
-            now = self.get_clock().now().to_msg()
-            decimal = np.mod(self.time_stamp[self.i],1)
-            now.nanosec = int(decimal*1e9)
-            now.sec = int(self.time_stamp[self.i]-decimal)
-            
-            msg = PoseStamped()
-            msg.header.stamp = now
-            msg.header.frame_id = "stage"
-
-            # Populate message with Z data from matlab file and previous control input
-            Z = self.needle_pose[self.i]
-            new_rand = np.random.randn(2,1)
-            msg.pose.position = Point(x=self.entry_point[0,0]+0.1*new_rand[0,0], y=Z[1,0], z=self.entry_point[2,0]+0.1*new_rand[1,0])
-            msg.pose.orientation = Quaternion(x=float(Z[3,0]), y=float(Z[4,0]), z=float(Z[5,0]), w=float(Z[6,0]))
-
-            self.publisher_needle_pose.publish(msg)
-            # self.get_logger().info('Publish - Needle pose: %s'  % (msg.pose))
-            self.i += 1
+        if (self.entry_point.size == 0):
+            entry_point = msg.pose
+            self.entry_point = np.array([[entry_point.position.x, entry_point.position.y, entry_point.position.z, \
+                                    entry_point.orientation.w, entry_point.orientation.x, entry_point.orientation.y, entry_point.orientation.z]]).T
+            self.get_logger().info('Entry point acquired, starting insertion')
+
+    # Step simulation and publish stage and Aurora readings
+    def timer_simulation_callback(self):
+        self.sim.step(self.period)
+        now = self.get_clock().now().to_msg()
+
+        # Stage encoders
+        Z = self.sim.stage_pose()[0]
+        msg = PoseStamped()
+        msg.header.stamp = now
+        msg.header.frame_id = "stage"
+        msg.pose.position = Point(x=Z[0], y=Z[1], z=Z[2])
+        msg.pose.orientation = Quaternion(w=Z[3], x=Z[4], y=Z[5], z=Z[6])
+        self.publisher_needle_pose.publish(msg)
+
+        # Aurora tip and base sensors
+        if self.publish_aurora:
+            for name, X in zip(['NeedleToTracker', 'BaseToTracker'], self.sim.aurora(self.aurora_tf)):
+                msg = Transform()
+                msg.name = name
+                msg.transform.translation.x = float(X[0,0])
+                msg.transform.translation.y = float(X[0,1])
+                msg.transform.translation.z = float(X[0,2])
+                msg.transform.rotation.w = float(X[0,3])
+                msg.transform.rotation.x = float(X[0,4])
+                msg.transform.rotation.y = float(X[0,5])
+                msg.transform.rotation.z = float(X[0,6])
+                self.publisher_aurora.publish(msg)
+
+        # Finished goals
+        with self.goals_lock:
+            for goal_handle, done in self.goals.items():
+                if done.done():
+                    continue
+                if goal_handle.is_cancel_requested:
+                    done.set_result('canceled')
+                elif not self.sim.moving()[0]:
+                    done.set_result('succeeded')
+
+        # Operator stand-in: insert one step, hit SPACE, wait for the stage, repeat
+        if self.auto_step and (self.entry_point.size != 0) and (not self.sim.moving()[0]) and (not self.goals):
+            if self.wait is None:
+                if self.sim.depth[0] > 0:
+                    self.publisher_keyboard.publish(Int8(data=32))
+                self.wait = self.sim.time
+            elif (self.sim.time - self.wait >= self.step_wait) and (self.sim.depth[0] + self.insertion_step <= self.max_depth):
+                self.sim.insert(self.insertion_step)
+                self.wait = None
 
     # Destroy de action server
     def destroy(self):
@@ -92,36 +161,30 @@ class VirtualRobot(Node):
         return CancelResponse.ACCEPT
 
     # Execute a goal
-    # This is a dummy action: the "goal" is to increment x from 0 to 4
+    # Moves the simulated stage to the goal and waits (without blocking the executor) until it gets there
     async def execute_callback(self, goal_handle):
-        self.get_logger().info('Executing goal...')
-
-        feedback_msg = MoveStage.Feedback()
-        feedback_msg.x = 0.0
-
-        # Start executing the action
-        for k in range(1, 5):
-            if goal_handle.is_cancel_requested:
-                goal_handle.canceled()
-                self.get_logger().info('Goal canceled')
-                return MoveStage.Result()
-
-            # Update control input
-            feedback_msg.x = float(k)
-
-            # self.get_logger().info('Publishing feedback: {0}'.format(feedback_msg.x))
-
-            # Publish the feedback
-            goal_handle.publish_feedback(feedback_msg)
-            
-        goal_handle.succeed()
+        my_goal = goal_handle.request
+        self.get_logger().info('Executing goal: x=%f, z=%f' % (my_goal.x, my_goal.z))
+        self.sim.move([my_goal.x, my_goal.z])
+
+        done = Future(executor=self.executor)
+        with self.goals_lock:
+            self.goals[goal_handle] = done
+        try:
+            status = await done
+        finally:
+            with self.goals_lock:
+                del self.goals[goal_handle]
 
         # Populate result message
         result = MoveStage.Result()
-        result.x = feedback_msg.x
-
-        # self.get_logger().info('Returning result: {0}'.format(result.x))
-
+        result.x = float(self.sim.stage[0,0])
+        if status == 'canceled':
+            self.sim.move(self.sim.stage)
+            goal_handle.canceled()
+            self.get_logger().info('Goal canceled')
+        else:
+            goal_handle.succeed()
         return result
 
 
@@ -1,12 +1,16 @@
 import rclpy
-import os
+import array
 import numpy as np
 
 from rclpy.node import Node
 from geometry_msgs.msg import PoseArray
 from geometry_msgs.msg import Pose
-from scipy.io import loadmat
+from sensor_msgs.msg import PointCloud2, PointField
 from builtin_interfaces.msg import Time
+from trajcontrol import dataset
+
+MESSAGES = ('pose_array', 'point_cloud', 'both')
+POINT_FIELDS = [PointField(name=name, offset=4*i, datatype=PointField.FLOAT32, count=1) for i, name in enumerate('xyz')]
 
 class VirtualSensor(Node):
 
@@ -15,49 +19,94 @@ class VirtualSensor(Node):
 
         #Declare node parameters
         self.declare_parameter('dataset', 'fbg_10') #Dataset file name
+        self.declare_parameter('rate', 2.0)         #Shape publishing rate (Hz, one dataset sample per message)
+        self.declare_parameter('message', 'pose_array') #Shape message: pose_array / point_cloud / both
+
+        self.message = self.get_parameter('message').get_parameter_value().string_value
+        if self.message not in MESSAGES:
+            raise ValueError('Unknown shape message %s (%s)' % (self.message, ', '.join(MESSAGES)))
 
         #Published topics
-        self.publisher_shape = self.create_publisher(PoseArray, '/needle/state/shape', 10)
-        timer_period = 0.5  # seconds
+        if self.message != 'point_cloud':
+            self.publisher_shape = self.create_publisher(PoseArray, '/needle/state/shape', 10)
+        if self.message != 'pose_array':
+            self.publisher_cloud = self.create_publisher(PointCloud2, '/needle/state/shape_cloud', 10)
+        timer_period = 1.0/self.get_parameter('rate').get_parameter_value().double_value  # seconds
         self.timer = self.create_timer(timer_period, self.timer_callback)
 
-        #Load data from matlab file
-        file_path = os.path.join('src','trajcontrol','files',self.get_parameter('dataset').get_parameter_value().string_value + '.mat') #String with full path to file
-        trial_data = loadmat(file_path, mat_dtype=True)
-        
-        self.sensor = trial_data['sensor'][0]
-        self.time_stamp = trial_data['time_stamp'][0]
+        #Load dataset (converted from the matlab file once, memory mapped)
+        self.dataset = dataset.load(self.get_parameter('dataset').get_parameter_value().string_value)
+        self.time_stamp = self.dataset.arrays['time_stamp']
         self.i=0
-        
-    # Publish current needle shape (PoseArray of 3D points)
+
+        #Pool of Pose objects for the longest shape (reused by every PoseArray)
+        self.pool = [Pose() for _ in range(int(np.diff(self.dataset.offsets['sensor']).max(initial=0)))]
+
+    # Publish current needle shape (PoseArray of 3D points and/or PointCloud2)
     def timer_callback(self):
-        
-        # Use Aurora timestamp
+
+        # Use Aurora timestamp (last sample after the dataset ends)
         now = self.get_clock().now().to_msg()
-        decimal = np.mod(self.time_stamp[self.i],1)
+        stamp = float(self.time_stamp[min(self.i, len(self.dataset)-1)])
+        decimal = np.mod(stamp,1)
         now.nanosec = int(decimal*1e9)
-        now.sec = int(self.time_stamp[self.i]-decimal)
-    
-        msg = PoseArray()
-        msg.header.stamp = now
-        msg.header.frame_id = "needle"
-
-        # Populate message with X data from matlab file
-        if (self.i < self.sensor.size):
-            X = self.sensor[self.i]
-            j = 0
-            while (j < X.size/3):
-                pose = Pose()
-                pose.position.x = float(X[0][j])
-                pose.position.y = float(X[1][j])
-                pose.position.z = float(X[2][j])
-                msg.poses.append(pose)
-                j += 1
+        now.sec = int(stamp-decimal)
+
+        # Shape points from the dataset (empty after the dataset ends)
+        X = np.empty((0, 3))
+        if (self.i < len(self.dataset)):
+            X = self.dataset.sample('sensor', self.i)      # Shape points (N x 3)
             self.i += 1
 
-        self.publisher_shape.publish(msg)
+        if self.message != 'point_cloud':
+            msg = PoseArray()
+            msg.header.stamp = now
+            msg.header.frame_id = "needle"
+            msg.poses = pose_array(X, self.pool)
+            self.publisher_shape.publish(msg)
+        if self.message != 'pose_array':
+            msg = point_cloud(X)
+            msg.header.stamp = now
+            msg.header.frame_id = "needle"
+            self.publisher_cloud.publish(msg)
         #self.get_logger().info('Publish - Pose Array %i = %s in %s frame' % (self.i, msg.poses, msg.header.frame_id))
 
+########################################################################
+### Auxiliar functions ###
+########################################################################
+
+# Function: pose_array
+# DO: Fill Poses of a preallocated pool with shape points
+# Inputs:
+#   X: shape points (numpy array Nx3)
+#   pool: list of at least N Pose objects
+# Output:
+#   first N poses of the pool (positions set, orientation untouched)
+def pose_array(X, pool):
+    poses = pool[:X.shape[0]]
+    for pose, (x, y, z) in zip(poses, X.tolist()):
+        position = pose.position
+        position.x = x
+        position.y = y
+        position.z = z
+    return poses
+
+# Function: point_cloud
+# DO: Unordered PointCloud2 (x, y, z float32) with the shape points in one contiguous buffer
+def point_cloud(X):
+    msg = PointCloud2()
+    msg.height = 1
+    msg.width = X.shape[0]
+    msg.fields = POINT_FIELDS
+    msg.is_bigendian = False
+    msg.point_step = 12
+    msg.row_step = 12*X.shape[0]
+    msg.is_dense = True
+    data = array.array('B')
+    data.frombytes(np.ascontiguousarray(X, dtype='<f4').tobytes())
+    msg.data = data
+    return msg
+
 def main(args=None):
     rclpy.init(args=args)
 